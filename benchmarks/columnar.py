@@ -0,0 +1,133 @@
+# Size and query time of the columnar raw archive (utils/columnar.py)
+#
+# Records a synthetic drive's raw fixes as a segment archive and a shelve
+# (the original raw<ts>.db format), converts both to columnar archives and
+# checks they read back identical, and that neither conversion traces more
+# than --peak MiB of memory at its peak. Where Python has no other dbm
+# module, the shelve's peak includes the index dbm.dumb keeps in memory of
+# every key. Then compares the file sizes and
+# the time to pull a time window out of each format.
+#
+# Usage: python3 benchmarks/columnar.py [--hours 6] [--window 600] [--peak 8]
+
+import argparse
+import os
+import shelve
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate
+from utils.archive import RawArchiveReader, RawArchiveWriter, segment_paths
+from utils.columnar import ColumnarArchive, convert_segments, convert_shelve
+from utils.pipeline import Pipeline
+
+class RecordRecorder:
+	# Stands in for the Sampler, the raw records are what matters here
+	def process_update(self, minimal):
+		pass
+
+def raw_records(hours):
+	records = []
+	pipeline = Pipeline(RecordRecorder())
+	pipeline.process_fix = lambda minimal, full: records.append((minimal['timestamp'], full))
+	for line in generate(1, hours * 3600):
+		pipeline.process_line(line.decode('ascii').strip())
+	return records
+
+def size(paths):
+	return sum(os.path.getsize(path) for path in paths)
+
+def timed(call, repeat=5):
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = call()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best * 1000, result
+
+def peak(call):
+	# MiB traced at the peak of call()
+	tracemalloc.start()
+	call()
+	peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+	tracemalloc.stop()
+	return peak
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare the raw archive formats')
+	parser.add_argument('--hours', type=float, default=6, help='hours of 1 Hz drive')
+	parser.add_argument('--window', type=int, default=600, help='seconds to query')
+	parser.add_argument('--peak', type=float, default=8, help='MiB a conversion may trace at its peak')
+	args = parser.parse_args()
+
+	records = raw_records(args.hours)
+	directory = tempfile.mkdtemp()
+	try:
+		prefix = os.path.join(directory, 'raw')
+		with RawArchiveWriter(prefix) as writer:
+			for timestamp, record in records:
+				writer.append(timestamp, record)
+
+		shelve_path = os.path.join(directory, 'shelve.db')
+		with shelve.open(shelve_path) as raw:
+			for timestamp, record in records:
+				raw[str(timestamp)] = record
+
+		columnar_path = prefix + '.col'
+		start = time.perf_counter()
+		convert_segments(prefix, columnar_path)
+		convert_time = time.perf_counter() - start
+		segments_peak = peak(lambda: convert_segments(prefix, columnar_path))
+		shelve_peak = peak(lambda: convert_shelve(shelve_path, os.path.join(directory, 'shelve.col')))
+
+		ok = segments_peak <= args.peak and shelve_peak <= args.peak
+		for path in (columnar_path, os.path.join(directory, 'shelve.col')):
+			with ColumnarArchive(path) as archive:
+				same = list(archive) == records
+			print("%-28s %s" % (os.path.basename(path) + ' reads back', 'identical' if same else 'DIFFERENT'))
+			ok = ok and same
+
+		shelve_files = [path for path in os.listdir(directory) if path.startswith('shelve.db')]
+		print("\n%d records, converted in %.2f s" % (len(records), convert_time))
+		print("%-28s %10.1f MiB" % ('peak converting segments', segments_peak))
+		print("%-28s %10.1f MiB" % ('peak converting the shelve', shelve_peak))
+		print("%-28s %10.1f KiB" % ('segments', size(segment_paths(prefix)) / 1024))
+		print("%-28s %10.1f KiB" % ('shelve', size(os.path.join(directory, path) for path in shelve_files) / 1024))
+		print("%-28s %10.1f KiB" % ('columnar', size([columnar_path]) / 1024))
+
+		t_start = records[len(records) // 2][0]
+		t_end = t_start + args.window - 1
+		fields = ['fix.lat', 'fix.lat_dir', 'fix.lon', 'fix.lon_dir']
+
+		def segment_scan():
+			return [(t, r) for t, r in RawArchiveReader(prefix) if t_start <= t <= t_end]
+
+		def shelve_lookup():
+			with shelve.open(shelve_path, 'r') as raw:
+				return [(t, raw[str(t)]) for t in range(t_start, t_end + 1) if str(t) in raw]
+
+		def columnar_query(fields=None):
+			with ColumnarArchive(columnar_path) as archive:
+				return list(archive.query(t_start, t_end, fields))
+
+		print("\n%d s window" % args.window)
+		for name, call in (
+			('segment scan', segment_scan),
+			('shelve key lookups', shelve_lookup),
+			('columnar, full records', columnar_query),
+			('columnar, 4 fields', lambda: columnar_query(fields))
+		):
+			elapsed, result = timed(call)
+			print("%-28s %10.2f ms  %d records" % (name, elapsed, len(result)))
+			ok = ok and len(result) == args.window
+
+		print("\nok" if ok else "\nMISMATCH")
+		sys.exit(0 if ok else 1)
+	finally:
+		shutil.rmtree(directory)
@@ -0,0 +1,119 @@
+# Points sent by the dead reckoning Sampler strategy against the distance one
+#
+# Runs a steady motorway leg (constant speed, near constant course, a few
+# metres of receiver noise) and the wandering synthetic drive through a grid
+# of settings of both strategies. For each max cross-track error of the
+# track from the sampled polyline (utils/sweep.py) it reports the fewest
+# points and bytes each strategy needs to stay within it. Dead reckoning
+# runs twice: extrapolating each sent fix's own speed and course
+# (velocity_fixes=1, 'raw velocity') and their mean over the last fixes as
+# the Sampler does by default. Also checks the streaming and batch paths
+# agree for dead reckoning. The default settings of both strategies are
+# shown first.
+#
+# Usage: python3 benchmarks/dead_reckoning.py [--duration 3600]
+
+import argparse
+import math
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.sampler_batch import recorded_fixes
+from utils.monitor import Sampler
+from utils.sweep import TRACK_FIELDS, evaluate, grid_search
+
+def motorway(duration, seed=1, speed=31.0, noise=2.0):
+	# 1 Hz fixes of a long straight-ish leg with gentle bends
+	rng = random.Random(seed)
+	lat, lon, course = 52.0, -1.5, 45.0
+	track = {key: [] for key in TRACK_FIELDS}
+	for t in range(int(duration)):
+		course = (course + 0.02 * math.sin(t / 600)) % 360
+		lat += speed * math.cos(math.radians(course)) / 111320
+		lon += speed * math.sin(math.radians(course)) / (111320 * math.cos(math.radians(lat)))
+		for key, value in zip(TRACK_FIELDS, (
+			1600000000 + t,
+			lat + rng.gauss(0, noise) / 111320,
+			lon + rng.gauss(0, noise) / (111320 * math.cos(math.radians(lat))),
+			speed + rng.gauss(0, 0.3),
+			(course + rng.gauss(0, 0.5)) % 360,
+			60.0
+		)):
+			track[key].append(value)
+	return track
+
+def drive(duration):
+	fixes = recorded_fixes(duration)
+	return {key: [fix[key] for fix in fixes] for key in TRACK_FIELDS}
+
+def streamed_indices(track, parameters):
+	emitted = []
+	sampler = Sampler(update_callback=lambda point: emitted.append(point['t']), **parameters)
+	for values in zip(*[track[key] for key in TRACK_FIELDS]):
+		update = dict(zip(TRACK_FIELDS, values))
+		update['status'] = 'A'
+		sampler.process_update(update)
+	return [track['timestamp'].index(t) for t in emitted]
+
+def fewest(results, target):
+	# Cheapest result within the max error target
+	within = [result for result in results if result['max_error'] <= target]
+	return min(within, key=lambda result: result['bytes']) if within else None
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare the Sampler strategies')
+	parser.add_argument('--duration', type=float, default=3600, help='seconds of each track')
+	args = parser.parse_args()
+
+	grids = {
+		'distance': grid_search({
+			'minimum_sampling_distance': [5, 10, 25, 50, 100, 200, 400],
+			'maximum_sampling_distance': [500, 2000, 30000],
+			'x_max': [0.01, 0.05, 0.15, 0.5]
+		}),
+		'dead_reckoning': grid_search({
+			'strategy': ['dead_reckoning'],
+			'drift_tolerance': [2, 5, 10, 25, 50, 100],
+			'max_interval': [60, 300, 900]
+		}),
+		'raw velocity': grid_search({
+			'strategy': ['dead_reckoning'],
+			'drift_tolerance': [2, 5, 10, 25, 50, 100],
+			'max_interval': [60, 300, 900],
+			'velocity_fixes': [1]
+		})
+	}
+	grids = {strategy: list(grid) for strategy, grid in grids.items()}
+
+	ok = True
+	for name, track in (('motorway', motorway(args.duration)), ('synthetic drive', drive(args.duration))):
+		print("%s, %d fixes; fewest points for a max cross-track error" % (name, len(track['timestamp'])))
+		results = {strategy: [evaluate(parameters, [track], 'json') for parameters in grid] for strategy, grid in grids.items()}
+
+		for strategy, parameters in (('distance', {}), ('dead_reckoning', {'strategy': 'dead_reckoning'})):
+			result = evaluate(parameters, [track], 'json')
+			print("  defaults  %-14s %6d points %7d bytes  max %7.1f m  mean %6.2f m" % (
+				strategy, result['points'], result['bytes'], result['max_error'], result['mean_error']
+			))
+
+		for target in (10, 25, 50, 100):
+			line = "  <= %3d m" % target
+			best = {strategy: fewest(results[strategy], target) for strategy in grids}
+			for strategy in ('raw velocity', 'dead_reckoning', 'distance'):
+				result = best[strategy]
+				if result is None:
+					line += "  %-14s      -" % strategy
+				else:
+					line += "  %-14s %5d points" % (strategy, result['points'])
+			print(line)
+
+		parameters = {'strategy': 'dead_reckoning'}
+		same = streamed_indices(track, parameters) == Sampler(**parameters).process_batch(track).tolist()
+		ok = ok and same
+		print("  dead reckoning streaming and batch %s\n" % ('identical' if same else 'DIFFERENT'))
+
+	print("ok" if ok else "MISMATCH")
+	sys.exit(0 if ok else 1)
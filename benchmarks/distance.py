@@ -0,0 +1,167 @@
+# Accuracy and speed of the Sampler distance engines (utils/distance.py)
+#
+# Accuracy is checked against WGS84 geodesic distances: a few tabulated
+# values and Vincenty's inverse formula for random legs. The equirectangular
+# engine is also checked against the haversine for the leg lengths of its
+# documented error bound. Exits with status 1 if an engine is outside its
+# bound.
+#
+# Usage: python3 benchmarks/distance.py [--legs 100000] [--seed 1]
+
+import argparse
+import os
+import random
+import sys
+import time
+from math import sin, cos, tan, sqrt, atan, atan2, radians, degrees
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.distance import ENGINES
+
+# WGS84 ellipsoid
+WGS84_A = 6378137.0
+WGS84_F = 1 / 298.257223563
+
+# Tabulated WGS84 distances: (lat1, lon1, lat2, lon2, metres)
+REFERENCE = [
+	(0, 0, 1, 0, 110574.389),		# 1 degree of latitude at the equator
+	(89, 0, 90, 0, 111693.864),		# 1 degree of latitude at the pole
+	(0, 0, 0, 1, 111319.491),		# 1 degree of longitude at the equator
+]
+
+# Sphere against ellipsoid, whatever the engine
+SPHERE_BOUND = 0.0065
+
+# Equirectangular against haversine: (longest leg in m, relative bound)
+EQUIRECTANGULAR_BOUNDS = [(1000, 1e-6), (30000, 2e-4)]
+
+def vincenty(lat1, lon1, lat2, lon2):
+	# Vincenty's inverse formula on the WGS84 ellipsoid, in metres
+	a, f = WGS84_A, WGS84_F
+	b = a * (1 - f)
+
+	u1 = atan((1 - f) * tan(radians(lat1)))
+	u2 = atan((1 - f) * tan(radians(lat2)))
+	sin_u1, cos_u1 = sin(u1), cos(u1)
+	sin_u2, cos_u2 = sin(u2), cos(u2)
+
+	l = radians(lon2 - lon1)
+	lam = l
+	for _ in range(200):
+		sin_lam, cos_lam = sin(lam), cos(lam)
+		sin_sigma = sqrt((cos_u2 * sin_lam)**2 + (cos_u1 * sin_u2 - sin_u1 * cos_u2 * cos_lam)**2)
+		if sin_sigma == 0:
+			return 0.0
+		cos_sigma = sin_u1 * sin_u2 + cos_u1 * cos_u2 * cos_lam
+		sigma = atan2(sin_sigma, cos_sigma)
+		sin_alpha = cos_u1 * cos_u2 * sin_lam / sin_sigma
+		cos2_alpha = 1 - sin_alpha**2
+		cos_2sigma_m = cos_sigma - 2 * sin_u1 * sin_u2 / cos2_alpha if cos2_alpha else 0.0
+		c = f / 16 * cos2_alpha * (4 + f * (4 - 3 * cos2_alpha))
+		previous = lam
+		lam = l + (1 - c) * f * sin_alpha * (sigma + c * sin_sigma * (cos_2sigma_m + c * cos_sigma * (-1 + 2 * cos_2sigma_m**2)))
+		if abs(lam - previous) < 1e-12:
+			break
+
+	u_sq = cos2_alpha * (a**2 - b**2) / b**2
+	big_a = 1 + u_sq / 16384 * (4096 + u_sq * (-768 + u_sq * (320 - 175 * u_sq)))
+	big_b = u_sq / 1024 * (256 + u_sq * (-128 + u_sq * (74 - 47 * u_sq)))
+	delta_sigma = big_b * sin_sigma * (cos_2sigma_m + big_b / 4 * (
+		cos_sigma * (-1 + 2 * cos_2sigma_m**2) -
+		big_b / 6 * cos_2sigma_m * (-3 + 4 * sin_sigma**2) * (-3 + 4 * cos_2sigma_m**2)))
+	return b * big_a * (sigma - delta_sigma)
+
+def random_legs(count, longest, seed, max_latitude=85):
+	# Legs up to `longest` metres in random directions below max_latitude
+	rng = random.Random(seed)
+	legs = []
+	for _ in range(count):
+		lat = rng.uniform(-max_latitude, max_latitude)
+		lon = rng.uniform(-180, 180)
+		length = rng.uniform(1, longest)
+		heading = rng.uniform(0, 6.283185307179586)
+		dlat = degrees(length * cos(heading) / WGS84_A)
+		dlon = degrees(length * sin(heading) / (WGS84_A * cos(radians(lat))))
+		lon2 = (lon + dlon + 180) % 360 - 180
+		legs.append((lat, lon, max(min(lat + dlat, 90), -90), lon2))
+	return legs
+
+def distance(engine, lat1, lon1, lat2, lon2):
+	return engine.distance(engine.terms(lat1, lon1), engine.terms(lat2, lon2))
+
+def relative_error(value, reference):
+	return abs(value - reference) / reference
+
+def check_reference(name, engine, legs):
+	ok = True
+	worst = 0
+	for lat1, lon1, lat2, lon2, metres in REFERENCE:
+		vincenty_error = relative_error(vincenty(lat1, lon1, lat2, lon2), metres)
+		if vincenty_error > 1e-6:
+			print("vincenty off by %.2e at %r" % (vincenty_error, (lat1, lon1, lat2, lon2)))
+			ok = False
+		worst = max(worst, relative_error(distance(engine, lat1, lon1, lat2, lon2), metres))
+
+	for lat1, lon1, lat2, lon2 in legs:
+		worst = max(worst, relative_error(distance(engine, lat1, lon1, lat2, lon2), vincenty(lat1, lon1, lat2, lon2)))
+
+	print("%-16s worst against WGS84 %.3f%%  (bound %.2f%%)" % (name, worst * 100, SPHERE_BOUND * 100))
+	return ok and worst <= SPHERE_BOUND
+
+def check_equirectangular(count, seed):
+	ok = True
+	haversine = ENGINES['haversine']()
+	equirectangular = ENGINES['equirectangular']()
+
+	for longest, bound in EQUIRECTANGULAR_BOUNDS:
+		worst = 0
+		for lat1, lon1, lat2, lon2 in random_legs(count, longest, seed):
+			exact = distance(haversine, lat1, lon1, lat2, lon2)
+			worst = max(worst, relative_error(distance(equirectangular, lat1, lon1, lat2, lon2), exact))
+		print("equirectangular  legs up to %5d m: worst against haversine %.2e  (bound %.0e)" % (longest, worst, bound))
+		ok = ok and worst <= bound
+
+	return ok
+
+def uncached(lat1, lon1, lat2, lon2, radius=6373000):
+	# The Sampler's former distance: radians and cos of both points per call
+	phi1, phi2 = radians(lat1), radians(lat2)
+	dphi = phi2 - phi1
+	dlam = radians(lon2) - radians(lon1)
+	a = sin(dphi / 2)**2 + cos(phi1) * cos(phi2) * sin(dlam / 2)**2
+	return radius * 2 * atan2(sqrt(a), sqrt(1 - a))
+
+def timed(call, legs):
+	start = time.perf_counter()
+	for leg in legs:
+		call(*leg)
+	return (time.perf_counter() - start) / len(legs) * 1e9
+
+def benchmark(count, seed):
+	legs = random_legs(count, 100, seed)
+	print("\n%-32s %8s" % ('distance per leg', 'ns'))
+	print("%-32s %8.0f" % ('uncached haversine', timed(uncached, legs)))
+
+	for name, engine_class in sorted(ENGINES.items()):
+		engine = engine_class()
+		terms = [(engine.terms(lat1, lon1), engine.terms(lat2, lon2)) for lat1, lon1, lat2, lon2 in legs]
+		print("%-32s %8.0f" % (name + ' (precomputed terms)', timed(engine.distance, terms)))
+		print("%-32s %8.0f" % (name + ' (terms per leg)', timed(lambda *leg: distance(engine, *leg), legs)))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Check and time the Sampler distance engines')
+	parser.add_argument('--legs', type=int, default=100000, help='random legs per check')
+	parser.add_argument('--seed', type=int, default=1)
+	args = parser.parse_args()
+
+	ok = True
+	legs = random_legs(min(args.legs, 10000), 30000, args.seed)
+	for name, engine_class in sorted(ENGINES.items()):
+		ok = check_reference(name, engine_class(), legs) and ok
+	ok = check_equirectangular(args.legs, args.seed) and ok
+
+	benchmark(args.legs, args.seed)
+
+	print("\nok" if ok else "\nOUT OF BOUNDS")
+	sys.exit(0 if ok else 1)
@@ -0,0 +1,166 @@
+# Epoch alignment of fixes: utils.epochs.EpochAssembler against the blob's
+# "every section filled" rule it replaced
+#
+# Feeds the fix sentences of a synthetic drive, with a share of them lost
+# and repeated as on a noisy serial line, to both. Counts the fixes that mix
+# GGA and RMC of different epochs and the epochs that went out more than
+# once, and prints the assembler's epoch counters. With nothing lost both
+# must produce the same fixes. Then drops a single VTG from the clean
+# stream: no fix may carry a VTG track that differs from its RMC course,
+# i.e. a VTG of another epoch. Last, feeds the clean stream in bursts with
+# a boundary between them, once as sent and once with GSA and VTG ahead of
+# GGA and RMC in every burst: the first must give the same fixes and no
+# out of order bursts, the second no fix with another epoch's VTG.
+#
+# Usage: python3 benchmarks/epochs.py [--rate 10] [--duration 600] [--loss 0.05] [--repeat 0.02]
+
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate
+from utils import decoder
+from utils.epochs import EpochAssembler
+from utils.nmea import GNSS_Blob
+from utils.pipeline import FIX_SENTENCES
+
+def fix_sentences(rate, duration):
+	messages = []
+	for line in generate(rate, duration):
+		msg = decoder.decode(line.decode('ascii').strip(), FIX_SENTENCES)
+		if msg is not None:
+			messages.append(msg)
+	return messages
+
+def noisy(messages, loss, repeat, seed=1):
+	rng = random.Random(seed)
+	result = []
+	for msg in messages:
+		if rng.random() < loss:
+			continue
+		result.append(msg)
+		if rng.random() < repeat:
+			result.append(msg)
+	return result
+
+def filled_blob(messages):
+	# The rule before: a fix whenever every section of the blob is filled
+	blob = GNSS_Blob()
+	fixes = []
+	for msg in messages:
+		{
+			'GGA': blob.add_fix_data,
+			'RMC': blob.add_minimum_transit_data,
+			'GSA': blob.add_DOP,
+			'VTG': blob.add_track_and_ground_speed
+		}[msg.sentence_type](msg)
+		if None not in (blob.fix, blob.transit_data, blob.dop, blob.track_and_speed):
+			fixes.append(blob.get_base_information())
+	return fixes
+
+def epoch_aligned(messages):
+	assembler = EpochAssembler(GNSS_Blob())
+	fixes = []
+	for msg in messages:
+		fix = assembler.add(msg)
+		if fix is not None:
+			fixes.append(fix)
+	fix = assembler.close()
+	if fix is not None:
+		fixes.append(fix)
+	return fixes, assembler.stats()
+
+def bursts(messages, untimed_first=False):
+	# The clean stream split into one burst per epoch
+	result = []
+	for msg in messages:
+		if msg.sentence_type == 'GGA':
+			result.append([])
+		result[-1].append(msg)
+	if untimed_first:
+		result = [sorted(burst, key=lambda msg: msg.sentence_type in ('GGA', 'RMC')) for burst in result]
+	return result
+
+def burst_aligned(bursts):
+	assembler = EpochAssembler(GNSS_Blob())
+	fixes = []
+	for burst in bursts:
+		assembler.boundary()
+		for msg in burst:
+			fix = assembler.add(msg)
+			if fix is not None:
+				fixes.append(fix)
+	fix = assembler.close()
+	if fix is not None:
+		fixes.append(fix)
+	return fixes, assembler.stats()
+
+def without_one(messages, sentence_type, epoch):
+	# messages without the sentence_type of the given epoch
+	seen = 0
+	result = []
+	for msg in messages:
+		if msg.sentence_type == sentence_type:
+			seen += 1
+			if seen == epoch:
+				continue
+		result.append(msg)
+	return result
+
+def course_mismatches(fixes):
+	# Fixes whose VTG track differs from their RMC course
+	return sum(
+		1 for _, full in fixes
+		if full['track_and_speed'] and full['track_and_speed']['true_track'] != full['transit_data']['true_course']
+	)
+
+def check(fixes):
+	mixed = sum(1 for _, full in fixes if full['fix']['timestamp'] != full['transit_data']['timestamp'])
+	epochs = [str(full['transit_data']['timestamp']) for _, full in fixes]
+	return mixed, len(epochs) - len(set(epochs))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare fix assembly rules')
+	parser.add_argument('--rate', type=int, default=10, help='fix rate in Hz')
+	parser.add_argument('--duration', type=float, default=600, help='seconds of synthetic drive')
+	parser.add_argument('--loss', type=float, default=0.05, help='share of sentences lost')
+	parser.add_argument('--repeat', type=float, default=0.02, help='share of sentences repeated')
+	args = parser.parse_args()
+
+	messages = fix_sentences(args.rate, args.duration)
+	epochs = args.rate * int(args.duration)
+
+	same = filled_blob(messages) == epoch_aligned(messages)[0]
+	print("%d epochs, clean stream: %s" % (epochs, 'identical' if same else 'DIFFERENT'))
+
+	dropped, dropped_stats = epoch_aligned(without_one(messages, 'VTG', epochs // 2))
+	mismatches = course_mismatches(dropped)
+	print("one VTG lost: %6d fixes %6d with the VTG track of another epoch" % (len(dropped), mismatches))
+	print("  %r" % dropped_stats)
+
+	in_order, in_order_stats = burst_aligned(bursts(messages))
+	reordered, reordered_stats = burst_aligned(bursts(messages, untimed_first=True))
+	reordered_mismatches = course_mismatches(reordered)
+	print("bursts as sent: %s, %d out of order" % ('identical' if in_order == epoch_aligned(messages)[0] else 'DIFFERENT', in_order_stats['out_of_order']))
+	print("GSA/VTG first:  %6d fixes %6d with the VTG track of another epoch" % (len(reordered), reordered_mismatches))
+	print("  %r" % reordered_stats)
+
+	messages = noisy(messages, args.loss, args.repeat)
+	print("%.0f%% lost, %.0f%% repeated:" % (args.loss * 100, args.repeat * 100))
+	before = filled_blob(messages)
+	after, stats = epoch_aligned(messages)
+	for name, fixes in (('filled blob', before), ('epoch aligned', after)):
+		mixed, repeated = check(fixes)
+		print("  %-14s %6d fixes %6d mixing epochs %6d epochs repeated" % (name, len(fixes), mixed, repeated))
+	print("  %r" % stats)
+
+	ok = (
+		same and mismatches == 0 and check(after) == (0, 0)
+		and in_order == epoch_aligned(fix_sentences(args.rate, args.duration))[0] and in_order_stats['out_of_order'] == 0
+		and reordered_mismatches == 0 and check(reordered) == (0, 0)
+	)
+	print("\nok" if ok else "\nMISMATCH")
+	sys.exit(0 if ok else 1)
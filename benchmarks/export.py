@@ -0,0 +1,97 @@
+# Throughput of the raw archive exporter (utils/export.py)
+#
+# Writes a synthetic drive as several columnar archives, segment archives
+# and a shelve, as if pulled off a small fleet, and exports them to CSV,
+# GPX and columnar with 1, 2 and 4 worker processes. Checks the output is
+# complete, in timestamp order and the same for every worker count.
+# Scaling is bounded by the cores of the machine it runs on.
+#
+# Usage: python3 benchmarks/export.py [--hours 2] [--devices 4]
+
+import argparse
+import csv
+import os
+import shelve
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.columnar import raw_records
+from utils.archive import RawArchiveWriter
+from utils.columnar import ColumnarArchive, write_archive
+from utils.export import export
+
+def fleet(directory, records, devices):
+	# Each device drives the same route a few seconds apart, so the merge
+	# has to interleave every file
+	paths = []
+	for device in range(devices):
+		items = [(timestamp + device * 3, record) for timestamp, record in records]
+		path = os.path.join(directory, 'device%d' % device)
+		os.mkdir(path)
+		if device % 3 == 0:
+			write_archive(items, os.path.join(path, 'raw%d.col' % items[0][0]))
+		elif device % 3 == 1:
+			with RawArchiveWriter(os.path.join(path, 'raw%d' % items[0][0])) as writer:
+				for timestamp, record in items:
+					writer.append(timestamp, record)
+		else:
+			with shelve.open(os.path.join(path, 'raw%d.db' % items[0][0])) as raw:
+				for timestamp, record in items:
+					raw[str(timestamp)] = record
+		paths.append(path)
+	return paths
+
+def output_rows(path):
+	if path.endswith('.csv'):
+		with open(path, newline='') as f:
+			return [int(row[0]) for row in list(csv.reader(f))[1:]]
+	if path.endswith('.col'):
+		with ColumnarArchive(path) as archive:
+			return [timestamp for timestamp, _ in archive]
+	with open(path) as f:
+		return [None] * f.read().count('<trkpt ')
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Measure the raw archive exporter')
+	parser.add_argument('--hours', type=float, default=2, help='hours of 1 Hz drive per device')
+	parser.add_argument('--devices', type=int, default=4)
+	args = parser.parse_args()
+
+	records = raw_records(args.hours)
+	directory = tempfile.mkdtemp()
+	ok = True
+	try:
+		inputs = fleet(directory, records, args.devices)
+		expected = len(records) * args.devices
+		print("%d devices, %d records, %d cores" % (args.devices, expected, os.cpu_count()))
+
+		for extension in ('.csv', '.gpx', '.col'):
+			reference = None
+			for workers in (1, 2, 4):
+				output = os.path.join(directory, 'export%d%s' % (workers, extension))
+				start = time.perf_counter()
+				count = export(inputs, output, workers=workers)
+				elapsed = time.perf_counter() - start
+
+				rows = output_rows(output)
+				complete = count == expected and len(rows) == expected
+				ordered = rows == sorted(rows) if rows[:1] != [None] else True
+				with open(output, 'rb') as f:
+					content = f.read()
+				same = reference is None or content == reference
+				reference = content if reference is None else reference
+
+				check = complete and ordered and same
+				ok = ok and check
+				print("%-4s %d workers %8.2f s %9.0f records/s  %s" % (
+					extension[1:], workers, elapsed, count / elapsed, 'ok' if check else 'MISMATCH'
+				))
+
+		print("\nok" if ok else "\nMISMATCH")
+		sys.exit(0 if ok else 1)
+	finally:
+		shutil.rmtree(directory)
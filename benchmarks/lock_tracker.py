@@ -0,0 +1,136 @@
+# GSV lock tracking: utils.satellites.LockTracker against GNSS_Blob
+#
+# Times the work per GSV page of the incremental LockTracker against the
+# walk over a page table that GNSS_Blob used to do (BlobWalk below),
+# over the GSV pages of a synthetic drive. Then feeds both the pages of two
+# constellations interleaved page by page, as some receivers send them, and
+# checks which constellations each finds complete.
+#
+# Usage: python3 benchmarks/lock_tracker.py [--duration 3600]
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate
+from utils import decoder
+from utils.nmea import MAX_SATELLITE_PAGES
+from utils.satellites import LockTracker
+
+class BlobWalk:
+	# GNSS_Blob's former add_satellite/check_satellites: pages keyed by
+	# number alone, the whole table checked after every page
+
+	def __init__(self):
+		self.satellites = {}
+		self.locked = False
+
+	def add_satellite(self, msg):
+		self.locked = False
+		if msg.msg_num in self.satellites or len(self.satellites) < MAX_SATELLITE_PAGES:
+			self.satellites[msg.msg_num] = msg
+
+	def check_satellites(self):
+		self.locked = True
+		num_messages = -1
+		msg_num_sum = 0
+
+		for sat_num, sat_info in self.satellites.items():
+			try:
+				if int(sat_num) != int(sat_info.msg_num):
+					self.locked = False
+
+				if num_messages < 0:
+					num_messages = int(sat_info.num_messages)
+				elif num_messages != int(sat_info.num_messages):
+					self.locked = False
+
+				msg_num_sum += int(sat_info.msg_num)
+			except Exception:
+				self.locked = False
+				break
+
+		if msg_num_sum != sum(range(num_messages+1)) and len(self.satellites) != num_messages:
+			self.locked = False
+
+		return self.locked
+
+def gsv_pages(duration):
+	pages = []
+	for line in generate(1, duration):
+		msg = decoder.decode(line.decode('ascii').strip(), ('GSV',))
+		if msg is not None:
+			pages.append(msg)
+	return pages
+
+def blob_walk(pages):
+	blob = BlobWalk()
+	locks = 0
+	for msg in pages:
+		blob.add_satellite(msg)
+		locks += blob.check_satellites()
+	return locks
+
+def tracker(pages):
+	lock = LockTracker()
+	sets = 0
+	for msg in pages:
+		sets += lock.add(msg) is not None
+	return sets
+
+def interleaved(pages):
+	# GP and GL pages of each second alternated
+	by_talker = {'GP': [], 'GL': []}
+	for msg in pages:
+		if msg.talker in by_talker:
+			by_talker[msg.talker].append(msg)
+	mixed = []
+	for gp, gl in zip(by_talker['GP'], by_talker['GL']):
+		mixed += [gp, gl]
+	return mixed
+
+def timed(call, pages, repeat=5):
+	best = None
+	for _ in range(repeat):
+		start = time.perf_counter()
+		call(pages)
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+	return best / len(pages) * 1e6
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare GSV lock tracking')
+	parser.add_argument('--duration', type=float, default=3600, help='seconds of synthetic drive')
+	args = parser.parse_args()
+
+	pages = gsv_pages(args.duration)
+	print("%d GSV pages" % len(pages))
+	print("GNSS_Blob walk %6.2f us/page" % timed(blob_walk, pages))
+	print("LockTracker    %6.2f us/page" % timed(tracker, pages))
+
+	# The blob keys pages by number alone, so interleaved constellations
+	# overwrite each other and their page counts disagree
+	mixed = interleaved(pages[:200])
+	blob = BlobWalk()
+	blob_locked = False
+	for msg in mixed:
+		blob.add_satellite(msg)
+		blob_locked = blob.check_satellites() or blob_locked
+	blob_talkers = sorted(set(msg.talker for msg in blob.satellites.values()))
+
+	lock = LockTracker()
+	for msg in mixed:
+		lock.add(msg)
+
+	print("\ninterleaved GP/GL pages")
+	print("GNSS_Blob      locked %-5s table mixes pages of %s" % (blob_locked, ', '.join(blob_talkers)))
+	print("LockTracker    locked %-5s tables for %s, %d broken sequences" % (lock.locked, ', '.join(sorted(lock.tables)), lock.broken_sequences))
+	print(json.dumps(lock.quality(), indent=1, sort_keys=True))
+
+	ok = lock.locked and sorted(lock.tables) == ['GL', 'GP'] and lock.broken_sequences == 0
+	print("\nok" if ok else "\nMISMATCH")
+	sys.exit(0 if ok else 1)
@@ -0,0 +1,126 @@
+# Logging cost on the producing thread: a plain FileHandler as set up by
+# logging.basicConfig against utils.logs.LogPipeline
+#
+# Logs what the client logs per point ("Sending data to AWS" and a decode
+# error for a share of the lines) from the calling thread and reports the
+# time spent in the logging calls, the bytes that reached the log files and
+# the number of write() calls. LogPipeline runs twice: rate limited as in
+# the client, and with the rate limit off and a queue large enough for the
+# whole run, where its files must hold every record, rotated into gzipped
+# files of at most max_bytes.
+#
+# Usage: python3 benchmarks/logs.py [--records 100000] [--errors 0.05] [--max-bytes 262144]
+
+import argparse
+import glob
+import gzip
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.logs import LOG_FORMAT, LogPipeline
+
+class CountingFile:
+	# Counts write() calls going to the underlying file
+
+	def __init__(self, stream):
+		self._stream = stream
+		self.writes = 0
+
+	def write(self, data):
+		self.writes += 1
+		return self._stream.write(data)
+
+	def __getattr__(self, name):
+		return getattr(self._stream, name)
+
+def produce(records, errors):
+	# The per point logging of the client
+	error_every = int(1 / errors) if errors else 0
+	start = time.perf_counter()
+	for i in range(records):
+		logging.info('Sending data to AWS')
+		if error_every and i % error_every == 0:
+			logging.error("An exception of type ChecksumError occurred. Arguments:\n('bad checksum',)")
+	return time.perf_counter() - start
+
+def reset_root():
+	root = logging.getLogger()
+	for handler in list(root.handlers):
+		root.removeHandler(handler)
+		handler.close()
+
+def plain(directory, records, errors):
+	path = os.path.join(directory, 'plain.log')
+	handler = logging.FileHandler(path, 'w')
+	handler.setFormatter(logging.Formatter(LOG_FORMAT))
+	handler.stream = CountingFile(handler.stream)
+	root = logging.getLogger()
+	root.addHandler(handler)
+	root.setLevel(logging.DEBUG)
+
+	elapsed = produce(records, errors)
+	writes = handler.stream.writes
+	reset_root()
+	return elapsed, os.path.getsize(path), writes
+
+def pipelined(directory, records, errors, max_bytes, burst, queue_size):
+	path = os.path.join(directory, 'tracker%d.log' % burst)
+	logs = LogPipeline(path, max_bytes=max_bytes, backup_count=1000, burst=burst, queue_size=queue_size).start()
+
+	elapsed = produce(records, errors)
+	logs.stop()
+	stats = logs.stats()
+
+	files = sorted(glob.glob(path + '.*.gz'))
+	lines = []
+	sizes = []
+	for name in files:
+		with gzip.open(name, 'rt') as f:
+			data = f.read()
+		sizes.append(len(data))
+		lines.extend(data.splitlines())
+	with open(path) as f:
+		lines.extend(f.read().splitlines())
+	size = sum(os.path.getsize(name) for name in files) + os.path.getsize(path)
+	return elapsed, size, stats, files, sizes, lines
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare logging set-ups')
+	parser.add_argument('--records', type=int, default=100000, help='points logged')
+	parser.add_argument('--errors', type=float, default=0.05, help='share of points with a decode error')
+	parser.add_argument('--max-bytes', type=int, default=256 * 1024, help='log file size cap')
+	args = parser.parse_args()
+
+	with tempfile.TemporaryDirectory() as directory:
+		elapsed, size, writes = plain(directory, args.records, args.errors)
+		print("%-12s %8.2f us/point %10d bytes %8d writes" % ('basicConfig', elapsed / args.records * 1e6, size, writes))
+
+		results = {}
+		for name, burst, queue_size in (('LogPipeline', 10, 10000), ('no limit', 2 * args.records, 2 * args.records)):
+			elapsed, size, stats, files, sizes, lines = results[name] = pipelined(directory, args.records, args.errors, args.max_bytes, burst, queue_size)
+			print("%-12s %8.2f us/point %10d bytes %8d writes, %d files" % (name, elapsed / args.records * 1e6, size, stats['writes'], len(files) + 1))
+			print("  %r" % stats)
+
+	error_every = int(1 / args.errors) if args.errors else 0
+	expected = args.records + (len(range(0, args.records, error_every)) if error_every else 0)
+
+	lines = results['LogPipeline'][5]
+	summaries = sum(1 for line in lines if 'suppressed' in line)
+	stats, files, sizes, lines = results['no limit'][2:]
+	records = sum(1 for line in lines if ' - root - ' in line)
+	print("\nrate limited: %d summaries; no limit: %d of %d records written, largest file %d bytes" % (summaries, records, expected, max(sizes or [0])))
+
+	ok = (
+		summaries > 0 and
+		stats['dropped'] == 0 and
+		records == expected and
+		len(files) > 0 and
+		all(size <= args.max_bytes + 64 * 1024 for size in sizes)
+	)
+	print("\nok" if ok else "\nMISMATCH")
+	sys.exit(0 if ok else 1)
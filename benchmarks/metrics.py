@@ -0,0 +1,77 @@
+# Overhead of the utils.metrics instrumentation
+#
+# Runs a synthetic drive end to end through utils.pipeline.Pipeline with
+# metrics disabled and enabled and reports the cost per NMEA line, then
+# prints the per-stage stats the enabled run recorded. Also checks the
+# histogram percentiles against exact ones over random latencies.
+#
+# Usage: python3 benchmarks/metrics.py [--rate 1] [--duration 3600] [--repeat 3]
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate
+from utils.metrics import Histogram, metrics
+from utils.monitor import Sampler
+from utils.pipeline import Pipeline
+
+def run(lines):
+	pipeline = Pipeline(Sampler(update_callback=lambda point: None))
+	start = time.perf_counter()
+	for line in lines:
+		pipeline.process_line(line)
+	return time.perf_counter() - start
+
+def best_of(repeat, lines, enabled):
+	metrics.enable(enabled)
+	times = []
+	for _ in range(repeat):
+		metrics.reset()
+		times.append(run(lines))
+	return min(times)
+
+def check_histogram(count, seed):
+	# Percentiles must be within a bucket (12.5%) of the exact values
+	rng = random.Random(seed)
+	values = sorted(int(rng.lognormvariate(5, 2)) for _ in range(count))
+	histogram = Histogram()
+	for value in values:
+		histogram.record(value)
+
+	ok = True
+	for p in (0.5, 0.9, 0.99, 0.999):
+		exact = values[min(count - 1, int(count * p + 0.5) - 1)]
+		reported = histogram.percentile(p)
+		within = exact <= reported <= max(exact * 1.125, exact + 1)
+		ok = ok and within
+		print("p%-5g exact %8d us  histogram %8d us  %s" % (p * 100, exact, reported, 'ok' if within else 'OFF'))
+	return ok
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Measure the metrics overhead')
+	parser.add_argument('--rate', type=int, default=1, help='fix rate in Hz')
+	parser.add_argument('--duration', type=float, default=3600, help='seconds of synthetic drive')
+	parser.add_argument('--repeat', type=int, default=3)
+	args = parser.parse_args()
+
+	lines = [line.decode('ascii').strip() for line in generate(args.rate, args.duration)]
+
+	disabled = best_of(args.repeat, lines, False)
+	enabled = best_of(args.repeat, lines, True)
+	per_line = 1e6 / len(lines)
+	print("%d lines" % len(lines))
+	print("metrics disabled %7.2f us/line" % (disabled * per_line))
+	print("metrics enabled  %7.2f us/line  (+%.2f us, %+.1f%%)" % (enabled * per_line, (enabled - disabled) * per_line, (enabled / disabled - 1) * 100))
+
+	print("\nstages of the enabled run:")
+	print(json.dumps(metrics.snapshot()['latency_us'], indent=1, sort_keys=True))
+
+	print()
+	ok = check_histogram(100000, 1)
+	sys.exit(0 if ok else 1)
@@ -0,0 +1,111 @@
+# Time and coordinate conversion of utils/nmea.py against the originals
+#
+# Property checks over random inputs: get_epoch_time must equal the
+# original strptime conversion evaluated in UTC (and calendar.timegm) in
+# any local time zone, convert_lat_long must return exactly what the
+# original string based conversion returned. Then times both against the
+# originals. Exits with status 1 on any mismatch.
+#
+# Usage: python3 benchmarks/nmea_conversion.py [--samples 200000] [--seed 1]
+
+import argparse
+import calendar
+import datetime
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.nmea import convert_lat_long, get_epoch_time
+
+# Local time zones to run the epoch check in
+TIME_ZONES = ['UTC', 'Europe/London', 'America/Los_Angeles', 'Asia/Kolkata']
+
+def original_epoch_time(t, d):
+	# get_epoch_time before the change, interprets the time in local time
+	return int(datetime.datetime.strptime(
+		str(d.day) + "-" + str(d.month) + "-" + str(d.year) + " " + str(t.hour) + ":" + str(t.minute) + ":" + str(t.second), '%d-%m-%Y %H:%M:%S').timestamp())
+
+def original_lat_long(value, dir):
+	# convert_lat_long before the change
+	deg, dec = value.split('.')
+	precision = len(dec)
+	mins = deg[-2:] + '.' + dec
+	comp = float(mins) / 60 + float(deg[:-2])
+	comp = comp if (dir == 'E' or dir == 'N') else (comp / -1)
+	return round(float(str(comp)), precision)
+
+def set_time_zone(name):
+	os.environ['TZ'] = name
+	time.tzset()
+
+def random_times(count, rng):
+	samples = []
+	for _ in range(count):
+		d = datetime.date(rng.randrange(1980, 2069), rng.randrange(1, 13), rng.randrange(1, 29))
+		t = datetime.time(rng.randrange(24), rng.randrange(60), rng.randrange(60), rng.choice((0, rng.randrange(1000000))))
+		samples.append((t, d))
+	return samples
+
+def random_coordinates(count, rng):
+	samples = []
+	for _ in range(count):
+		digits = rng.choice((2, 3))
+		decimals = rng.choice((2, 3, 4, 5, 6))
+		degrees = rng.randrange(90 if digits == 2 else 180)
+		value = '%0*d%02d.%0*d' % (digits, degrees, rng.randrange(60), decimals, rng.randrange(10 ** decimals))
+		samples.append((value, rng.choice('NSEW')))
+	return samples
+
+def check_epoch_time(samples):
+	ok = True
+	for zone in TIME_ZONES:
+		set_time_zone(zone)
+		mismatches = sum(1 for t, d in samples if get_epoch_time(t, d) != calendar.timegm((d.year, d.month, d.day, t.hour, t.minute, t.second)))
+		print("get_epoch_time   TZ=%-20s %d mismatches against calendar.timegm" % (zone, mismatches))
+		ok = ok and mismatches == 0
+
+	# The original only agreed when the local time zone was UTC
+	set_time_zone('UTC')
+	mismatches = sum(1 for t, d in samples if get_epoch_time(t, d) != original_epoch_time(t, d))
+	print("get_epoch_time   TZ=%-20s %d mismatches against the original" % ('UTC', mismatches))
+	return ok and mismatches == 0
+
+def check_lat_long(samples):
+	mismatches = [(value, dir) for value, dir in samples if convert_lat_long(value, dir) != original_lat_long(value, dir)]
+	print("convert_lat_long %d mismatches against the original" % len(mismatches))
+	for value, dir in mismatches[:5]:
+		print("    %s %s: %r != %r" % (value, dir, convert_lat_long(value, dir), original_lat_long(value, dir)))
+	return not mismatches
+
+def timed(call, samples):
+	start = time.perf_counter()
+	for sample in samples:
+		call(*sample)
+	return (time.perf_counter() - start) / len(samples) * 1e9
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Check and time the NMEA conversions')
+	parser.add_argument('--samples', type=int, default=200000, help='random inputs per check')
+	parser.add_argument('--seed', type=int, default=1)
+	args = parser.parse_args()
+
+	rng = random.Random(args.seed)
+	times = random_times(args.samples, rng)
+	coordinates = random_coordinates(args.samples, rng)
+
+	ok = check_epoch_time(times[:20000])
+	ok = check_lat_long(coordinates) and ok
+
+	# A drive has one date, which is what the midnight cache is for
+	drive = [(t, times[0][1]) for t, _ in times]
+
+	print("\n%-36s %8s %8s" % ('per call', 'ns', 'before'))
+	print("%-36s %8.0f %8.0f" % ('get_epoch_time (one date)', timed(get_epoch_time, drive), timed(original_epoch_time, drive)))
+	print("%-36s %8.0f %8.0f" % ('get_epoch_time (random dates)', timed(get_epoch_time, times), timed(original_epoch_time, times)))
+	print("%-36s %8.0f %8.0f" % ('convert_lat_long', timed(convert_lat_long, coordinates), timed(original_lat_long, coordinates)))
+
+	print("\nok" if ok else "\nMISMATCH")
+	sys.exit(0 if ok else 1)
@@ -0,0 +1,74 @@
+# Throughput of utils.decoder against pynmea2 on a recorded NMEA stream
+#
+# Usage: python3 benchmarks/nmea_decode.py <nmea log> [repeats]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pynmea2
+
+from utils import decoder
+
+def load_lines(path):
+	with open(path, 'rb') as f:
+		lines = [l.decode('utf-8', 'replace').strip() for l in f]
+	return [l for l in lines if len(l) > 6]
+
+def run(name, parse, lines, repeats):
+	errors = 0
+	start = time.perf_counter()
+	for _ in range(repeats):
+		for line in lines:
+			try:
+				parse(line)
+			except Exception:
+				errors += 1
+	elapsed = time.perf_counter() - start
+	count = len(lines) * repeats
+	print("%-28s %10.0f lines/s  %7.2f us/line  %d errors" % (name, count / elapsed, elapsed / count * 1e6, errors))
+	return elapsed
+
+def pynmea2_with_fields(line):
+	# pynmea2 converts lazily, GNSS_Blob then reads every field
+	msg = pynmea2.parse(line)
+	cls = decoder.SENTENCES.get(msg.sentence_type)
+	if cls is not None:
+		for key in cls._fields[1:]:
+			getattr(msg, key, None)
+	return msg
+
+def check_equivalence(lines):
+	# The fast path must produce the same values pynmea2 does
+	mismatches = 0
+	for line in lines:
+		try:
+			fast = decoder.decode(line)
+			slow = pynmea2.parse(line)
+		except Exception:
+			continue
+		if fast is None:
+			continue
+		for key, value in fast.items():
+			if getattr(slow, key, '') != value:
+				mismatches += 1
+				print("Mismatch in %s: %s %r != %r" % (line, key, value, getattr(slow, key, '')))
+				break
+	return mismatches
+
+if __name__ == '__main__':
+	lines = load_lines(sys.argv[1])
+	repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+	print("%d lines x %d repeats" % (len(lines), repeats))
+
+	mismatches = check_equivalence(lines)
+	print("%d sentences differ from pynmea2" % mismatches)
+
+	run('pynmea2.parse', pynmea2.parse, lines, repeats)
+	slow = run('pynmea2.parse + fields', pynmea2_with_fields, lines, repeats)
+	fast = run('decoder.parse', decoder.parse, lines, repeats)
+	run('decoder.parse (GSV only)', lambda l: decoder.parse(l, ('GSV',)), lines, repeats)
+	run('decoder.parse (fix only)', lambda l: decoder.parse(l, ('GGA', 'VTG', 'RMC', 'GSA')), lines, repeats)
+	print("speed-up %.1fx" % (slow / fast))
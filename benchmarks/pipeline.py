@@ -0,0 +1,198 @@
+# Per-stage and end-to-end benchmark of the start.py pipeline
+#
+# Drives synthetic NMEA streams at several fix rates through each stage on
+# its own (decode, lock and epoch assembly, get_base_information, Sampler, raw
+# persistence) and through utils.pipeline.Pipeline end to end. Reports
+# throughput, p50/p99 latency per call and peak traced memory.
+#
+# Usage: python3 benchmarks/pipeline.py [--rates 1 5 10 20] [--duration 600] [--output results.json]
+
+import argparse
+import copy
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate
+from utils import decoder
+from utils.archive import RawArchiveWriter
+from utils.monitor import Sampler
+from utils.nmea import GNSS_Blob
+from utils.pipeline import Pipeline
+
+def percentile(sorted_values, p):
+	if not sorted_values:
+		return 0
+	return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p))]
+
+def measure(stage, rate, items, make_call, memory=True):
+	# Time call(item) for every item, then repeat on a fresh call under
+	# tracemalloc for the peak memory so tracing does not skew the latencies.
+	# make_call() returns the call with its own fresh state for each pass.
+	timer = time.perf_counter_ns
+	latencies = []
+	append = latencies.append
+
+	call = make_call()
+	start = timer()
+	for item in items:
+		t0 = timer()
+		call(item)
+		append(timer() - t0)
+	elapsed = (timer() - start) / 1e9
+
+	peak = None
+	if memory:
+		call = make_call()
+		tracemalloc.start()
+		for item in items:
+			call(item)
+		peak = tracemalloc.get_traced_memory()[1] / 1024
+		tracemalloc.stop()
+
+	latencies.sort()
+	return {
+		'stage': stage,
+		'rate_hz': rate,
+		'items': len(items),
+		'throughput_per_s': len(items) / elapsed if elapsed else None,
+		'p50_us': percentile(latencies, 0.50) / 1000,
+		'p99_us': percentile(latencies, 0.99) / 1000,
+		'peak_kib': peak
+	}
+
+def epochs(lines):
+	# Decoded fix sentence groups, one per epoch, with the GSV set in force
+	gsv = []
+	group = None
+	for line in lines:
+		if not line:
+			continue
+		msg = decoder.decode(line)
+		if msg is None:
+			continue
+		if msg.sentence_type == 'GSV':
+			if msg.msg_num == '1' and msg.talker == 'GP':
+				gsv = []
+			if msg.talker == 'GP':
+				gsv.append(msg)
+		elif msg.sentence_type == 'GGA':
+			group = list(gsv) + [msg]
+		elif group is not None:
+			group.append(msg)
+			if msg.sentence_type == 'VTG':
+				yield group
+				group = None
+
+def populated_blob(group):
+	# The blob of one epoch as EpochAssembler hands it over
+	blob = GNSS_Blob()
+	blob.set_satellites([msg for msg in group if msg.sentence_type == 'GSV'])
+	for msg in group:
+		if msg.sentence_type == 'GGA':
+			blob.add_fix_data(msg)
+		elif msg.sentence_type == 'RMC':
+			blob.add_minimum_transit_data(msg)
+		elif msg.sentence_type == 'GSA':
+			blob.add_DOP(msg)
+		elif msg.sentence_type == 'VTG':
+			blob.add_track_and_ground_speed(msg)
+	return blob
+
+def assembler():
+	# Pipeline.assemble: GSV pages into the LockTracker, fix sentences into
+	# the EpochAssembler once locked, including emitting each epoch's fix
+	return Pipeline(Sampler(update_callback=lambda point: None)).assemble
+
+def run_rate(rate, duration, workdir, memory):
+	results = []
+	lines = [line.decode('ascii').strip() for line in generate(rate, duration)]
+	sentences = [line for line in lines if line]
+
+	results.append(measure('decode', rate, sentences, lambda: decoder.parse, memory))
+	try:
+		import pynmea2
+		results.append(measure('decode_pynmea2', rate, sentences, lambda: pynmea2.parse, memory))
+	except ImportError:
+		pass
+
+	groups = list(epochs(lines))
+	msgs = [msg for group in groups for msg in group]
+	results.append(measure('assemble', rate, msgs, assembler, memory))
+
+	# get_base_information resets the blob, so every pass gets its own copies
+	populated = [populated_blob(group) for group in groups]
+	fixes = [copy.deepcopy(blob).get_base_information() for blob in populated]
+	def base_information():
+		blobs = [copy.deepcopy(blob) for blob in populated]
+		return lambda i: blobs[i].get_base_information()
+	results.append(measure('base_information', rate, list(range(len(populated))), base_information, memory))
+
+	def sampler():
+		return Sampler(update_callback=lambda point: None).process_update
+	results.append(measure('sampler', rate, [dict(minimal) for minimal, _ in fixes], sampler, memory))
+
+	archives = []
+	def raw_persist():
+		archive = RawArchiveWriter(os.path.join(workdir, 'raw%g_%d' % (rate, len(archives))))
+		archives.append(archive)
+		return lambda fix: archive.append(fix[0].get('timestamp'), fix[1])
+	results.append(measure('raw_persist', rate, fixes, raw_persist, memory))
+
+	emitted = []
+	def end_to_end():
+		del emitted[:]
+		archive = RawArchiveWriter(os.path.join(workdir, 'e2e%g_%d' % (rate, len(archives))))
+		archives.append(archive)
+		return Pipeline(Sampler(update_callback=emitted.append), archive).process_line
+	result = measure('end_to_end', rate, lines, end_to_end, memory)
+	result['fixes'] = len(fixes)
+	result['points_emitted'] = len(emitted)
+	results.append(result)
+
+	for archive in archives:
+		archive.close()
+
+	return results
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Benchmark the NMEA -> Sampler pipeline')
+	parser.add_argument('--rates', type=float, nargs='+', default=[1, 5, 10, 20])
+	parser.add_argument('--duration', type=float, default=600, help='seconds of drive per rate')
+	parser.add_argument('--output', default=None, help='write machine readable results to this JSON file')
+	parser.add_argument('--no-memory', action='store_true', help='skip the tracemalloc pass')
+	args = parser.parse_args()
+
+	workdir = tempfile.mkdtemp(prefix='omega-bench-')
+	try:
+		results = []
+		for rate in args.rates:
+			for result in run_rate(rate, args.duration, workdir, not args.no_memory):
+				results.append(result)
+				print("%5g Hz %-18s %8d items %12.0f /s  p50 %8.1f us  p99 %8.1f us  peak %s KiB" % (
+					rate,
+					result['stage'],
+					result['items'],
+					result['throughput_per_s'] or 0,
+					result['p50_us'],
+					result['p99_us'],
+					'-' if result['peak_kib'] is None else '%.0f' % result['peak_kib']
+				))
+	finally:
+		shutil.rmtree(workdir)
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump({
+				'python': platform.python_version(),
+				'machine': platform.machine(),
+				'duration_s': args.duration,
+				'results': results
+			}, f, indent=1)
@@ -0,0 +1,66 @@
+# Sampler.process_batch against the streaming Sampler.process_update
+#
+# Runs the fixes of a synthetic drive through both paths with both sampling
+# strategy, checks they emit exactly the same points and reports the time per
+# fix of each.
+#
+# Usage: python3 benchmarks/sampler_batch.py [--duration 36000]
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate
+from utils.monitor import Sampler
+from utils.pipeline import Pipeline
+
+class FixRecorder:
+	# Stands in for the Sampler to collect the fixes the pipeline assembles
+	def __init__(self):
+		self.fixes = []
+
+	def process_update(self, minimal):
+		self.fixes.append(minimal)
+
+def recorded_fixes(duration):
+	recorder = FixRecorder()
+	pipeline = Pipeline(recorder)
+	for line in generate(1, duration):
+		pipeline.process_line(line.decode('ascii').strip())
+	return recorder.fixes
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare batch and streaming Sampler')
+	parser.add_argument('--duration', type=float, default=36000, help='seconds of synthetic drive')
+	args = parser.parse_args()
+
+	fixes = recorded_fixes(args.duration)
+	print("%d fixes" % len(fixes))
+	arrays = {key: [fix[key] for fix in fixes] for key in ('timestamp', 'latitude', 'longitude', 'speed', 'course', 'altitude', 'status')}
+
+	# process_batch imports NumPy on first use, keep that out of the timing
+	import numpy
+
+	identical = True
+	for strategy in ('distance', 'dead_reckoning'):
+		streamed = []
+		sampler = Sampler(update_callback=streamed.append, strategy=strategy)
+		start = time.perf_counter()
+		for fix in fixes:
+			sampler.process_update(dict(fix))
+		stream_time = time.perf_counter() - start
+
+		start = time.perf_counter()
+		emitted = Sampler(strategy=strategy).process_batch(arrays)
+		batch_time = time.perf_counter() - start
+
+		same = [point['t'] for point in streamed] == [fixes[i]['timestamp'] for i in emitted]
+		identical = identical and same
+		print(strategy)
+		print("  streaming %7.2f us/fix, %d points" % (stream_time / len(fixes) * 1e6, len(streamed)))
+		print("  batch     %7.2f us/fix, %d points" % (batch_time / len(fixes) * 1e6, len(emitted)))
+		print("  identical" if same else "  DIFFERENT")
+	sys.exit(0 if identical else 1)
@@ -0,0 +1,138 @@
+# Serial input under pipeline stalls: line by line reads against BulkSerialSource
+#
+# Feeds a synthetic 10 Hz NMEA stream in real time into a simulated UART
+# whose driver buffer drops bytes once full, as the Omega's does. The
+# consumer runs the pipeline and stalls every few seconds, as a slow SD card
+# write would. Reading line by line from the port loses data during the
+# stalls; the bulk reader keeps draining into its ring. Reports lines and
+# fixes received, bytes lost in the UART, ring overruns and framing errors.
+#
+# Usage: python3 benchmarks/serial_reader.py [--duration 20] [--stall 2] [--every 3] [--ring 65536]
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate
+from utils.pipeline import Pipeline
+from utils.serial_reader import BulkSerialSource
+
+class SimulatedUART:
+	# The serial.Serial calls the sources use, over a driver buffer of
+	# `buffer` bytes that drops whatever arrives while it is full
+
+	def __init__(self, buffer=4096, timeout=0.1):
+		self._data = bytearray()
+		self._buffer = buffer
+		self._timeout = timeout
+		self._changed = threading.Condition()
+		self.lost = 0
+		self.closed = False
+
+	def feed(self, data):
+		with self._changed:
+			room = self._buffer - len(self._data)
+			self.lost += max(0, len(data) - room)
+			self._data += data[:room]
+			self._changed.notify_all()
+
+	@property
+	def in_waiting(self):
+		return len(self._data)
+
+	def read(self, size=1):
+		with self._changed:
+			if not self._data:
+				self._changed.wait(self._timeout)
+			data = bytes(self._data[:size])
+			del self._data[:size]
+			return data
+
+	def readline(self):
+		deadline = time.monotonic() + self._timeout
+		with self._changed:
+			while b'\n' not in self._data and time.monotonic() < deadline:
+				self._changed.wait(deadline - time.monotonic())
+			end = self._data.find(b'\n') + 1 or len(self._data)
+			line = bytes(self._data[:end])
+			del self._data[:end]
+			return line
+
+	def close(self):
+		self.closed = True
+
+class FixCounter:
+	def __init__(self):
+		self.fixes = 0
+
+	def process_update(self, minimal):
+		self.fixes += 1
+
+def play(uart, duration, stopped):
+	# Write the stream out in real time, one burst per epoch
+	bursts = []
+	burst = b''
+	for line in generate(10, duration):
+		burst += line
+		# VTG closes every epoch
+		if line[3:6] == b'VTG':
+			bursts.append(burst)
+			burst = b''
+
+	start = time.monotonic()
+	for i, burst in enumerate(bursts):
+		delay = start + i / 10 - time.monotonic()
+		if delay > 0:
+			time.sleep(delay)
+		uart.feed(burst)
+	stopped.set()
+	return sum(burst.count(b'\n') for burst in bursts)
+
+def run(name, make_source, args):
+	uart = SimulatedUART()
+	source = make_source(uart)
+	counter = FixCounter()
+	pipeline = Pipeline(counter)
+
+	stopped = threading.Event()
+	result = {}
+	player = threading.Thread(target=lambda: result.update(sent=play(uart, args.duration, stopped)))
+	player.start()
+
+	lines = 0
+	next_stall = time.monotonic() + args.every
+	while True:
+		line = source.readline()
+		if line:
+			lines += 1
+			pipeline.process_line(line.decode('ascii', 'replace').strip())
+		elif stopped.is_set():
+			break
+		if time.monotonic() >= next_stall:
+			time.sleep(args.stall)
+			next_stall = time.monotonic() + args.every
+
+	player.join()
+	stats = source.stats() if hasattr(source, 'stats') else {}
+	print("%-18s %6d/%d lines %5d fixes  %7d bytes lost in UART  %3d ring overruns  %3d framing errors" % (
+		name, lines, result['sent'], counter.fixes, uart.lost, stats.get('overruns', 0), stats.get('framing_errors', 0)
+	))
+	if hasattr(source, 'close'):
+		source.close()
+	return uart.lost
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare serial readers under pipeline stalls')
+	parser.add_argument('--duration', type=float, default=20, help='seconds of 10 Hz stream')
+	parser.add_argument('--stall', type=float, default=2, help='seconds the consumer stalls')
+	parser.add_argument('--every', type=float, default=3, help='seconds between stalls')
+	parser.add_argument('--ring', type=int, default=64 * 1024, help='BulkSerialSource ring capacity in bytes')
+	args = parser.parse_args()
+
+	run('line by line', lambda uart: uart, args)
+	lost = run('BulkSerialSource', lambda uart: BulkSerialSource(capacity=args.ring, tty=uart), args)
+	sys.exit(0 if lost == 0 else 1)
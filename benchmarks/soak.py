@@ -0,0 +1,180 @@
+# Memory soak test: a long drive without coverage under a memory budget
+#
+# Runs the client's runtime (serial lines -> pipeline -> sampler -> outbox
+# -> publishers, raw archive, logs) over a synthetic drive of --hours,
+# compressed --speedup times, while AWS IoT is unreachable the whole time.
+# Publisher backoffs and batch ages are compressed by the same factor, so
+# the publisher retries as often per simulated hour as it would on the car.
+# The MQTT client stands in for the AWS SDK, including its offline publish
+# queue: with --offline-queue -1 (the old configuration) every failed
+# publish is kept in memory, with 0 (the default now) none is.
+#
+# Every second the usage per component of utils.memory.MemoryBudget, the
+# SDK queue and the process rss are sampled. Fails if a component exceeds
+# its limit or rss grows by more than --rss-growth MiB over the second half
+# of the run.
+#
+# Usage: python3 benchmarks/soak.py [--hours 12] [--speedup 720] [--budget 8] [--offline-queue 0]
+
+import argparse
+import collections
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate
+from utils.archive import RawArchiveWriter
+from utils.aws import MQTT
+from utils.logs import LogPipeline
+from utils.memory import ITEM_BYTES, MemoryBudget
+from utils.metrics import metrics
+from utils.monitor import Sampler
+from utils.outbox import Outbox
+from utils.pipeline import Pipeline
+from utils.publisher import BatchPublisher
+from utils.runtime import AsyncRuntime
+
+MIB = 1024 * 1024
+
+class PacedSource:
+	# The synthetic drive at `speedup` times real time, None at its end
+
+	def __init__(self, hours, speedup, rate=1):
+		self._lines = generate(rate, hours * 3600)
+		self._rate = rate
+		self._speedup = speedup
+		self._start = None
+		self._epochs = 0
+
+	def readline(self):
+		if self._start is None:
+			self._start = time.monotonic()
+		line = next(self._lines, None)
+		if line is None:
+			return None
+		if line[3:6] == b'GGA':
+			self._epochs += 1
+			delay = self._start + self._epochs / self._rate / self._speedup - time.monotonic()
+			if delay > 0:
+				time.sleep(delay)
+		return line
+
+class OfflineClient:
+	# AWSIoTMQTTClient that never has a connection, with the SDK's offline
+	# publish queueing: 0 refuses publishes, -1 keeps all of them, n the
+	# newest n. A queued publish returns False, as the SDK's does.
+
+	def __init__(self, queue_size):
+		self._queue_size = queue_size
+		self.queue = collections.deque()
+		self.queued_bytes = 0
+
+	def publish(self, topic, payload, qos):
+		if self._queue_size == 0:
+			raise ConnectionError('Offline publish queueing disabled')
+		self.queue.append(payload)
+		self.queued_bytes += len(payload)
+		if 0 < self._queue_size < len(self.queue):
+			self.queued_bytes -= len(self.queue.popleft())
+		return False
+
+def monitor(budget, client, outbox, samples, stopped):
+	while not stopped.wait(1):
+		usage = budget.usage()
+		# Offline publishes have no share of the budget, the outbox keeps them
+		usage['mqtt'] = {'used': client.queued_bytes, 'limit': 0}
+		usage['outbox_items'] = {'used': len(outbox), 'limit': None}
+		samples.append((time.monotonic(), usage))
+
+def soak(args, directory):
+	budget = MemoryBudget(args.budget * MIB)
+	speedup = args.speedup
+
+	logs = LogPipeline(os.path.join(directory, 'tracker.log'), queue_size=budget.items('logs')).start()
+	budget.track('logs', lambda: logs.stats()['queued'] * ITEM_BYTES['logs'] + logs.stats()['buffered'])
+
+	mqtt = MQTT(offline_queue=args.offline_queue)
+	client = mqtt.pub_client = OfflineClient(args.offline_queue)
+	mqtt.connected = True
+
+	outbox = Outbox(os.path.join(directory, 'outbox.db'), cache_bytes=budget.limit('outbox'))
+	publishers = [
+		BatchPublisher(
+			outbox,
+			mqtt,
+			max_age=30 / speedup,
+			lease_size=budget.items('publisher') // 2,
+			retry_backoff=(1 / speedup, 60 / speedup)
+		)
+		for i in range(2)
+	]
+	budget.track('publisher', lambda: sum(publisher.leased for publisher in publishers) * ITEM_BYTES['publisher'])
+
+	raw_archive = RawArchiveWriter(os.path.join(directory, 'raw'), flush_bytes=min(16 * 1024, budget.limit('raw_archive')))
+	budget.track('raw_archive', lambda: raw_archive.pending)
+
+	sampler = Sampler(strategy='dead_reckoning', max_interval=5, update_callback=lambda point: runtime.emit(point))
+	pipeline = Pipeline(sampler, raw_archive)
+	runtime = AsyncRuntime(PacedSource(args.hours, speedup), pipeline, outbox, publishers, stats_interval=10, budget=budget)
+
+	samples = []
+	stopped = threading.Event()
+	sampler_thread = threading.Thread(target=monitor, args=(budget, client, outbox, samples, stopped))
+	sampler_thread.start()
+	start = time.monotonic()
+	runtime.run()
+	elapsed = time.monotonic() - start
+	stopped.set()
+	sampler_thread.join()
+
+	raw_archive.close()
+	stats = runtime.stats()
+	outbox.close()
+	logs.stop()
+	return samples, stats, elapsed, start
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Memory soak test over a long offline drive')
+	parser.add_argument('--hours', type=float, default=12, help='hours of 1 Hz drive without coverage')
+	parser.add_argument('--speedup', type=float, default=720, help='simulated seconds per second')
+	parser.add_argument('--budget', type=float, default=8, help='memory budget in MiB')
+	parser.add_argument('--offline-queue', type=int, default=0, help='SDK offline publish queue size, -1 for no limit')
+	parser.add_argument('--rss-growth', type=float, default=4, help='MiB rss may grow over the second half')
+	args = parser.parse_args()
+
+	metrics.enable()
+	with tempfile.TemporaryDirectory() as directory:
+		samples, stats, elapsed, start = soak(args, directory)
+
+	print("%.1f h offline in %.0f s, %d samples" % (args.hours, elapsed, len(samples)))
+	components = sorted(set(name for _, usage in samples for name in usage))
+	peaks = {}
+	for name in components:
+		used = [usage[name]['used'] for _, usage in samples if name in usage and usage[name]['used'] is not None]
+		limit = next((usage[name]['limit'] for _, usage in samples if name in usage), None)
+		peaks[name] = (max(used) if used else None, limit)
+		print("  %-14s peak %12s  limit %12s  end %12s" % (
+			name,
+			peaks[name][0],
+			limit if limit is not None else '-',
+			used[-1] if used else None
+		))
+
+	spilled = sum(q.get('spilled', 0) for q in stats.values() if isinstance(q, dict))
+	dropped = sum(q.get('dropped', 0) for q in stats.values() if isinstance(q, dict))
+	print("  queues: %d items spilled to the outbox, %d dropped" % (spilled, dropped))
+
+	over = [name for name, (peak, limit) in peaks.items() if limit is not None and peak is not None and peak > limit]
+	half = [usage['rss']['used'] for t, usage in samples if t - start >= elapsed / 2 and usage['rss']['used'] is not None]
+	growth = (half[-1] - half[0]) / MIB if len(half) > 1 else 0
+	print("  rss grew %.2f MiB over the second half" % growth)
+	if over:
+		print("  over the budget: %s" % ', '.join(over))
+
+	ok = not over and growth <= args.rss_growth
+	print("\nok" if ok else "\nOVER BUDGET")
+	sys.exit(0 if ok else 1)
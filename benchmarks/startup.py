@@ -0,0 +1,108 @@
+# Time to first fix recorded after a power-up without cloud coverage
+#
+# The receiver streams a synthetic 10 Hz drive into a simulated UART from
+# the moment the process starts, while AWS IoT stays unreachable for
+# --offline seconds (each connect attempt times out after --timeout). Two
+# start-up sequences are compared:
+#
+#   blocking    connect MQTT first, retrying until it succeeds, then open
+#               the serial port (the old start.py, which did not even retry
+#               and died on the first failed connect)
+#   background  open the serial port, then MQTT.connect_in_background()
+#
+# and the pipeline runs until the first fix reaches a raw archive. Reports
+# Pipeline.time_to_first_fix, connect attempts and when MQTT came up.
+#
+# Usage: python3 benchmarks/startup.py [--offline 12] [--timeout 2]
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.serial_reader import FixCounter, SimulatedUART, play
+from utils.archive import RawArchiveWriter
+from utils.aws import MQTT
+from utils.pipeline import Pipeline
+from utils.serial_reader import BulkSerialSource
+
+class UnreachableClient:
+	# AWSIoTMQTTClient stand-in that cannot connect before `until`
+
+	def __init__(self, until, timeout):
+		self._until = until
+		self._timeout = timeout
+		self.attempts = 0
+		self.connected_at = None
+
+	def connect(self):
+		self.attempts += 1
+		wait = min(self._timeout, max(0, self._until - time.monotonic()))
+		time.sleep(wait)
+		if time.monotonic() < self._until:
+			raise TimeoutError('connect timed out')
+		self.connected_at = time.monotonic()
+		return True
+
+def start_up(name, background, args, directory):
+	started = time.monotonic()
+	uart = SimulatedUART()
+	stopped = threading.Event()
+	player = threading.Thread(target=play, args=(uart, args.offline + 10, stopped), daemon=True)
+	player.start()
+
+	mqtt = MQTT()
+	client = mqtt.pub_client = UnreachableClient(started + args.offline, args.timeout)
+	if background:
+		source = BulkSerialSource(tty=uart)
+		mqtt.connect_in_background(backoff=(1, 300))
+	else:
+		while True:
+			try:
+				mqtt.connect()
+				break
+			except TimeoutError:
+				time.sleep(1)
+		source = BulkSerialSource(tty=uart)
+
+	archive = RawArchiveWriter(os.path.join(directory, name))
+	pipeline = Pipeline(FixCounter(), archive, started=started)
+	while pipeline.time_to_first_fix is None and not stopped.is_set():
+		line = source.readline()
+		if line:
+			pipeline.process_line(line.decode('ascii', 'replace').strip())
+
+	# Wait for the background connect to finish as well
+	while not mqtt.connected and not stopped.is_set():
+		time.sleep(0.1)
+	mqtt.stop_connecting()
+	source.close()
+	archive.close()
+
+	print("%-11s first fix recorded after %6.2f s, MQTT up after %6.2f s (%d attempts)" % (
+		name,
+		pipeline.time_to_first_fix if pipeline.time_to_first_fix is not None else float('nan'),
+		client.connected_at - started if client.connected_at else float('nan'),
+		client.attempts
+	))
+	return pipeline.time_to_first_fix
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare start-up sequences without cloud coverage')
+	parser.add_argument('--offline', type=float, default=12, help='seconds until AWS IoT is reachable')
+	parser.add_argument('--timeout', type=float, default=2, help='seconds a connect attempt takes to fail')
+	args = parser.parse_args()
+	logging.disable(logging.ERROR)
+
+	with tempfile.TemporaryDirectory() as directory:
+		blocking = start_up('blocking', False, args, directory)
+		background = start_up('background', True, args, directory)
+
+	ok = background is not None and background < args.offline
+	print("\nok" if ok else "\nMISMATCH")
+	sys.exit(0 if ok else 1)
@@ -0,0 +1,115 @@
+# Synthetic multi-constellation NMEA streams for the benchmarks
+#
+# Usage: python3 benchmarks/synthetic.py <output.nmea> [rate_hz] [duration_s]
+
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from utils.sources import KNOTS, nmea_coordinate, nmea_sentence
+
+# Talker id and number of satellites in view per constellation
+CONSTELLATIONS = (
+	('GP', 12),
+	('GL', 8),
+	('GA', 6),
+	('GB', 5)
+)
+
+# Serial read timeout of start.py; slower fix rates leave an idle gap
+READ_TIMEOUT = 0.1
+
+class Constellation:
+
+	def __init__(self, talker, count, rng, first_prn):
+		self.talker = talker
+		self.satellites = [
+			[first_prn + i, rng.randint(5, 85), rng.randint(0, 359), rng.randint(20, 48)]
+			for i in range(count)
+		]
+
+	def drift(self, rng):
+		for sat in self.satellites:
+			sat[3] = min(50, max(0, sat[3] + rng.randint(-2, 2)))
+
+	def gsv(self):
+		lines = []
+		total = (len(self.satellites) + 3) // 4
+		for n in range(total):
+			body = '%sGSV,%d,%d,%02d' % (self.talker, total, n + 1, len(self.satellites))
+			for prn, elevation, azimuth, snr in self.satellites[n * 4:n * 4 + 4]:
+				body += ',%02d,%02d,%03d,%02d' % (prn, elevation, azimuth, snr)
+			lines.append(nmea_sentence(body))
+		return lines
+
+	def gsa(self):
+		prns = ['%02d' % sat[0] for sat in self.satellites[:12]]
+		prns += [''] * (12 - len(prns))
+		return nmea_sentence('GNGSA,A,3,%s,1.4,0.8,1.1' % ','.join(prns))
+
+def generate(rate_hz=1, duration_s=600, constellations=CONSTELLATIONS, seed=1, start=1600000000):
+	# Yields serial lines (bytes) of a drive with stops, turns and speed
+	# changes. GSV sets go out once a second, the fix sentences every epoch,
+	# in the GSV, GGA, RMC, GSA, VTG order of the Omega's receiver. A b'' read
+	# timeout separates epochs when the fix period exceeds READ_TIMEOUT.
+
+	rng = random.Random(seed)
+	sky = [Constellation(talker, count, rng, 1 + 32 * i) for i, (talker, count) in enumerate(constellations)]
+
+	lat, lon, altitude = 51.5, -0.1, 20.0
+	course, speed = 90.0, 10.0
+	period = 1.0 / rate_hz
+
+	for epoch in range(int(duration_s * rate_hz)):
+		t = start + epoch * period
+		second = int(epoch * period) != int((epoch - 1) * period) or epoch == 0
+
+		if second:
+			# Manoeuvre once a second: stop every few minutes, wander otherwise
+			if int(t) % 300 < 30:
+				speed = max(0.0, speed - 2)
+			else:
+				speed = min(33.0, max(0.0, speed + rng.uniform(-1, 1.2)))
+			course = (course + rng.gauss(0, 8 if int(t) % 120 < 60 else 1)) % 360
+			altitude += rng.uniform(-0.5, 0.5)
+
+		distance = speed * period
+		lat += distance * math.cos(math.radians(course)) / 111320
+		lon += distance * math.sin(math.radians(course)) / (111320 * math.cos(math.radians(lat)))
+
+		if period > READ_TIMEOUT:
+			yield b''
+
+		if second:
+			for constellation in sky:
+				constellation.drift(rng)
+				for line in constellation.gsv():
+					yield line
+
+		stamp = time.gmtime(t)
+		hhmmss = '%02d%02d%06.3f' % (stamp.tm_hour, stamp.tm_min, stamp.tm_sec + t % 1)
+		ddmmyy = '%02d%02d%02d' % (stamp.tm_mday, stamp.tm_mon, stamp.tm_year % 100)
+		lat_s = nmea_coordinate(lat, 2)
+		lat_dir = 'N' if lat >= 0 else 'S'
+		lon_s = nmea_coordinate(lon, 3)
+		lon_dir = 'E' if lon >= 0 else 'W'
+		knots = speed / KNOTS
+		in_use = sum(min(12, len(c.satellites)) for c in sky)
+
+		yield nmea_sentence('GNGGA,%s,%s,%s,%s,%s,1,%02d,0.8,%.1f,M,47.0,M,,' % (hhmmss, lat_s, lat_dir, lon_s, lon_dir, min(in_use, 99), altitude))
+		yield nmea_sentence('GNRMC,%s,A,%s,%s,%s,%s,%.3f,%.2f,%s,,,A' % (hhmmss, lat_s, lat_dir, lon_s, lon_dir, knots, course, ddmmyy))
+		for constellation in sky:
+			yield constellation.gsa()
+		yield nmea_sentence('GNVTG,%.2f,T,,M,%.3f,N,%.3f,K,A' % (course, knots, knots * 1.852))
+
+if __name__ == '__main__':
+	rate = float(sys.argv[2]) if len(sys.argv) > 2 else 1
+	duration = float(sys.argv[3]) if len(sys.argv) > 3 else 600
+	with open(sys.argv[1], 'wb') as f:
+		for line in generate(rate, duration):
+			if line:
+				f.write(line)
@@ -0,0 +1,76 @@
+# Bytes per point and encode time of the MQTT wire encodings
+#
+# Samples a synthetic drive through the Sampler, then encodes the sampled
+# points one message per point (the original MQTT.send path), as JSON
+# batches and as compact binary batches, and checks the compact batches
+# decode back within the fixed-point resolution.
+#
+# Usage: python3 benchmarks/wire_encoding.py [--duration 3600] [--batch 50]
+
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.synthetic import generate
+from utils.monitor import Sampler
+from utils.pipeline import Pipeline
+from utils.wire import FIELDS, CompactEncoder, JSONEncoder, decode_batch
+
+def sampled_points(duration):
+	points = []
+	pipeline = Pipeline(Sampler(update_callback=points.append))
+	for line in generate(1, duration):
+		pipeline.process_line(line.decode('ascii').strip())
+	return points
+
+def batches(points, size):
+	return [points[i:i + size] for i in range(0, len(points), size)]
+
+def single_json(batch):
+	# What MQTT.send publishes for every point
+	return [json.dumps(point, indent=0).encode('utf-8') for point in batch]
+
+def run(name, points, size, encode):
+	start = time.perf_counter()
+	payloads = []
+	for batch in batches(points, size):
+		payloads.extend(encode(batch))
+	elapsed = time.perf_counter() - start
+
+	total = sum(len(payload) for payload in payloads)
+	print("%-16s %6d messages %8d bytes %7.1f bytes/point %7.2f us/point" % (
+		name, len(payloads), total, total / len(points), elapsed / len(points) * 1e6))
+	return payloads
+
+def check_round_trip(points, payloads):
+	# Largest decoding error per field, bounded by half the fixed-point step
+	decoded = [point for payload in payloads for point in decode_batch(payload)]
+	assert len(decoded) == len(points)
+	for key, scale in FIELDS:
+		error = max(abs(a[key] - b[key]) for a, b in zip(points, decoded))
+		assert error <= 0.5 / scale + 1e-9, (key, error)
+		print("  %-3s max error %.2g" % (key, error))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Compare MQTT wire encodings')
+	parser.add_argument('--duration', type=float, default=3600, help='seconds of synthetic drive')
+	parser.add_argument('--batch', type=int, default=50, help='points per batch')
+	args = parser.parse_args()
+
+	points = sampled_points(args.duration)
+	print("%d sampled points, batches of %d" % (len(points), args.batch))
+
+	json_encoder = JSONEncoder()
+	compact_encoder = CompactEncoder()
+
+	run('json per point', points, args.batch, single_json)
+	run('json batch', points, args.batch,
+		lambda batch: [json_encoder.encode_batch([json_encoder.encode_point(p) for p in batch])])
+	payloads = run('compact batch', points, args.batch,
+		lambda batch: [compact_encoder.encode_batch([compact_encoder.encode_point(p) for p in batch])])
+
+	check_round_trip(points, payloads)
@@ -0,0 +1,35 @@
+# Exports raw archives pulled off devices to GPX, CSV or columnar files.
+#
+# Usage: python3 export.py <output> <archive>... [--format gpx|csv|columnar] [--workers N] [--start EPOCH] [--end EPOCH]
+#
+# The archives are columnar files (.col), raw archive prefixes or segments
+# (.seg), raw<ts>.db shelves or directories of any of these, e.g. the
+# mounted SD cards of several trackers. The output format follows the
+# output file's extension unless --format is given; the points are written
+# in timestamp order. See utils/export.py.
+
+import argparse
+import logging
+import time
+
+from utils.export import WRITERS, export
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Export raw archives to GPX, CSV or columnar files')
+	parser.add_argument('output')
+	parser.add_argument('archives', nargs='+')
+	parser.add_argument('--format', default=None, choices=sorted(WRITERS), help='output format, by default from the output extension')
+	parser.add_argument('--workers', type=int, default=None, help='worker processes, by default one per core')
+	parser.add_argument('--start', type=int, default=None, help='first epoch time to export')
+	parser.add_argument('--end', type=int, default=None, help='last epoch time to export')
+	parser.add_argument('--log', default='WARNING', help='logging level')
+	args = parser.parse_args()
+
+	logging.basicConfig(
+		format='%(asctime)s - %(name)s - %(filename)s(%(lineno)d) - %(levelname)s - %(message)s',
+		level=args.log
+	)
+
+	start = time.perf_counter()
+	count = export(args.archives, args.output, args.format, args.workers, args.start, args.end)
+	print("%d points written to %s in %.2f s" % (count, args.output, time.perf_counter() - start))
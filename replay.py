@@ -0,0 +1,65 @@
+# Replays a recorded drive through the GNSS_Blob -> Sampler -> queue path
+# without the GNSS receiver, the SD card or the cellular connection.
+#
+# Usage: python3 replay.py <recording> [--rate HZ] [--warp FACTOR] [--output points.json] [--stats stats.json]
+#
+# The recording is an NMEA log (.nmea/.log/.txt), a JSON dump as read by
+# test.py (.json), a raw archive prefix/segment written by start.py or a
+# compacted columnar archive (.col).
+
+import argparse
+import json
+import logging
+import queue
+import time
+
+from utils.metrics import StatsReporter, metrics
+from utils.monitor import Sampler
+from utils.pipeline import Pipeline
+from utils.sources import ReplaySource
+
+parser = argparse.ArgumentParser(description='Replay a recorded drive through the sampling pipeline')
+parser.add_argument('recording')
+parser.add_argument('--rate', type=float, default=None, help='internal sampling rate in Hz to interpolate the recording to')
+parser.add_argument('--warp', type=float, default=None, help='time warp factor, omit to replay as fast as possible')
+parser.add_argument('--output', default=None, help='write the sampled points to this JSON file')
+parser.add_argument('--stats', default=None, help='record per-stage metrics and write them to this JSON file')
+parser.add_argument('--log', default='WARNING', help='logging level')
+args = parser.parse_args()
+
+logging.basicConfig(
+	format='%(asctime)s - %(name)s - %(filename)s(%(lineno)d) - %(levelname)s - %(message)s',
+	level=args.log
+)
+
+q = queue.Queue()
+
+def monitor_callback(point):
+	q.put(point)
+
+sampler = Sampler(update_callback = monitor_callback)
+pipeline = Pipeline(sampler)
+
+if args.stats:
+	metrics.enable()
+
+start = time.perf_counter()
+with ReplaySource.from_file(args.recording, rate=args.rate, warp=args.warp) as source:
+	pipeline.run(source)
+elapsed = time.perf_counter() - start
+
+# Every epoch that went out as a fix reached the sampler
+fixes = pipeline.epochs.complete + pipeline.epochs.incomplete
+
+points = []
+while not q.empty():
+	points.append(q.get())
+
+print("%d fixes replayed in %.2f s, %d points sampled" % (fixes, elapsed, len(points)))
+
+if args.stats:
+	StatsReporter(args.stats).report()
+
+if args.output:
+	with open(args.output, 'w') as f:
+		json.dump(points, f, indent=0)
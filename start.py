@@ -1,28 +1,50 @@
 # Imports
-import serial
-import datetime
 import time
+
+# Start of the process, for the time to first fix metric
+started = time.monotonic()
+
+import datetime
 import signal
 import sys
-import pynmea2
 import logging
 import shelve
-from threading import Thread
-from persistqueue import Queue
+
+from utils.columnar import compact_in_background
+from utils.logs import LogPipeline
+from utils.memory import DEFAULT_BUDGET, ITEM_BYTES, MemoryBudget
 
 ts = datetime.datetime.timestamp(datetime.datetime.now())
 
-logging.basicConfig(
-	filename='/mnt/mmcblk0p1/logs_' + str(ts) + '.log',
-	filemode='w',
-	format='%(asctime)s - %(name)s - %(filename)s(%(lineno)d) - %(levelname)s - %(message)s',
-	level=logging.DEBUG
-)
+# Every in-memory buffer is sized from the memory budget, memory_budget in
+# /root/config in MiB (see utils/memory.py). It only changes on a restart.
+with shelve.open('/root/config') as config:
+	budget = MemoryBudget((config.get('memory_budget') or DEFAULT_BUDGET / 2 ** 20) * 2 ** 20)
+
+# Archives of earlier boots are compacted into columnar files for long term
+# storage by a low priority process, see utils/columnar.py. It is forked
+# here, before any thread is started or file opened, so the child inherits
+# neither.
+compactor = compact_in_background('/mnt/mmcblk0p1', ['/mnt/mmcblk0p1/raw' + str(ts)], log_path = '/mnt/mmcblk0p1/compaction.log')
+
+# Logs go to the SD card through a background writer thread, in batches and
+# rate limited (see utils/logs.py). Every start begins a new tracker.log, the
+# previous ones are kept gzipped as tracker.log.1.gz, ... The level is the
+# log_level key of /root/config; `kill -HUP <pid>` re-reads the config.
+logs = LogPipeline('/mnt/mmcblk0p1/tracker.log', level = logging.INFO, queue_size = budget.items('logs')).start()
+budget.track('logs', lambda: logs.stats()['queued'] * ITEM_BYTES['logs'] + logs.stats()['buffered'])
 
-from utils.nmea import GNSS_Blob
 from utils.aws import MQTT
+from utils.publisher import BatchPublisher
+from utils.outbox import Outbox, migrate_persistqueue
 from utils.monitor import Sampler
 from utils.error_handling import error_message
+from utils.metrics import StatsReporter, metrics
+from utils.profiling import AllocationProfiler, SamplingProfiler
+from utils.archive import RawArchiveWriter
+from utils.pipeline import Pipeline
+from utils.serial_reader import BulkSerialSource
+from utils.runtime import AsyncRuntime
 
 # Signal handler
 def signal_handler(signal, frame):
@@ -33,49 +55,118 @@ def signal_handler(signal, frame):
 signal.signal(signal.SIGINT, signal_handler)  # Ctrl+C
 signal.signal(signal.SIGTSTP, signal_handler) # Ctrl+Z
 
+# On-demand profiling: `kill -USR1 <pid>` starts or stops a sampling CPU
+# profile, `kill -USR2 <pid>` allocation tracing. Both stop by themselves
+# after a minute and write their reports to the SD card (see
+# utils/profiling.py); with profile_upload set in /root/config a summary
+# is also sent over MQTT. While the runtime runs the toggles are called on
+# its event loop like SIGHUP below, before that from the signal handler.
+profile_upload = False
+
+def profile_report(summary):
+	if profile_upload:
+		mqtt.send_profile(summary)
+
+cpu_profiler = SamplingProfiler('/mnt/mmcblk0p1', on_report = profile_report)
+allocation_profiler = AllocationProfiler('/mnt/mmcblk0p1', on_report = profile_report)
+
+def profile_handler(signal_number, frame):
+	if signal_number == signal.SIGUSR1:
+		cpu_profiler.toggle()
+	else:
+		allocation_profiler.toggle()
+	return
+
+signal.signal(signal.SIGUSR1, profile_handler)
+signal.signal(signal.SIGUSR2, profile_handler)
+
+# Apply changes to /root/config without a restart. While the runtime runs,
+# SIGHUP is handled on its event loop between Sampler steps (see
+# AsyncRuntime.run); before that the handler only notes the request, and
+# it is applied just before the runtime starts.
+reload_requested = False
+
+def reload_handler(signal_number, frame):
+	global reload_requested
+	reload_requested = True
+	return
+
+def reload_settings():
+	global reload_requested
+	reload_requested = False
+	with shelve.open('/root/config') as config:
+		settings_update(config)
+	logging.info("Settings reloaded")
+
+##
+## Serial
+##
+
+# Opened first, the drain thread buffers the receiver's output while the
+# rest starts up
+tty = BulkSerialSource('/dev/ttyUSB1', timeout = 0.1, capacity = budget.limit('serial'))
+budget.track('serial', lambda: tty.stats()['buffered'])
+
 ##
 ## MQTT stuff
 ##
 
-mqtt = MQTT()
-mqtt.connect()
+# Connects in the background with exponential backoff, points wait in the
+# outbox until it is up and while offline (the SDK's offline queue is off)
+mqtt = MQTT(offline_queue = 0)
+mqtt.connect_in_background(backoff = (1, 300))
+metrics.gauge('mqtt_connected', lambda: int(mqtt.connected))
+
+##
+## Stats
+##
+
+# Per-stage counters and latency histograms, written to the SD card every
+# minute and, with telemetry on, also sent over MQTT (see utils/metrics.py)
+stats_reporter = StatsReporter('/mnt/mmcblk0p1/stats.json', mqtt)
 	
 ##
 ## Queue
 ##
 	
-q = Queue(path="/mnt/mmcblk0p1/queue")
+q = Outbox("/mnt/mmcblk0p1/outbox.db", cache_bytes = budget.limit('outbox'))
+try:
+	migrate_persistqueue("/mnt/mmcblk0p1/queue", q)
+except Exception as e:
+	# A broken old queue must not keep the tracker from starting
+	logging.error("Failed to migrate the old queue")
+	logging.error(error_message(e))
 
-def worker():
-    while True:
-        item = q.get()
-        if mqtt.send(item):
-        	logging.info("Send was successful")
-	        q.task_done()
-
-for i in range(2):
-     t = Thread(target=worker)
-     t.daemon = True
-     t.start()
+# Points are published in batches, each acknowledged on the outbox once AWS
+# has confirmed the whole batch. Leases keep the workers off each other's items.
+publishers = [BatchPublisher(q, mqtt, lease_size = budget.items('publisher') // 2) for i in range(2)]
+budget.track('publisher', lambda: sum(publisher.leased for publisher in publishers) * ITEM_BYTES['publisher'])
 
 ##
 ## Monitor stuff
 ##
 
 def monitor_callback(point):
-	#mqtt.send(point)
-	q.put(point)
+	# Handed to the outbox stage of the runtime
+	runtime.emit(point)
 
-sampler = Sampler(update_callback = monitor_callback)
+sampler = Sampler(
+	update_callback = monitor_callback,
+	snapshot_path = '/mnt/mmcblk0p1/sampler_snapshot'
+)
 
 ##
 ## GNSS stuff
 ##
 
-blob = GNSS_Blob()
+# Raw fixes are buffered and appended to segment files, see utils/archive.py
+# for the flush/fsync policy and the resulting data-loss window
+raw_archive = RawArchiveWriter('/mnt/mmcblk0p1/raw' + str(ts), flush_bytes = min(16 * 1024, budget.limit('raw_archive')))
+budget.track('raw_archive', lambda: raw_archive.pending)
 
 
 def settings_update(config):
+	global profile_upload
 	try:
 		if config.get('sampling_distance'):
 			sampler.set_sampling_distance(config.get('sampling_distance'))
@@ -97,6 +188,53 @@ def settings_update(config):
 			sampler.set_moving_average_length(config.get('moving_average_length'))
 		else:
 			config['moving_average_length'] = 20
+			
+		if config.get('sampling_strategy'):
+			sampler.set_strategy(config.get('sampling_strategy'))
+		else:
+			config['sampling_strategy'] = 'distance'
+			
+		if config.get('drift_tolerance'):
+			sampler.set_drift_tolerance(config.get('drift_tolerance'))
+		else:
+			config['drift_tolerance'] = 25
+			
+		if config.get('max_interval'):
+			sampler.set_max_interval(config.get('max_interval'))
+		else:
+			config['max_interval'] = 300
+			
+		if config.get('velocity_fixes'):
+			sampler.set_velocity_fixes(config.get('velocity_fixes'))
+		else:
+			config['velocity_fixes'] = 5
+			
+		if 'metrics' in config:
+			metrics.enable(config['metrics'])
+		else:
+			# Off by default, the per-stage timing costs CPU on every line
+			config['metrics'] = False
+			metrics.enable(False)
+			
+		if config.get('telemetry'):
+			# Telemetry reports the metrics, so it switches them on
+			stats_reporter.set_telemetry(True)
+			metrics.enable()
+		else:
+			config['telemetry'] = False
+			
+		if config.get('profile_upload'):
+			profile_upload = True
+		else:
+			config['profile_upload'] = False
+			
+		if config.get('log_level'):
+			logs.set_level(config.get('log_level'))
+		else:
+			config['log_level'] = 'INFO'
+			
+		if not config.get('memory_budget'):
+			config['memory_budget'] = DEFAULT_BUDGET // 2 ** 20
 		
 	except Exception as e:
 		logging.error(error_message(e))
@@ -106,80 +244,35 @@ with shelve.open('/root/config') as config:
     settings_update(config)
     config.close()
 
+signal.signal(signal.SIGHUP, reload_handler)
+
 ##
 ## Main loop
 ##
 
 # Global and local variables	
 interrupted = False
-locked = False
 
-# Read serial data in an endless loop
-with serial.Serial('/dev/ttyUSB1', timeout = 0.1) as tty:
+pipeline = Pipeline(sampler, raw_archive, started = started)
 
-	while not interrupted:
-		try:
-			# Read data line from serial
-			line = tty.readline()
-			line = line.decode('utf-8').strip()
-			
-			if len(line) > 6:
-				sentence_type = line[1:6]
-				try:
-					msg = pynmea2.parse(line)
-				except Exception as e:
-					logging.error(error_message(e))
-					continue
-					
-				if not locked:
-					if msg.sentence_type == 'GSV':
-						# GPS Satellites in view
-						blob.add_satellite(msg)
-						
-					locked = blob.check_satellites()	
-					
-				else:
-					if msg.sentence_type == 'GGA':
-						# Global Positioning System Fix Data
-						blob.add_fix_data(msg)
-						
-					elif msg.sentence_type == 'VTG':
-						# Track made good and ground speed
-						blob.add_track_and_ground_speed(msg)
-						
-					elif msg.sentence_type == 'RMC':
-						# Recommended minimum specific GPS/Transit data
-						blob.add_minimum_transit_data(msg)
-						
-					elif msg.sentence_type == 'GSA':
-						# GPS DOP and active satellites
-						blob.add_DOP(msg)
-						
-				if blob.is_complete():
-					#logging.DEBUG("Data captured - store/send")
-					minimal, full = blob.get_base_information()
-					sampler.process_update(minimal)
-					
-					try:
-						with shelve.open('/mnt/mmcblk0p1/raw' + str(ts) + '.db') as raw:
-							raw[str(minimal.get('t'))] = full
-							raw.close()
-					except Exception as e:
-						logging.error("Failed to persit raw data")
-						logging.error(error_message(e))
-						continue
-					
-			else:
-				locked = False
-				blob.reset()
-				
-		except Exception as e:
-			logging.error("Exception in Main")
-			logging.error(error_message(e))
-			continue
+# Read serial data until interrupted; the runtime then drains every stage
+with tty:
+	if reload_requested:
+		reload_settings()
+	runtime = AsyncRuntime(tty, pipeline, q, publishers, reporter = stats_reporter, budget = budget)
+	runtime.run(lambda: interrupted, signal_handlers = {
+		signal.SIGHUP: reload_settings,
+		signal.SIGUSR1: cpu_profiler.toggle,
+		signal.SIGUSR2: allocation_profiler.toggle
+	})
 	
 # Graceful close down
 logging.info("Graceful close down")
+sampler.snapshot()
+raw_archive.close()
+q.close()
+mqtt.stop_connecting()
+logs.stop()
 
 
 
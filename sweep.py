@@ -0,0 +1,85 @@
+# Sweeps the Sampler parameters over recorded drives and reports the
+# settings that send the fewest bytes for a given track accuracy.
+#
+# Usage: python3 sweep.py <recording>... [--strategy distance|dead_reckoning]
+#                         [--grid NAME=V1,V2,...]... [--random N [--range NAME=LOW:HIGH]...]
+#                         [--encoding json|compact] [--error max|mean] [--workers N] [--output results.json]
+#
+# The recordings are anything replay.py reads. Without --grid or --random
+# the strategy's grid in utils.sweep.DEFAULT_GRIDS is searched; parameters
+# not in the grid keep their defaults. See utils/sweep.py for the scoring.
+
+import argparse
+import json
+import logging
+import time
+
+from utils.sweep import DEFAULT_GRIDS, PARAMETERS, grid_search, load_track, parameter_value, pareto, random_search, settings_of, sweep
+from utils.wire import ENCODERS
+
+def assignments(values, parse):
+	# NAME=VALUE arguments to a dict
+	result = {}
+	for value in values or []:
+		name, _, spec = value.partition('=')
+		if name not in PARAMETERS:
+			raise SystemExit("Unknown parameter %s, one of %s" % (name, ', '.join(sorted(PARAMETERS))))
+		try:
+			result[name] = parse(name, spec)
+		except ValueError:
+			kind = 'integers' if PARAMETERS[name][3] else 'numbers'
+			raise SystemExit("Values of %s must be %s, got %s" % (name, kind, spec))
+	return result
+
+def print_table(results):
+	names = sorted(PARAMETERS)
+	print(' '.join('%9s' % name[:9] for name in names) + '   points    bytes  max err mean err')
+	for result in results:
+		settings = settings_of(result['parameters'])
+		print(' '.join('%9g' % settings[name] for name in names) + ' %8d %8d %8.1f %8.2f' % (
+			result['points'], result['bytes'], result['max_error'], result['mean_error']
+		))
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Sweep the Sampler parameters over recorded drives')
+	parser.add_argument('recordings', nargs='+')
+	parser.add_argument('--grid', action='append', help='NAME=V1,V2,... values to search for a parameter')
+	parser.add_argument('--random', type=int, default=None, help='number of random combinations instead of a grid')
+	parser.add_argument('--range', action='append', help='NAME=LOW:HIGH range for --random, default all of utils.sweep.PARAMETERS')
+	parser.add_argument('--seed', type=int, default=None)
+	parser.add_argument('--strategy', default='distance', choices=sorted(DEFAULT_GRIDS), help='Sampler strategy to sweep')
+	parser.add_argument('--encoding', default='json', choices=sorted(ENCODERS), help='wire encoding to count bytes in')
+	parser.add_argument('--error', default='max', choices=['max', 'mean'], help='cross-track error to trade bytes against')
+	parser.add_argument('--workers', type=int, default=None, help='worker processes, by default one per core')
+	parser.add_argument('--output', default=None, help='write every result and the Pareto front to this JSON file')
+	parser.add_argument('--log', default='WARNING', help='logging level')
+	args = parser.parse_args()
+
+	logging.basicConfig(
+		format='%(asctime)s - %(name)s - %(filename)s(%(lineno)d) - %(levelname)s - %(message)s',
+		level=args.log
+	)
+
+	tracks = [load_track(path) for path in args.recordings]
+
+	if args.random:
+		ranges = assignments(args.range, lambda name, spec: tuple(parameter_value(name, value) for value in spec.split(':')))
+		combinations = list(random_search(args.random, args.seed, ranges))
+	else:
+		grid = assignments(args.grid, lambda name, spec: [parameter_value(name, value) for value in spec.split(',')]) or DEFAULT_GRIDS[args.strategy]
+		combinations = list(grid_search(grid))
+	for parameters in combinations:
+		parameters['strategy'] = args.strategy
+
+	start = time.perf_counter()
+	results = sweep(tracks, combinations, args.workers, args.encoding)
+	error = args.error + '_error'
+	front = pareto(results, error)
+
+	print("%d combinations over %d fixes in %.1f s\n" % (len(results), sum(len(track['timestamp']) for track in tracks), time.perf_counter() - start))
+	print("Pareto front, bytes against %s cross-track error (m):" % args.error)
+	print_table(front)
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump({'results': results, 'pareto': front, 'error': error, 'encoding': args.encoding}, f, indent=1)
@@ -6,7 +6,6 @@ import signal
 import sys
 import pynmea2
 import json
-import os
 import logging
 import shelve
 from threading import Thread
@@ -43,7 +42,7 @@ def worker():
     while True:
         item = q.get()
         if mqtt.send(item):
-        	logging.info("Send was successful")
+        	logging.debug("Send was successful")
 	        q.task_done()
 
 for i in range(2):
@@ -102,12 +101,6 @@ with shelve.open('/root/config') as config:
 ##
 ## Main loop
 ##
-try:
-	os.remove("sampler_history")
-except:
-	logging.info('Sampler history does not exist')
-	pass
-
 with open('/root/test_data.json') as td:
 	items = json.load(td)
 	
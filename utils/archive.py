@@ -0,0 +1,172 @@
+import glob
+import logging
+import os
+import pickle
+import struct
+import time
+import zlib
+
+from utils.error_handling import error_message
+
+# Raw fix archive
+#
+# Every completed fix is appended as one record to the current segment file:
+#
+#   +----------------+---------------+---------------------------------+
+#   | length (u32be) | crc32 (u32be) | pickle((timestamp, full_blob))  |
+#   +----------------+---------------+---------------------------------+
+#
+# Segments are named <prefix>_<sequence>.seg and a new one is started once
+# the current segment grows past `segment_size` bytes.
+#
+# Data-loss window: records are buffered in memory and written out once
+# `flush_bytes` are pending or the oldest pending record is `flush_interval`
+# seconds old, so a crash of the process loses at most that much data. The
+# age is checked on every append and on tick(), which the caller runs
+# periodically so records do not linger once fixes stop arriving.
+# Written data is fsync'd at most every `fsync_interval` seconds, so a power
+# cut can additionally lose up to `fsync_interval` seconds of written data.
+# A torn record at the tail of a segment is detected by the reader through
+# its length/crc header and skipped.
+
+HEADER = struct.Struct('>II')
+SEGMENT_SUFFIX = '.seg'
+
+def segment_paths(prefix):
+	# All segment files for an archive prefix, oldest first
+	return sorted(glob.glob(glob.escape(prefix) + '_*' + SEGMENT_SUFFIX))
+
+class RawArchiveWriter:
+
+	def __init__(
+		self,
+		prefix,
+		segment_size=4 * 1024 * 1024,
+		flush_bytes=16 * 1024,
+		flush_interval=10,
+		fsync_interval=60
+	):
+		self._prefix = prefix
+		self._segment_size = segment_size
+		self._flush_bytes = flush_bytes
+		self._flush_interval = flush_interval
+		self._fsync_interval = fsync_interval
+
+		self._buffer = bytearray()
+		self._buffer_since = None
+		self._last_fsync = time.monotonic()
+
+		self._file = None
+		self._sequence = len(segment_paths(prefix))
+		self._open_segment()
+
+	def _open_segment(self):
+		path = '%s_%05d%s' % (self._prefix, self._sequence, SEGMENT_SUFFIX)
+		self._file = open(path, 'ab')
+		self._segment_written = self._file.tell()
+
+	def _rotate(self):
+		self._sync()
+		self._file.close()
+		self._sequence += 1
+		self._open_segment()
+
+	def append(self, timestamp, record):
+		payload = pickle.dumps((timestamp, record), pickle.HIGHEST_PROTOCOL)
+		self._buffer += HEADER.pack(len(payload), zlib.crc32(payload))
+		self._buffer += payload
+
+		now = time.monotonic()
+		if self._buffer_since is None:
+			self._buffer_since = now
+
+		if len(self._buffer) >= self._flush_bytes or now - self._buffer_since >= self._flush_interval:
+			self.flush()
+
+	def tick(self):
+		# Write out a buffer that has become too old, or fsync when due,
+		# without a new record
+		now = time.monotonic()
+		if self._buffer_since is not None and now - self._buffer_since >= self._flush_interval:
+			self.flush()
+		elif self._buffer_since is None and now - self._last_fsync >= self._fsync_interval:
+			self.flush()
+
+	@property
+	def pending(self):
+		# Bytes buffered in memory, not yet written
+		return len(self._buffer)
+
+	def flush(self):
+		if self._buffer:
+			self._file.write(self._buffer)
+			self._file.flush()
+			self._segment_written += len(self._buffer)
+			self._buffer = bytearray()
+			self._buffer_since = None
+
+		if time.monotonic() - self._last_fsync >= self._fsync_interval:
+			self._sync()
+
+		if self._segment_written >= self._segment_size:
+			self._rotate()
+
+	def _sync(self):
+		try:
+			os.fsync(self._file.fileno())
+		except Exception as e:
+			logging.error(error_message(e))
+		self._last_fsync = time.monotonic()
+
+	def close(self):
+		if self._file is None:
+			return
+		self._fsync_interval = 0
+		self.flush()
+		self._file.close()
+		self._file = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class RawArchiveReader:
+	# Iterates (timestamp, record) tuples back out of an archive's segments
+
+	def __init__(self, prefix):
+		self._prefix = prefix
+
+	def __iter__(self):
+		for path in segment_paths(self._prefix):
+			for item in read_segment(path):
+				yield item
+
+def read_segment(path, offsets=False):
+	# Reads one record at a time, so memory does not grow with the segment.
+	# With offsets, yields (offset, item) for read_record().
+	with open(path, 'rb') as f:
+		offset = 0
+		while True:
+			item = read_record(f, offset, path)
+			if item is None:
+				return
+			yield (offset, item) if offsets else item
+			offset = f.tell()
+
+def read_record(f, offset, path=None):
+	# The item of the record at offset in an open segment file, None at its
+	# end or at a truncated or corrupt record
+	f.seek(offset)
+	header = f.read(HEADER.size)
+	if len(header) < HEADER.size:
+		return None
+
+	length, crc = HEADER.unpack(header)
+	payload = f.read(length)
+	if len(payload) < length or zlib.crc32(payload) != crc:
+		logging.error("Truncated or corrupt record in %s at offset %d" % (path or getattr(f, 'name', None), offset))
+		return None
+
+	return pickle.loads(payload)
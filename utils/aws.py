@@ -1,8 +1,15 @@
 import datetime
 import decimal
-from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient, AWSIoTMQTTShadowClient
 import json
 import logging
+import threading
+
+from utils.error_handling import error_message
+from utils.metrics import metrics
+from utils.wire import ENCODERS
+
+# AWS IoT Core rejects messages with a larger payload
+MAX_PAYLOAD_BYTES = 128 * 1024
 
 #logging.basicConfig(filename='/root/mqtt_publish.log', filemode='w', format='%(name)s - %(levelname)s - %(message)s', level=logging.INFO)
 logging.info('Creating and configuring MQTT client')
@@ -72,9 +79,35 @@ def delta_callback(payload, responseStatus, token):
 
 class MQTT:
 
-	def __init__(self):
+	def __init__(self, encoding='json', offline_queue=0):
 		self.thingName = "defender_tracker_iot_thing"
 		
+		# Wire encoding of batches, 'json' or 'compact' (see utils/wire.py)
+		if encoding == 'json':
+			self.encoder = ENCODERS[encoding](default=dumper)
+		else:
+			self.encoder = ENCODERS[encoding]()
+		
+		# Messages the SDK keeps in memory while offline, dropping the oldest
+		# beyond that; -1 for no limit. A publish that goes into this queue
+		# still returns False, so the outbox retries it anyway and the queue
+		# is off by default: points wait in the outbox on disk instead. As
+		# nothing is published once the SDK reports the connection lost, the
+		# queue only catches publishes made as it drops.
+		self._offline_queue = offline_queue
+
+		# The AWS SDK is only imported and the client only set up on the first
+		# connect, so the GNSS side starts without waiting for either
+		self.pub_client = None
+
+		# Whether the connection is up, cleared and set again by the SDK's
+		# offline and online callbacks while it reconnects
+		self.connected = False
+		self._stopped = threading.Event()
+
+	def __create_client(self):
+		from AWSIoTPythonSDK.MQTTLib import AWSIoTMQTTClient, DROP_OLDEST
+
 		self.pub_client = AWSIoTMQTTClient(self.thingName)
 		#self.shadow_client = AWSIoTMQTTShadowClient(self.thingName)
 
@@ -87,7 +120,9 @@ class MQTT:
 			"/root/7519928cd5-private.pem.key",
 			"/root/7519928cd5-certificate.pem.cer"
 		)
-		self.pub_client.configureOfflinePublishQueueing(-1)
+		self.pub_client.configureOfflinePublishQueueing(self._offline_queue, DROP_OLDEST)
+		self.pub_client.onOnline = self.__online
+		self.pub_client.onOffline = self.__offline
 		self.pub_client.configureConnectDisconnectTimeout(10)
 		self.pub_client.configureMQTTOperationTimeout(120)
 		
@@ -107,7 +142,12 @@ class MQTT:
 
 	def connect(self):
 		print('Connecting to AWS IoT')
-		self.pub_client.connect()
+		if self.pub_client is None:
+			self.__create_client()
+		if self.pub_client.connect() is False:
+			raise ConnectionError('Connecting to AWS IoT failed')
+		# The SDK reconnects by itself from here on
+		self.connected = True
 		#self.shadow_client.connect()
 
 		#self.shadow_handler = self.shadow_client.createShadowHandlerWithName(self.thingName, True)
@@ -115,11 +155,82 @@ class MQTT:
 		
 		#self.deviceShadowHandler.shadowUpdate(payload, custom_callback, 5)
 
+	def __online(self):
+		self.connected = True
+
+	def __offline(self):
+		# Called on the SDK's thread; publishes fail fast until it is back
+		self.connected = False
+		logging.warning('Connection to AWS IoT lost, the SDK is reconnecting')
 		
+	def connect_in_background(self, backoff=(1, 300)):
+		# Retry connect() on a thread until it succeeds, waiting backoff[0]
+		# seconds after the first failure and doubling up to backoff[1]
+		thread = threading.Thread(target=self.__connect_loop, args=(backoff,), name='mqtt', daemon=True)
+		thread.start()
+		return thread
+
+	def __connect_loop(self, backoff):
+		delay = backoff[0]
+		while not self._stopped.is_set():
+			start = metrics.clock()
+			try:
+				self.connect()
+				metrics.observe('mqtt_connect', start)
+				logging.info('Connected to AWS IoT')
+				return
+			except Exception as e:
+				metrics.count('mqtt_connect_failed')
+				logging.error("Failed to connect to AWS IoT, retrying in %d s" % delay)
+				logging.error(error_message(e))
+
+			self._stopped.wait(delay)
+			delay = min(delay * 2, backoff[1])
+
+	def stop_connecting(self):
+		self._stopped.set()
+
 	def send(self, data):
-		logging.info('Sending data to AWS')
+		logging.debug('Sending data to AWS')
+		if not self.connected:
+			return False
 		
 		payload = json.dumps(data, default=dumper, indent=0)
 		return self.pub_client.publish(self.thingName + "/transit", payload, 1)
+
+	def encode_point(self, data):
+		# One point as the selected encoder stores it inside a batch
+		return self.encoder.encode_point(data)
+
+	def point_size(self, encoded):
+		return self.encoder.point_size(encoded)
+
+	def batch_overhead(self, count):
+		# Bytes a batch of count encoded points adds around them
+		return self.encoder.batch_overhead(count)
+
+	def send_batch(self, encoded_points):
+		# Publish already encoded points as one message; returns once the
+		# PUBACK for the whole batch has arrived
+		if not self.connected:
+			return False
+		payload = self.encoder.encode_batch(encoded_points)
+		return self.pub_client.publish(self.thingName + self.encoder.topic_suffix, payload, 1)
+
+	def send_telemetry(self, stats):
+		# Compact pipeline stats (utils.metrics.telemetry); QoS 0, a lost
+		# report is replaced by the next one
+		if not self.connected:
+			return False
+		payload = json.dumps(stats, separators=(',', ':'))
+		return self.pub_client.publish(self.thingName + "/transit/telemetry", payload, 0)
+
+	def send_profile(self, summary):
+		# Summary of an on-demand profile (utils/profiling.py), the full
+		# report stays on the SD card
+		if not self.connected:
+			return False
+		payload = json.dumps(summary, separators=(',', ':'))
+		return self.pub_client.publish(self.thingName + "/transit/profile", payload, 0)
 	
 
@@ -0,0 +1,428 @@
+import array
+import bisect
+import glob
+import heapq
+import logging
+import mmap
+import multiprocessing
+import os
+import pickle
+import shelve
+import struct
+import zlib
+
+from utils.archive import RawArchiveReader, SEGMENT_SUFFIX, segment_paths
+from utils.error_handling import error_message
+from utils.logs import LOG_FORMAT
+from utils.nmea import get_epoch_time
+
+# Columnar raw fix archive for long term storage
+#
+# The segment archive of utils/archive.py is the crash-safe journal written
+# while driving; compact_archives() later turns finished archives (and the
+# older shelve files) into one compressed columnar file each:
+#
+#   +-------------+--------+--------+-----+
+#   | MAGIC (5 B) | chunk  | chunk  | ... |
+#   +-------------+--------+--------+-----+
+#
+#   chunk:  length (u32be) | crc32 (u32be) | t_min (i64be) | t_max (i64be) | rows (u32be)
+#           columns (u16be) | columns x [name length (u16be) | blob length (u32be) | blob crc32 (u32be) | name]
+#           columns x blob
+#
+# length covers everything after the chunk header, the header crc32 the
+# column directory and every blob has its own crc32.
+# A record {'fix': {'lat': ...}, 'satellites': {...}, ...} is stored as the
+# columns 'fix.lat', ... and 'satellites' (the GSV pages stay one column),
+# next to a 'timestamp' column. Each column of a chunk is a zlib compressed
+# pickle of its values, so a query only inflates the columns it asks for.
+# The chunk headers form a sparse time index: the reader walks them once
+# through a memory map, then seeks straight to the chunks of a time window.
+#
+# A writer holds one chunk in memory, so chunks are kept small (CHUNK_ROWS,
+# two minutes at 1 Hz). Conversions stream their input: a segment archive
+# record by record, a shelve by its keys sorted by time. On the device the
+# compaction runs in a separate process at the lowest priority, see
+# compact_in_background(), so its memory is not part of the client's budget
+# and its CPU time goes to the client first.
+
+MAGIC = b'RAWC\x01'
+CHUNK = struct.Struct('>IIqqI')
+COLUMNS = struct.Struct('>H')
+COLUMN = struct.Struct('>HII')
+COLUMNAR_SUFFIX = '.col'
+
+# Records per chunk
+CHUNK_ROWS = 120
+
+# Columns kept whole rather than split by key
+WHOLE_SECTIONS = ('satellites',)
+
+def flatten(record):
+	columns = {}
+	for section, values in record.items():
+		if isinstance(values, dict) and section not in WHOLE_SECTIONS:
+			for key, value in values.items():
+				columns[section + '.' + key] = value
+		else:
+			columns[section] = values
+	return columns
+
+def unflatten(columns):
+	record = {}
+	for name, value in columns.items():
+		section, dot, key = name.partition('.')
+		if dot:
+			record.setdefault(section, {})[key] = value
+		else:
+			record[name] = value
+	return record
+
+class ColumnarWriter:
+	# Writes (timestamp, record) pairs in chunks of chunk_rows records
+
+	def __init__(self, path, chunk_rows=CHUNK_ROWS, level=6):
+		self._chunk_rows = chunk_rows
+		self._level = level
+		self._file = open(path, 'wb')
+		self._file.write(MAGIC)
+		self.__clear()
+
+	def __clear(self):
+		self._timestamps = []
+		self._columns = {}
+
+	def append(self, timestamp, record):
+		rows = len(self._timestamps)
+		for name, value in flatten(record).items():
+			column = self._columns.get(name)
+			if column is None:
+				# Column first seen in this chunk, earlier rows did not have it
+				column = self._columns[name] = [None] * rows
+			column.append(value)
+
+		self._timestamps.append(int(timestamp))
+		for column in self._columns.values():
+			if len(column) <= rows:
+				column.append(None)
+
+		if len(self._timestamps) >= self._chunk_rows:
+			self.flush()
+
+	def flush(self):
+		if not self._timestamps:
+			return
+
+		columns = [('timestamp', self._timestamps)] + sorted(self._columns.items())
+		blobs = [zlib.compress(pickle.dumps(values, pickle.HIGHEST_PROTOCOL), self._level) for _, values in columns]
+
+		directory = bytearray(COLUMNS.pack(len(columns)))
+		for (name, _), blob in zip(columns, blobs):
+			name = name.encode('utf-8')
+			directory += COLUMN.pack(len(name), len(blob), zlib.crc32(blob))
+			directory += name
+
+		length = len(directory) + sum(len(blob) for blob in blobs)
+		self._file.write(CHUNK.pack(length, zlib.crc32(directory), min(self._timestamps), max(self._timestamps), len(self._timestamps)))
+		self._file.write(directory)
+		for blob in blobs:
+			self._file.write(blob)
+		self.__clear()
+
+	def close(self):
+		if self._file is None:
+			return
+		self.flush()
+		self._file.flush()
+		os.fsync(self._file.fileno())
+		self._file.close()
+		self._file = None
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+class ColumnarArchive:
+	# Reads a columnar archive through a memory map
+
+	def __init__(self, path):
+		self.path = path
+		self._file = open(path, 'rb')
+		self._map = None
+		self._index = []
+		self._sorted = True
+		self._t_max = []
+
+		try:
+			size = os.fstat(self._file.fileno()).st_size
+			if size < len(MAGIC):
+				return
+			self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+			if self._map[:len(MAGIC)] != MAGIC:
+				raise ValueError("%s is not a columnar archive" % path)
+			self.__build_index()
+		except Exception:
+			self.close()
+			raise
+
+	def __build_index(self):
+		# One (t_min, t_max, offset, rows) entry per complete chunk
+		data = self._map
+		offset = len(MAGIC)
+		while offset + CHUNK.size <= len(data):
+			length, _, t_min, t_max, rows = CHUNK.unpack_from(data, offset)
+			if offset + CHUNK.size + length > len(data):
+				logging.error("Truncated chunk in %s at offset %d" % (self.path, offset))
+				break
+			self._index.append((t_min, t_max, offset, rows))
+			offset += CHUNK.size + length
+
+		# Chunks of one drive follow each other in time, which lets a query
+		# bisect to its first chunk; otherwise it checks every chunk
+		self._sorted = all(a[1] <= b[0] for a, b in zip(self._index, self._index[1:]))
+		self._t_max = [entry[1] for entry in self._index]
+
+	def __len__(self):
+		return sum(entry[3] for entry in self._index)
+
+	@property
+	def span(self):
+		# (first, last) timestamp in the archive, None if it is empty
+		if not self._index:
+			return None
+		return min(entry[0] for entry in self._index), max(entry[1] for entry in self._index)
+
+	def chunks(self, t_start=None, t_end=None):
+		# Index entries of the chunks overlapping [t_start, t_end]
+		first = 0
+		if self._sorted and t_start is not None:
+			first = bisect.bisect_left(self._t_max, t_start)
+
+		for entry in self._index[first:]:
+			t_min, t_max = entry[0], entry[1]
+			if t_end is not None and t_min > t_end:
+				if self._sorted:
+					return
+				continue
+			if t_start is not None and t_max < t_start:
+				continue
+			yield entry
+
+	def query(self, t_start=None, t_end=None, fields=None):
+		# Yields (timestamp, values) for every record in [t_start, t_end].
+		# values is the full record without `fields`, otherwise a dict of the
+		# named columns; a section name such as 'fix' selects all of its
+		# columns.
+		for _, _, offset, _ in self.chunks(t_start, t_end):
+			try:
+				for item in self.read_chunk(offset, t_start, t_end, fields):
+					yield item
+			except Exception as e:
+				logging.error("Unreadable chunk in %s at offset %d" % (self.path, offset))
+				logging.error(error_message(e))
+
+	def __iter__(self):
+		return self.query()
+
+	def read_chunk(self, offset, t_start=None, t_end=None, fields=None):
+		# query() for the single chunk at offset (from chunks()). Only the
+		# directory and the blobs of the wanted columns are read.
+		data = self._map
+		crc = CHUNK.unpack_from(data, offset)[1]
+
+		position = offset + CHUNK.size
+		count = COLUMNS.unpack_from(data, position)[0]
+		position += COLUMNS.size
+		directory = []
+		for _ in range(count):
+			name_length, blob_length, blob_crc = COLUMN.unpack_from(data, position)
+			position += COLUMN.size
+			directory.append((data[position:position + name_length].decode('utf-8'), blob_length, blob_crc))
+			position += name_length
+
+		if zlib.crc32(data[offset + CHUNK.size:position]) != crc:
+			raise ValueError("directory crc mismatch")
+
+		blobs = {}
+		for name, blob_length, blob_crc in directory:
+			blobs[name] = (position, blob_length, blob_crc)
+			position += blob_length
+
+		def column(name):
+			blob_start, blob_length, blob_crc = blobs[name]
+			blob = data[blob_start:blob_start + blob_length]
+			if zlib.crc32(blob) != blob_crc:
+				raise ValueError("crc mismatch in column %s" % name)
+			return pickle.loads(zlib.decompress(blob))
+
+		timestamps = column('timestamp')
+		rows = [
+			i for i, t in enumerate(timestamps)
+			if (t_start is None or t >= t_start) and (t_end is None or t <= t_end)
+		]
+		if not rows:
+			return
+
+		names = [entry[0] for entry in directory if entry[0] != 'timestamp']
+		if fields is not None:
+			names = [
+				name for name in names
+				if name in fields or name.partition('.')[0] in fields
+			]
+		values = {name: column(name) for name in names}
+
+		for i in rows:
+			columns = {name: values[name][i] for name in names}
+			yield timestamps[i], columns if fields is not None else unflatten(columns)
+
+	def close(self):
+		if self._map is not None:
+			self._map.close()
+			self._map = None
+		self._file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+def archive_paths(directory):
+	return sorted(glob.glob(os.path.join(glob.escape(directory), '*' + COLUMNAR_SUFFIX)))
+
+def query(paths, t_start=None, t_end=None, fields=None):
+	# ColumnarArchive.query over several archives, e.g. archive_paths(dir)
+	for path in paths:
+		with ColumnarArchive(path) as archive:
+			span = archive.span
+			if span is None:
+				continue
+			if (t_end is not None and span[0] > t_end) or (t_start is not None and span[1] < t_start):
+				continue
+			for item in archive.query(t_start, t_end, fields):
+				yield item
+
+def record_timestamp(record):
+	# Epoch time of a raw fix record
+	return get_epoch_time(record['fix']['timestamp'], record['transit_data']['datestamp'])
+
+def shelve_keys(raw):
+	# (timestamp, key) of every record in an open shelve in timestamp order.
+	# Epoch keys, as the original start.py wrote, are sorted as an array of
+	# integers; only records under other keys are read for their timestamp.
+	epochs = array.array('q')
+	named = []
+	for key in raw:
+		try:
+			timestamp = int(key)
+		except ValueError:
+			timestamp = None
+		if timestamp is not None and str(timestamp) == key:
+			epochs.append(timestamp)
+		else:
+			named.append((record_timestamp(raw[key]) if timestamp is None else timestamp, key))
+
+	epochs = array.array('q', sorted(epochs))
+	named.sort()
+	return heapq.merge(((timestamp, str(timestamp)) for timestamp in epochs), named)
+
+def convert_shelve(path, destination, chunk_rows=CHUNK_ROWS):
+	# Convert a raw<ts>.db shelve as written by the original start.py. Only
+	# the keys are sorted, the records are read one at a time. Returns the
+	# record count.
+	with shelve.open(path, 'r') as raw:
+		return write_archive(((timestamp, raw[key]) for timestamp, key in shelve_keys(raw)), destination, chunk_rows)
+
+def convert_segments(prefix, destination, chunk_rows=CHUNK_ROWS):
+	# Convert a segment archive of utils.archive. Returns the record count.
+	return write_archive(RawArchiveReader(prefix), destination, chunk_rows)
+
+def write_archive(items, destination, chunk_rows=CHUNK_ROWS):
+	# Write (timestamp, record) items to a new columnar archive, atomically
+	tmp_path = destination + '.tmp'
+	count = 0
+	with ColumnarWriter(tmp_path, chunk_rows) as writer:
+		for timestamp, record in items:
+			writer.append(timestamp, record)
+			count += 1
+	os.replace(tmp_path, destination)
+	return count
+
+def shelve_paths(directory):
+	# raw<ts>.db shelves in directory; depending on the dbm module the files
+	# on disk are raw<ts>.db, raw<ts>.db.db or raw<ts>.db.dat/.dir/.bak
+	names = set()
+	for path in glob.glob(os.path.join(glob.escape(directory), 'raw*.db*')):
+		name = path.rsplit('.db', 1)[0] + '.db'
+		if name.endswith('.db.db'):
+			name = name[:-len('.db')]
+		names.add(name)
+	return sorted(names)
+
+def compact_archives(directory, keep=()):
+	# Convert every finished segment archive and shelve file in directory
+	# to a columnar archive next to it, then remove the originals. Archives
+	# whose prefix is in `keep` (the one being written) are left alone.
+	converted = []
+
+	prefixes = set(path.rsplit('_', 1)[0] for path in glob.glob(os.path.join(glob.escape(directory), '*_*' + SEGMENT_SUFFIX)))
+	for prefix in sorted(prefixes - set(keep)):
+		try:
+			count = convert_segments(prefix, prefix + COLUMNAR_SUFFIX)
+			with ColumnarArchive(prefix + COLUMNAR_SUFFIX) as archive:
+				if count != len(archive):
+					raise ValueError("record count mismatch")
+			for path in segment_paths(prefix):
+				os.remove(path)
+			converted.append((prefix, count))
+		except Exception as e:
+			logging.error("Failed to compact %s" % prefix)
+			logging.error(error_message(e))
+
+	for path in shelve_paths(directory):
+		destination = path[:-len('.db')] + COLUMNAR_SUFFIX
+		if os.path.exists(destination):
+			continue
+		try:
+			count = convert_shelve(path, destination)
+			with ColumnarArchive(destination) as archive:
+				if count != len(archive):
+					raise ValueError("record count mismatch")
+			for name in glob.glob(glob.escape(path) + '*'):
+				os.remove(name)
+			converted.append((path, count))
+		except Exception as e:
+			logging.error("Failed to convert %s" % path)
+			logging.error(error_message(e))
+
+	for source, count in converted:
+		logging.info("Compacted %d raw fixes from %s" % (count, source))
+	return converted
+
+def compact_in_background(directory, keep=(), log_path=None):
+	# compact_archives() in a daemon process at nice 19. Forked, as start.py
+	# has no __main__ guard for spawn to re-import. A forked child only gets
+	# the calling thread, so call this before starting threads or opening
+	# files and connections (start.py does so first thing). The client's
+	# log handlers do not work in the child, it logs to log_path instead.
+	process = multiprocessing.get_context('fork').Process(
+		target=_compact_process,
+		args=(directory, keep, log_path),
+		name='compactor',
+		daemon=True
+	)
+	process.start()
+	return process
+
+def _compact_process(directory, keep, log_path):
+	os.nice(19)
+	root = logging.getLogger()
+	for handler in list(root.handlers):
+		root.removeHandler(handler)
+	if log_path is not None:
+		handler = logging.FileHandler(log_path)
+		handler.setFormatter(logging.Formatter(LOG_FORMAT))
+		root.addHandler(handler)
+	compact_archives(directory, keep)
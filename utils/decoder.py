@@ -0,0 +1,234 @@
+import datetime
+from decimal import Decimal
+from functools import lru_cache
+from collections import namedtuple
+
+# Fast-path NMEA decoder for the sentences the client consumes (GGA, RMC, VTG,
+# GSA and GSV). Each sentence is decoded into a tuple whose field names and
+# value types mirror the pynmea2 attributes, so GNSS_Blob handles both the
+# same way. Anything else falls back to pynmea2.
+
+class ChecksumError(ValueError):
+	pass
+
+_MASK_512 = (1 << 512) - 1
+_MASK_256 = (1 << 256) - 1
+_MASK_128 = (1 << 128) - 1
+_MASK_64 = (1 << 64) - 1
+
+def _xor_bytes(data):
+	# XOR of all bytes, folded on a single int instead of looping per byte.
+	# NMEA sentences are at most 82 characters, so 128 bytes covers them.
+	if len(data) > 128:
+		n = 0
+		for c in data:
+			n ^= c
+		return n
+
+	n = int.from_bytes(data, 'little')
+	n = (n >> 512) ^ (n & _MASK_512)
+	n = (n >> 256) ^ (n & _MASK_256)
+	n = (n >> 128) ^ (n & _MASK_128)
+	n = (n >> 64) ^ (n & _MASK_64)
+	n ^= n >> 32
+	n ^= n >> 16
+	n ^= n >> 8
+	return n & 0xff
+
+# GGA and RMC of one epoch carry the same time, and the date rarely changes,
+# so the (immutable) results are cached
+
+@lru_cache(maxsize=16)
+def _timestamp(s):
+	ms = s[6:]
+	return datetime.time(
+		int(s[0:2]),
+		int(s[2:4]),
+		int(s[4:6]),
+		int(float(ms) * 1000000) if ms else 0,
+		datetime.timezone.utc
+	)
+
+@lru_cache(maxsize=4)
+def _datestamp(s):
+	# Same two digit year pivot as strptime('%y'), which pynmea2 uses
+	year = int(s[4:6])
+	year += 2000 if year < 69 else 1900
+	return datetime.date(year, int(s[2:4]), int(s[0:2]))
+
+# (field name, converter); a converter of None keeps the raw string
+_FIELDS = {
+	'GGA': (
+		('timestamp', _timestamp),
+		('lat', None),
+		('lat_dir', None),
+		('lon', None),
+		('lon_dir', None),
+		('gps_qual', int),
+		('num_sats', None),
+		('horizontal_dil', None),
+		('altitude', float),
+		('altitude_units', None),
+		('geo_sep', None),
+		('geo_sep_units', None),
+		('age_gps_data', None),
+		('ref_station_id', None)
+	),
+	'RMC': (
+		('timestamp', _timestamp),
+		('status', None),
+		('lat', None),
+		('lat_dir', None),
+		('lon', None),
+		('lon_dir', None),
+		('spd_over_grnd', float),
+		('true_course', float),
+		('datestamp', _datestamp),
+		('mag_variation', None),
+		('mag_var_dir', None)
+	),
+	'VTG': (
+		('true_track', float),
+		('true_track_sym', None),
+		('mag_track', Decimal),
+		('mag_track_sym', None),
+		('spd_over_grnd_kts', Decimal),
+		('spd_over_grnd_kts_sym', None),
+		('spd_over_grnd_kmph', float),
+		('spd_over_grnd_kmph_sym', None),
+		('faa_mode', None)
+	),
+	'GSA': (
+		('mode', None),
+		('mode_fix_type', None),
+		('sv_id01', None),
+		('sv_id02', None),
+		('sv_id03', None),
+		('sv_id04', None),
+		('sv_id05', None),
+		('sv_id06', None),
+		('sv_id07', None),
+		('sv_id08', None),
+		('sv_id09', None),
+		('sv_id10', None),
+		('sv_id11', None),
+		('sv_id12', None),
+		('pdop', None),
+		('hdop', None),
+		('vdop', None)
+	),
+	'GSV': (
+		('num_messages', None),
+		('msg_num', None),
+		('num_sv_in_view', None),
+		('sv_prn_num_1', None),
+		('elevation_deg_1', None),
+		('azimuth_1', None),
+		('snr_1', None),
+		('sv_prn_num_2', None),
+		('elevation_deg_2', None),
+		('azimuth_2', None),
+		('snr_2', None),
+		('sv_prn_num_3', None),
+		('elevation_deg_3', None),
+		('azimuth_3', None),
+		('snr_3', None),
+		('sv_prn_num_4', None),
+		('elevation_deg_4', None),
+		('azimuth_4', None),
+		('snr_4', None)
+	)
+}
+
+def _sentence_class(sentence_type, fields):
+	base = namedtuple(sentence_type, ('talker',) + tuple(name for name, _ in fields))
+
+	class Sentence(base):
+		__slots__ = ()
+
+		def items(self):
+			# (field name, value) pairs without the talker id
+			return zip(self._fields[1:], self[1:])
+
+	Sentence.__name__ = sentence_type
+	Sentence.__qualname__ = sentence_type
+	Sentence.sentence_type = sentence_type
+	return Sentence
+
+GGA = _sentence_class('GGA', _FIELDS['GGA'])
+RMC = _sentence_class('RMC', _FIELDS['RMC'])
+VTG = _sentence_class('VTG', _FIELDS['VTG'])
+GSA = _sentence_class('GSA', _FIELDS['GSA'])
+GSV = _sentence_class('GSV', _FIELDS['GSV'])
+
+SENTENCES = {
+	'GGA': GGA,
+	'RMC': RMC,
+	'VTG': VTG,
+	'GSA': GSA,
+	'GSV': GSV
+}
+
+# Per sentence: (class, field count, [(index, converter)] of typed fields)
+_DECODERS = {
+	sentence_type: (
+		SENTENCES[sentence_type],
+		len(fields),
+		[(i, convert) for i, (_, convert) in enumerate(fields) if convert]
+	)
+	for sentence_type, fields in _FIELDS.items()
+}
+
+def decode(line, wanted=None):
+	# Decode a fast-path sentence, returning None for any other sentence type
+	# or for types not listed in `wanted`. Raises ChecksumError or ValueError
+	# on a malformed line.
+
+	sentence_type = line[3:6]
+	if wanted is not None and sentence_type not in wanted:
+		return None
+
+	decoder = _DECODERS.get(sentence_type)
+	if decoder is None or line[0] != '$':
+		return None
+
+	star = line.find('*', 6)
+	if star >= 0:
+		body = line[1:star]
+		if _xor_bytes(body.encode('ascii')) != int(line[star + 1:star + 3], 16):
+			raise ChecksumError(line)
+	else:
+		body = line[1:]
+
+	cls, length, typed = decoder
+	values = body.split(',')
+	del values[0]
+
+	if len(values) < length:
+		values.extend([''] * (length - len(values)))
+	elif len(values) > length:
+		del values[length:]
+
+	for i, convert in typed:
+		v = values[i]
+		if v == '':
+			values[i] = None
+		else:
+			try:
+				values[i] = convert(v)
+			except Exception:
+				pass
+
+	values.insert(0, line[1:3])
+	return tuple.__new__(cls, values)
+
+def parse(line, wanted=None):
+	# decode() with pynmea2 as the fallback for every other sentence type.
+	# With `wanted` set, lines of other types are skipped without parsing.
+
+	msg = decode(line, wanted)
+	if msg is not None or wanted is not None:
+		return msg
+
+	import pynmea2
+	return pynmea2.parse(line)
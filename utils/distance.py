@@ -0,0 +1,92 @@
+from math import sin, cos, sqrt, atan2, radians, pi
+
+# Distance engines for the Sampler.
+#
+# An engine turns a position into its per-point terms once, when the point
+# enters the window, and measures distances between two sets of terms. Both
+# engines work on a sphere of the Sampler's planet radius, so against the
+# WGS84 ellipsoid they are off by up to ~0.6% depending on latitude and
+# heading; that is the same for every leg and does not matter for sampling.
+#
+#   haversine        exact great circle distance on the sphere
+#
+#   equirectangular  flat earth approximation using the mean of the cached
+#                    cos(lat) of both points. For legs up to 1 km (the
+#                    distance between 1 Hz fixes is under 100 m) below 85
+#                    degrees latitude it is within 1e-6 (1 mm per km) of the
+#                    haversine. The error grows with the square of the leg,
+#                    up to 0.02% at 30 km.
+#
+# benchmarks/distance.py checks both against WGS84 geodesics and the bounds.
+
+PLANET_RADIUS = 6373000
+
+class Haversine:
+
+	def __init__(self, radius=PLANET_RADIUS):
+		self.radius = radius
+
+	def terms(self, latitude, longitude):
+		phi = radians(latitude)
+		return (phi, radians(longitude), cos(phi))
+
+	def distance(self, a, b):
+		phi_a, lambda_a, cos_a = a
+		phi_b, lambda_b, cos_b = b
+
+		h = sin((phi_b - phi_a) / 2)**2 + cos_a * cos_b * sin((lambda_b - lambda_a) / 2)**2
+		return 2 * self.radius * atan2(sqrt(h), sqrt(1 - h))
+
+	def distances(self, latitude, longitude, prev_latitude, prev_longitude):
+		# NumPy version of distance over whole tracks, operation for operation
+		import numpy as np
+
+		phi_a = np.radians(prev_latitude)
+		phi_b = np.radians(latitude)
+		lambda_a = np.radians(prev_longitude)
+		lambda_b = np.radians(longitude)
+
+		h = np.sin((phi_b - phi_a) / 2)**2 + np.cos(phi_a) * np.cos(phi_b) * np.sin((lambda_b - lambda_a) / 2)**2
+		return 2 * self.radius * np.arctan2(np.sqrt(h), np.sqrt(1 - h))
+
+class Equirectangular:
+
+	def __init__(self, radius=PLANET_RADIUS):
+		self.radius = radius
+
+	def terms(self, latitude, longitude):
+		phi = radians(latitude)
+		return (phi, radians(longitude), cos(phi))
+
+	def distance(self, a, b):
+		phi_a, lambda_a, cos_a = a
+		phi_b, lambda_b, cos_b = b
+
+		d_lambda = lambda_b - lambda_a
+		if d_lambda > pi:
+			d_lambda -= 2 * pi
+		elif d_lambda < -pi:
+			d_lambda += 2 * pi
+
+		x = d_lambda * (cos_a + cos_b) / 2
+		y = phi_b - phi_a
+		return self.radius * sqrt(x * x + y * y)
+
+	def distances(self, latitude, longitude, prev_latitude, prev_longitude):
+		import numpy as np
+
+		phi_a = np.radians(prev_latitude)
+		phi_b = np.radians(latitude)
+
+		d_lambda = np.radians(longitude) - np.radians(prev_longitude)
+		d_lambda = np.where(d_lambda > pi, d_lambda - 2 * pi, d_lambda)
+		d_lambda = np.where(d_lambda < -pi, d_lambda + 2 * pi, d_lambda)
+
+		x = d_lambda * (np.cos(phi_a) + np.cos(phi_b)) / 2
+		y = phi_b - phi_a
+		return self.radius * np.sqrt(x * x + y * y)
+
+ENGINES = {
+	'haversine': Haversine,
+	'equirectangular': Equirectangular
+}
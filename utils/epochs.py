@@ -0,0 +1,199 @@
+import logging
+import time
+
+from utils.metrics import metrics
+
+# Epoch alignment of the fix sentences.
+#
+# GGA and RMC carry the UTC time of their epoch and open a new epoch when it
+# differs from the current one; GSA and VTG carry no time and belong to the
+# epoch opened last. A fix goes out exactly once per epoch:
+#
+#   complete    every sentence the receiver sends per epoch has arrived
+#   incomplete  the next epoch started or the deadline passed first, and
+#               at least GGA and RMC are there
+#   stale       as incomplete, but without GGA or RMC; nothing goes out
+#
+# Sentences that arrive once their epoch has gone out, timed or not, are
+# counted as late and dropped; an untimed one cannot be told apart from the
+# next epoch's, which would otherwise get the old course and speed. Which
+# sentences the receiver sends per epoch is learnt within REQUIRED_SENTENCES,
+# so a receiver without VTG does not hold every fix up to the deadline. A
+# sentence type is only no longer waited for once it has been missing for
+# ABSENT_EPOCHS epochs in a row, so a single lost sentence does not make
+# the following fixes go out without it.
+#
+# This relies on the receiver sending GGA or RMC before GSA and VTG within
+# each burst, as the Omega's receiver does. The caller marks the gap between
+# bursts with boundary() (the pipeline does on every read timeout). A burst
+# that starts with GSA or VTG instead is counted as out of order and logged
+# the first time; the open epoch goes out at the boundary and the untimed
+# sentences are kept for the epoch the burst's GGA or RMC opens.
+
+REQUIRED_SENTENCES = ('GGA', 'RMC', 'VTG', 'GSA')
+
+# Sentences a fix cannot do without
+MINIMUM_SENTENCES = frozenset(('GGA', 'RMC'))
+
+# Seconds an epoch may stay open after its first timed sentence
+EPOCH_DEADLINE = 0.5
+
+TIMED_SENTENCES = ('GGA', 'RMC')
+
+# Epochs in a row a sentence type must be missing before fixes stop
+# waiting for it
+ABSENT_EPOCHS = 3
+
+class EpochAssembler:
+
+	def __init__(self, blob, required=REQUIRED_SENTENCES, deadline=EPOCH_DEADLINE, clock=time.monotonic):
+		self.blob = blob
+		self._required = frozenset(required) | MINIMUM_SENTENCES
+		self._deadline = deadline
+		self._clock = clock
+
+		self.complete = 0
+		self.incomplete = 0
+		self.stale = 0
+		self.late = 0
+		self.out_of_order = 0
+		self.reset()
+
+	def reset(self):
+		self._expected = self._required
+		# Epochs in a row each required sentence type was missing from
+		self._absent = dict.fromkeys(self._required, 0)
+		# UTC time of the current epoch and when it opened
+		self._epoch = None
+		self._opened = None
+		self._emitted = False
+		# Whether a burst boundary came since the last sentence
+		self._boundary = False
+		# Sentence types added to the blob for the current epoch, and every
+		# type seen since it opened
+		self._types = set()
+		self._window = set()
+
+	def stats(self):
+		return {
+			'complete': self.complete,
+			'incomplete': self.incomplete,
+			'stale': self.stale,
+			'late': self.late,
+			'out_of_order': self.out_of_order,
+			'expected': sorted(self._expected)
+		}
+
+	def boundary(self):
+		# The gap between two bursts of sentences
+		self._boundary = True
+
+	def add(self, msg):
+		# Add a fix sentence; returns (minimal, full) when an epoch goes out
+		sentence_type = msg.sentence_type
+		fix = None
+		boundary = self._boundary
+		self._boundary = False
+
+		if sentence_type in TIMED_SENTENCES:
+			epoch = msg.timestamp
+			if epoch != self._epoch:
+				fix = self.close()
+				self.__open(epoch)
+			elif self._emitted:
+				self.late += 1
+				metrics.count('epochs_late')
+				return None
+
+		elif boundary and self._epoch is not None:
+			self.out_of_order += 1
+			metrics.count('epochs_out_of_order')
+			if self.out_of_order == 1:
+				logging.warning("%s starts a burst before GGA/RMC, closing epochs at burst boundaries" % sentence_type)
+			fix = self.close()
+			# Like untimed sentences before the first epoch, this one counts
+			# towards the epoch opened next
+			self._epoch = None
+			self._emitted = False
+
+		elif self._emitted:
+			# Seen for learning the expected set, but the fix has gone
+			self._window.add(sentence_type)
+			self.late += 1
+			metrics.count('epochs_late')
+			return None
+
+		self._window.add(sentence_type)
+		self.__add_to_blob(msg)
+		self._types.add(sentence_type)
+
+		if not self._emitted and self._epoch is not None and self._types >= self._expected:
+			self.complete += 1
+			metrics.count('epochs_complete')
+			return self.__emit()
+		return fix
+
+	def expire(self):
+		# Close the current epoch once its deadline has passed, e.g. on a
+		# read timeout; returns (minimal, full) if it goes out
+		if self._epoch is None or self._emitted:
+			return None
+		if self._clock() - self._opened < self._deadline:
+			return None
+		return self.close()
+
+	def close(self):
+		# Let the current epoch go out with what it has
+		if self._epoch is None or self._emitted:
+			return None
+
+		if self._types >= MINIMUM_SENTENCES:
+			self.incomplete += 1
+			metrics.count('epochs_incomplete')
+			return self.__emit()
+
+		self.stale += 1
+		metrics.count('epochs_stale')
+		self.blob.reset_fix()
+		self._types = set()
+		self._emitted = True
+		return None
+
+	def __open(self, epoch):
+		if self._window >= MINIMUM_SENTENCES:
+			for sentence_type in self._absent:
+				self._absent[sentence_type] = 0 if sentence_type in self._window else self._absent[sentence_type] + 1
+			self._expected = frozenset(
+				sentence_type for sentence_type, absent in self._absent.items()
+				if absent < ABSENT_EPOCHS
+			) | MINIMUM_SENTENCES
+		self._epoch = epoch
+		self._opened = self._clock()
+		self._emitted = False
+		# Untimed sentences before the first epoch count towards this one
+		self._window = set(self._types)
+
+	def __emit(self):
+		self._emitted = True
+		self._types = set()
+		return self.blob.get_base_information()
+
+	def __add_to_blob(self, msg):
+		blob = self.blob
+		sentence_type = msg.sentence_type
+
+		if sentence_type == 'GGA':
+			# Global Positioning System Fix Data
+			blob.add_fix_data(msg)
+
+		elif sentence_type == 'VTG':
+			# Track made good and ground speed
+			blob.add_track_and_ground_speed(msg)
+
+		elif sentence_type == 'RMC':
+			# Recommended minimum specific GPS/Transit data
+			blob.add_minimum_transit_data(msg)
+
+		elif sentence_type == 'GSA':
+			# GPS DOP and active satellites
+			blob.add_DOP(msg)
@@ -0,0 +1,245 @@
+import csv
+import datetime
+import glob
+import heapq
+import logging
+import os
+import pickle
+import shelve
+import zlib
+from xml.sax.saxutils import escape
+
+from utils.archive import HEADER, SEGMENT_SUFFIX, read_record, read_segment, segment_paths
+from utils.columnar import COLUMNAR_SUFFIX, ColumnarArchive, ColumnarWriter, archive_paths, shelve_keys, shelve_paths
+from utils.error_handling import error_message
+from utils.nmea import convert_lat_long
+
+# Bulk export of raw archives, see export.py for the command line.
+#
+# The input archives are split into units of work: one chunk of a columnar
+# archive, one segment file or one shelve. A worker process sorts its unit
+# by time and writes it to a part file of length/crc framed pickles (the
+# utils.archive record format). Only a columnar chunk is held whole; of a
+# segment or a shelve only the (timestamp, position) keys are sorted, and
+# the records are read back one at a time in that order. The parent then
+# streams a k-way merge of the part files into the output, which therefore
+# comes out in timestamp order whatever order the units finished in. At
+# most MERGE_FAN_IN part files are merged at once, more are first merged
+# in passes into larger part files.
+
+KNOTS = 0.514444
+
+# Part files open at once in a merge
+MERGE_FAN_IN = 32
+
+# CSV columns, one track point per row
+CSV_FIELDS = ['timestamp', 'time', 'latitude', 'longitude', 'speed', 'course', 'altitude', 'status', 'satellites', 'hdop']
+
+FORMATS = {
+	'.csv': 'csv',
+	'.gpx': 'gpx',
+	COLUMNAR_SUFFIX: 'columnar'
+}
+
+def input_units(paths):
+	# (kind, path, offset) units for archive files, archive prefixes and
+	# directories of archives (e.g. a mounted SD card)
+	for path in paths:
+		if os.path.isdir(path):
+			for unit in input_units(directory_archives(path)):
+				yield unit
+		elif path.endswith(COLUMNAR_SUFFIX):
+			with ColumnarArchive(path) as archive:
+				for entry in archive.chunks():
+					yield ('columnar', path, entry[2])
+		elif path.endswith(SEGMENT_SUFFIX):
+			yield ('segment', path, None)
+		elif '.db' in os.path.basename(path):
+			yield ('shelve', shelve_name(path), None)
+		else:
+			for segment in segment_paths(path):
+				yield ('segment', segment, None)
+
+def directory_archives(directory):
+	paths = archive_paths(directory)
+	paths += sorted(glob.glob(os.path.join(glob.escape(directory), '*' + SEGMENT_SUFFIX)))
+	paths += shelve_paths(directory)
+	return paths
+
+def shelve_name(path):
+	# The name to open a shelve by from any of its files
+	name = path.rsplit('.db', 1)[0] + '.db'
+	if name.endswith('.db.db'):
+		name = name[:-len('.db')]
+	return name
+
+def unit_records(kind, path, offset, t_start=None, t_end=None):
+	# (timestamp, record) of a unit in timestamp order
+	def selected(timestamp):
+		return (t_start is None or timestamp >= t_start) and (t_end is None or timestamp <= t_end)
+
+	if kind == 'columnar':
+		with ColumnarArchive(path) as archive:
+			records = [item for item in archive.read_chunk(offset, t_start, t_end) if selected(item[0])]
+		records.sort(key=lambda item: item[0])
+		for item in records:
+			yield item
+
+	elif kind == 'segment':
+		keys = sorted(
+			(timestamp, position) for position, (timestamp, _) in read_segment(path, offsets=True)
+			if selected(timestamp)
+		)
+		with open(path, 'rb') as f:
+			for _, position in keys:
+				yield read_record(f, position, path)
+
+	else:
+		with shelve.open(path, 'r') as raw:
+			for timestamp, key in shelve_keys(raw):
+				if selected(timestamp):
+					yield timestamp, raw[key]
+
+def track_point(timestamp, record):
+	# CSV_FIELDS of a raw record, None if it has no usable position
+	try:
+		fix = record['fix']
+		transit = record.get('transit_data', {})
+		speed = transit.get('spd_over_grnd')
+		return [
+			timestamp,
+			datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ'),
+			convert_lat_long(fix['lat'], fix['lat_dir']),
+			convert_lat_long(fix['lon'], fix['lon_dir']),
+			round(float(speed) * KNOTS, 3) if speed is not None else None,
+			transit.get('true_course'),
+			fix.get('altitude'),
+			transit.get('status'),
+			fix.get('num_sats'),
+			fix.get('horizontal_dil')
+		]
+	except Exception as e:
+		logging.debug(error_message(e))
+		return None
+
+def export_unit(task):
+	# Worker: write one unit sorted by time to its part file. Returns the
+	# part path and its item count.
+	(kind, path, offset), part_path, output_format, t_start, t_end = task
+
+	items = unit_records(kind, path, offset, t_start, t_end)
+	if output_format != 'columnar':
+		items = (
+			(timestamp, point) for timestamp, point in
+			((timestamp, track_point(timestamp, record)) for timestamp, record in items)
+			if point is not None
+		)
+
+	return part_path, write_part(items, part_path)
+
+def write_part(items, part_path):
+	count = 0
+	with open(part_path, 'wb') as part:
+		for item in items:
+			payload = pickle.dumps(item, pickle.HIGHEST_PROTOCOL)
+			part.write(HEADER.pack(len(payload), zlib.crc32(payload)))
+			part.write(payload)
+			count += 1
+	return count
+
+def merged(part_paths, scratch=None):
+	# Stream the sorted part files as one sequence in timestamp order. With
+	# more than MERGE_FAN_IN parts, groups of them are merged into part files
+	# in scratch first.
+	part_paths = list(part_paths)
+	passes = 0
+	while len(part_paths) > MERGE_FAN_IN:
+		passes += 1
+		merged_paths = []
+		for i in range(0, len(part_paths), MERGE_FAN_IN):
+			group = part_paths[i:i + MERGE_FAN_IN]
+			merged_path = os.path.join(scratch, 'merge_%d_%06d' % (passes, i))
+			write_part(merge_parts(group), merged_path)
+			for path in group:
+				os.remove(path)
+			merged_paths.append(merged_path)
+		part_paths = merged_paths
+	return merge_parts(part_paths)
+
+def merge_parts(part_paths):
+	return heapq.merge(*[read_segment(path) for path in part_paths], key=lambda item: item[0])
+
+def write_csv(items, path):
+	count = 0
+	with open(path, 'w', newline='') as f:
+		writer = csv.writer(f)
+		writer.writerow(CSV_FIELDS)
+		for _, row in items:
+			writer.writerow(['' if value is None else value for value in row])
+			count += 1
+	return count
+
+def write_gpx(items, path, name='Defender Tracker'):
+	count = 0
+	with open(path, 'w') as f:
+		f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+		f.write('<gpx version="1.1" creator="defender-tracker" xmlns="http://www.topografix.com/GPX/1/1">\n')
+		f.write('<trk><name>%s</name><trkseg>\n' % escape(name))
+		for _, row in items:
+			point = dict(zip(CSV_FIELDS, row))
+			if point['status'] not in (None, 'A'):
+				continue
+			f.write('<trkpt lat="%s" lon="%s">' % (point['latitude'], point['longitude']))
+			if point['altitude'] is not None:
+				f.write('<ele>%s</ele>' % point['altitude'])
+			f.write('<time>%s</time>' % point['time'])
+			if point['satellites'] not in (None, ''):
+				f.write('<sat>%d</sat>' % int(point['satellites']))
+			if point['hdop'] not in (None, ''):
+				f.write('<hdop>%s</hdop>' % point['hdop'])
+			f.write('</trkpt>\n')
+			count += 1
+		f.write('</trkseg></trk>\n</gpx>\n')
+	return count
+
+def write_columnar(items, path):
+	count = 0
+	with ColumnarWriter(path) as writer:
+		for timestamp, record in items:
+			writer.append(timestamp, record)
+			count += 1
+	return count
+
+WRITERS = {
+	'csv': write_csv,
+	'gpx': write_gpx,
+	'columnar': write_columnar
+}
+
+def export(paths, output, output_format=None, workers=None, t_start=None, t_end=None, scratch=None):
+	# Export the archives in paths to output, with a pool of `workers`
+	# processes (default: one per core). Returns the number of items written.
+	import multiprocessing
+	import shutil
+	import tempfile
+
+	if output_format is None:
+		output_format = FORMATS[os.path.splitext(output)[1]]
+
+	scratch = tempfile.mkdtemp(dir=scratch)
+	try:
+		tasks = [
+			(unit, os.path.join(scratch, 'part_%06d' % i), output_format, t_start, t_end)
+			for i, unit in enumerate(input_units(paths))
+		]
+
+		pool = multiprocessing.Pool(workers)
+		try:
+			parts = [part_path for part_path, count in pool.imap_unordered(export_unit, tasks) if count]
+		finally:
+			pool.close()
+			pool.join()
+
+		return WRITERS[output_format](merged(sorted(parts), scratch), output)
+	finally:
+		shutil.rmtree(scratch, ignore_errors=True)
@@ -0,0 +1,278 @@
+import gzip
+import logging
+import logging.handlers
+import os
+import queue
+import shutil
+import threading
+import time
+
+from utils.metrics import metrics
+
+# Logging for the SD card.
+#
+# Records go through a bounded queue (QueueHandler) to a listener thread, so
+# a log call never waits on the card. The listener's handler collects the
+# formatted lines and writes them in batches, once buffer_bytes are waiting,
+# flush_interval seconds after the oldest, or straight away for warnings and
+# worse. The log file is capped at max_bytes; full files are gzipped to
+# <path>.1.gz, <path>.2.gz, ... keeping backup_count of them, and every
+# start-up begins a new file.
+#
+# Before a record is queued, RateLimitFilter lets at most `burst` records
+# from the same logging call through per `interval` seconds. The rest are
+# dropped and counted, and the next record to get through from that call
+# says how many were left out. If the queue is full records are dropped and
+# counted too.
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(filename)s(%(lineno)d) - %(levelname)s - %(message)s'
+
+class RateLimitFilter(logging.Filter):
+
+	def __init__(self, burst=10, interval=60):
+		super().__init__()
+		self._burst = burst
+		self._interval = interval
+		self._lock = threading.Lock()
+		# (path, line, level): [window start, records, suppressed]
+		self._windows = {}
+		self.suppressed = 0
+
+	def filter(self, record):
+		key = (record.pathname, record.lineno, record.levelno)
+		with self._lock:
+			window = self._windows.get(key)
+			if window is None or record.created - window[0] >= self._interval:
+				suppressed = window[2] if window is not None else 0
+				self._windows[key] = [record.created, 1, 0]
+				if suppressed:
+					self.__summarise(record, suppressed, record.created - window[0])
+				return True
+
+			window[1] += 1
+			if window[1] <= self._burst:
+				return True
+
+			window[2] += 1
+			self.suppressed += 1
+		metrics.count('log_suppressed')
+		return False
+
+	@staticmethod
+	def __summarise(record, suppressed, seconds):
+		record.msg = '%s [%d similar messages suppressed in %d s]' % (record.getMessage(), suppressed, seconds)
+		record.args = None
+
+	def pending(self):
+		# (key, suppressed) of windows with records left out and not yet
+		# reported, e.g. to report on shutdown
+		with self._lock:
+			return [(key, window[2]) for key, window in self._windows.items() if window[2]]
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+	# QueueHandler that drops records rather than blocking or raising on a
+	# full queue
+
+	def __init__(self, q):
+		super().__init__(q)
+		self.dropped = 0
+
+	def enqueue(self, record):
+		try:
+			self.queue.put_nowait(record)
+		except queue.Full:
+			self.dropped += 1
+			metrics.count('log_dropped')
+
+class BatchingRotatingFileHandler(logging.Handler):
+	# Runs on the listener thread only, see above
+
+	def __init__(
+		self,
+		path,
+		max_bytes=1024 * 1024,
+		backup_count=5,
+		buffer_bytes=64 * 1024,
+		flush_interval=5
+	):
+		super().__init__()
+		self._path = path
+		self._max_bytes = max_bytes
+		self._backup_count = backup_count
+		self._buffer_bytes = buffer_bytes
+		self._flush_interval = flush_interval
+
+		self._buffer = []
+		self._buffered = 0
+		self._oldest = None
+		self._stream = None
+		self._size = 0
+		self.writes = 0
+		self.rotations = 0
+
+		if os.path.exists(path) and os.path.getsize(path) > 0:
+			self.__rotate()
+		self.__open()
+
+	def emit(self, record):
+		try:
+			line = self.format(record) + '\n'
+		except Exception:
+			self.handleError(record)
+			return
+
+		self._buffer.append(line)
+		self._buffered += len(line)
+		if self._oldest is None:
+			self._oldest = time.monotonic()
+
+		if record.levelno >= logging.WARNING or self._buffered >= self._buffer_bytes:
+			self.__write()
+		else:
+			self.flush(due_only=True)
+
+	@property
+	def buffered(self):
+		# Bytes of formatted lines waiting for the next write
+		return self._buffered
+
+	def flush(self, due_only=False):
+		if not self._buffer:
+			return
+		if due_only and time.monotonic() - self._oldest < self._flush_interval:
+			return
+		self.__write()
+
+	def __write(self):
+		data = ''.join(self._buffer)
+		self._buffer = []
+		self._buffered = 0
+		self._oldest = None
+
+		try:
+			self._stream.write(data)
+			self._stream.flush()
+			self.writes += 1
+			self._size += len(data)
+			if self._size >= self._max_bytes:
+				self._stream.close()
+				self.__rotate()
+				self.__open()
+		except Exception as e:
+			# Nowhere left to log to
+			print("Log write failed: %r" % e)
+
+	def __open(self):
+		self._stream = open(self._path, 'a')
+		self._size = self._stream.tell()
+
+	def __rotate(self):
+		# path -> path.1.gz, path.1.gz -> path.2.gz, ...
+		for n in range(self._backup_count - 1, 0, -1):
+			older = '%s.%d.gz' % (self._path, n)
+			if os.path.exists(older):
+				os.replace(older, '%s.%d.gz' % (self._path, n + 1))
+
+		if self._backup_count > 0:
+			tmp = '%s.1.gz.tmp' % self._path
+			with open(self._path, 'rb') as src, gzip.open(tmp, 'wb') as dst:
+				shutil.copyfileobj(src, dst)
+			os.replace(tmp, '%s.1.gz' % self._path)
+		os.remove(self._path)
+		self.rotations += 1
+
+	def close(self):
+		self.acquire()
+		try:
+			if self._stream is not None:
+				self.flush()
+				self._stream.close()
+				self._stream = None
+		finally:
+			self.release()
+		super().close()
+
+class FlushingQueueListener(logging.handlers.QueueListener):
+	# Wakes the handlers up every flush_interval seconds while the queue is
+	# idle, so batched lines do not wait for the next record
+
+	def __init__(self, q, *handlers, flush_interval=5):
+		super().__init__(q, *handlers, respect_handler_level=True)
+		self._flush_interval = flush_interval
+
+	def dequeue(self, block):
+		while True:
+			try:
+				return self.queue.get(block, self._flush_interval)
+			except queue.Empty:
+				for handler in self.handlers:
+					handler.acquire()
+					try:
+						handler.flush(due_only=True)
+					finally:
+						handler.release()
+
+class LogPipeline:
+	# Sets up the root logger as above. level can be changed at any time with
+	# set_level().
+
+	def __init__(
+		self,
+		path,
+		level=logging.INFO,
+		max_bytes=1024 * 1024,
+		backup_count=5,
+		buffer_bytes=64 * 1024,
+		flush_interval=5,
+		burst=10,
+		interval=60,
+		queue_size=10000,
+		format=LOG_FORMAT
+	):
+		self._queue = queue.Queue(queue_size)
+		self.file_handler = BatchingRotatingFileHandler(path, max_bytes, backup_count, buffer_bytes, flush_interval)
+		self.file_handler.setFormatter(logging.Formatter(format))
+
+		self.rate_limit = RateLimitFilter(burst, interval)
+		self.queue_handler = DroppingQueueHandler(self._queue)
+		self.queue_handler.addFilter(self.rate_limit)
+
+		self._listener = FlushingQueueListener(self._queue, self.file_handler, flush_interval=flush_interval)
+		self._level = level
+
+	def start(self):
+		root = logging.getLogger()
+		for handler in list(root.handlers):
+			root.removeHandler(handler)
+		root.addHandler(self.queue_handler)
+		self.set_level(self._level)
+		self._listener.start()
+		return self
+
+	def set_level(self, level):
+		# A level name ('DEBUG', 'INFO', ...) or number
+		if isinstance(level, str):
+			level = logging.getLevelName(level.upper())
+		logging.getLogger().setLevel(level)
+		self._level = level
+
+	def stats(self):
+		return {
+			'level': logging.getLevelName(self._level),
+			'queued': self._queue.qsize(),
+			'buffered': self.file_handler.buffered,
+			'dropped': self.queue_handler.dropped,
+			'suppressed': self.rate_limit.suppressed,
+			'writes': self.file_handler.writes,
+			'rotations': self.file_handler.rotations
+		}
+
+	def stop(self):
+		# Write everything queued, then what the rate limit still holds back
+		logging.getLogger().removeHandler(self.queue_handler)
+		self._listener.stop()
+
+		for (path, line, level), suppressed in self.rate_limit.pending():
+			record = logging.LogRecord('logs', level, path, line, '%d similar messages suppressed', (suppressed,), None)
+			self.file_handler.handle(record)
+		self.file_handler.close()
@@ -0,0 +1,110 @@
+import logging
+import os
+
+from utils.error_handling import error_message
+from utils.metrics import metrics
+
+# Memory budget of the client.
+#
+# The budget (bytes, memory_budget in /root/config) is split over the
+# in-memory buffers by BUDGET_SHARES, and each buffer is sized from its
+# share when it is created:
+#
+#   serial       BulkSerialSource ring
+#   lines ...    runtime stage queues, in items of ITEM_BYTES each; the
+#   points       points queue spills its oldest half to the outbox on disk
+#                when full, the others drop their oldest item
+#   logs         LogPipeline queue, dropping records once full
+#   raw_archive  RawArchiveWriter buffer, written out once full
+#   outbox       SQLite page cache of the outbox; points themselves are
+#                kept on disk
+#   publisher    points leased from the outbox for publishing
+#
+# The AWS SDK's offline publish queue is switched off altogether (see
+# utils/aws.py): while offline, points wait in the outbox on disk instead.
+# What is left of the budget is headroom for buffers of fixed size, such as
+# the sampler window and the GSV pages of the lock tracker. The interpreter
+# itself is not part of the budget; its resident size is reported as rss.
+#
+# Usage is estimated per component from item counts and buffer sizes, and
+# is published as memory.<component> gauges.
+
+# Default budget, 8 MiB
+DEFAULT_BUDGET = 8 * 1024 * 1024
+
+BUDGET_SHARES = {
+	'serial': 0.01,
+	'lines': 0.01,
+	'messages': 0.025,
+	'fixes': 0.03,
+	'raw': 0.3,
+	'points': 0.1,
+	'logs': 0.1,
+	'raw_archive': 0.01,
+	'outbox': 0.1,
+	'publisher': 0.05
+}
+
+# Estimated bytes each item takes in memory, measured on the synthetic
+# 10 Hz drive of benchmarks/synthetic.py
+ITEM_BYTES = {
+	'lines': 128,
+	'messages': 768,
+	'fixes': 4096,
+	'raw': 4096,
+	'points': 768,
+	'logs': 512,
+	'publisher': 768
+}
+
+def rss():
+	# Resident set size of the process in bytes, None where /proc is missing
+	try:
+		with open('/proc/self/statm') as f:
+			return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+	except (OSError, ValueError):
+		return None
+
+class MemoryBudget:
+
+	def __init__(self, total=DEFAULT_BUDGET, shares=BUDGET_SHARES):
+		self.total = int(total)
+		self.limits = {name: int(self.total * share) for name, share in shares.items()}
+		self._usage = {}
+
+	def limit(self, component):
+		# Bytes the component may use
+		return self.limits[component]
+
+	def items(self, component, minimum=1):
+		# Items of ITEM_BYTES the component may hold
+		return max(minimum, self.limits[component] // ITEM_BYTES[component])
+
+	def track(self, component, read):
+		# read() returns the component's current usage in bytes
+		self._usage[component] = read
+		metrics.gauge('memory.' + component, read)
+
+	def untrack(self, component):
+		self._usage.pop(component, None)
+		metrics.remove_gauge('memory.' + component)
+
+	def usage(self):
+		# {component: {'used': bytes, 'limit': bytes}}, plus the process rss
+		report = {}
+		for name, read in list(self._usage.items()):
+			try:
+				used = read()
+			except Exception as e:
+				logging.debug(error_message(e))
+				continue
+			report[name] = {'used': used, 'limit': self.limits.get(name)}
+		report['rss'] = {'used': rss(), 'limit': None}
+		return report
+
+	def over(self):
+		# Components using more than their limit
+		return sorted(
+			name for name, usage in self.usage().items()
+			if usage['limit'] is not None and usage['used'] is not None and usage['used'] > usage['limit']
+		)
@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import time
+from time import perf_counter
+
+from utils.error_handling import error_message
+
+# Lightweight per-stage instrumentation.
+#
+# Stages time themselves against the module level `metrics` registry:
+#
+#   start = metrics.clock()
+#   ...
+#   metrics.observe('decode', start)
+#
+# which records the duration in the stage's latency histogram and counts
+# the items it handled. Gauges (queue depths) are callables read when a
+# snapshot is taken. Instrumentation is off until metrics.enable(); while
+# off, clock() returns None and observe() returns straight away, so the
+# cost is one attribute check per call site. benchmarks/metrics.py measures
+# the overhead either way.
+#
+# Updates are not locked. Under the GIL a sample can very rarely be lost
+# when two threads record into the same histogram, which is fine for stats.
+
+# HDR style histogram: exact below 16 us, then 8 log-linear buckets per
+# power of two, i.e. every value is within 12.5% of its bucket's bounds
+SUB_BUCKET_BITS = 3
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+BUCKETS = 2 * SUB_BUCKETS + 40 * SUB_BUCKETS
+
+def bucket_index(value):
+	if value < 2 * SUB_BUCKETS:
+		return value
+	shift = value.bit_length() - SUB_BUCKET_BITS - 1
+	return SUB_BUCKETS + shift * SUB_BUCKETS + (value >> shift) - SUB_BUCKETS
+
+def bucket_upper_bound(index):
+	# Largest value that falls into bucket index
+	if index < 2 * SUB_BUCKETS:
+		return index
+	shift, sub = divmod(index - SUB_BUCKETS, SUB_BUCKETS)
+	return ((SUB_BUCKETS + sub + 1) << shift) - 1
+
+class Histogram:
+	# Latencies in microseconds, in fixed memory whatever the count. The
+	# buckets hold whole microseconds, the mean and max keep the fractions.
+
+	__slots__ = ('counts', 'count', 'total', 'max')
+
+	def __init__(self):
+		self.counts = [0] * BUCKETS
+		self.count = 0
+		self.total = 0.0
+		self.max = 0.0
+
+	def record(self, value):
+		self.counts[min(bucket_index(int(value)), BUCKETS - 1)] += 1
+		self.count += 1
+		self.total += value
+		if value > self.max:
+			self.max = value
+
+	def percentile(self, p):
+		if self.count == 0:
+			return 0
+
+		target = p * self.count
+		seen = 0
+		for index, count in enumerate(self.counts):
+			seen += count
+			if count and seen >= target:
+				return min(bucket_upper_bound(index), int(self.max))
+		return self.max
+
+	def summary(self):
+		return {
+			'count': self.count,
+			'mean': round(self.total / self.count, 2) if self.count else 0,
+			'p50': self.percentile(0.5),
+			'p90': self.percentile(0.9),
+			'p99': self.percentile(0.99),
+			'max': round(self.max, 2)
+		}
+
+class Metrics:
+
+	def __init__(self):
+		self.enabled = False
+		self._started = time.time()
+		self._counters = {}
+		self._histograms = {}
+		self._gauges = {}
+
+	def enable(self, enabled=True):
+		self.enabled = bool(enabled)
+
+	def clock(self):
+		# Start time for observe(), None while disabled
+		return perf_counter() if self.enabled else None
+
+	def observe(self, name, start, count=1):
+		# Record the time since start as one call of stage `name` that
+		# handled `count` items
+		if start is not None:
+			self.record(name, perf_counter() - start, count)
+
+	def record(self, name, seconds, count=1):
+		# Record a duration measured elsewhere, e.g. a publish until PUBACK
+		if not self.enabled:
+			return
+
+		try:
+			self._histograms[name].record(seconds * 1e6)
+			self._counters[name] += count
+		except KeyError:
+			self._histograms.setdefault(name, Histogram()).record(seconds * 1e6)
+			self._counters[name] = self._counters.get(name, 0) + count
+
+	def count(self, name, count=1):
+		if self.enabled:
+			self._counters[name] = self._counters.get(name, 0) + count
+
+	def gauge(self, name, read):
+		# Register a callable read on every snapshot
+		self._gauges[name] = read
+
+	def remove_gauge(self, name):
+		self._gauges.pop(name, None)
+
+	def snapshot(self):
+		gauges = {}
+		for name, read in list(self._gauges.items()):
+			try:
+				gauges[name] = read()
+			except Exception as e:
+				logging.debug(error_message(e))
+
+		return {
+			'time': int(time.time()),
+			'uptime': int(time.time() - self._started),
+			'enabled': self.enabled,
+			'counters': dict(self._counters),
+			'latency_us': {name: h.summary() for name, h in list(self._histograms.items())},
+			'gauges': gauges
+		}
+
+	def reset(self):
+		self._counters = {}
+		self._histograms = {}
+
+# The registry every stage reports to
+metrics = Metrics()
+
+def telemetry(snapshot, rates=None):
+	# Compact form of a snapshot for the MQTT telemetry message: counters,
+	# per second rates, [p50, p99, max] latencies and gauges
+	return {
+		't': snapshot['time'],
+		'up': snapshot['uptime'],
+		'c': snapshot['counters'],
+		'r': rates or {},
+		'l': {name: [s['p50'], s['p99'], s['max']] for name, s in snapshot['latency_us'].items()},
+		'g': snapshot['gauges']
+	}
+
+class StatsReporter:
+	# Writes the metrics snapshot to a JSON file (atomically, temp file +
+	# rename) and, with telemetry on, publishes its compact form through
+	# the MQTT client. Rates are items per second since the previous report.
+
+	def __init__(self, path, mqtt=None, telemetry=False, registry=metrics):
+		self._path = path
+		self._mqtt = mqtt
+		self._telemetry = telemetry
+		self._metrics = registry
+		self._previous = None
+
+	def set_telemetry(self, enabled):
+		self._telemetry = bool(enabled)
+
+	def report(self):
+		snapshot = self._metrics.snapshot()
+		snapshot['rates'] = self.__rates(snapshot)
+		self._previous = snapshot
+
+		self.__write(snapshot)
+
+		if self._telemetry and self._mqtt is not None:
+			try:
+				self._mqtt.send_telemetry(telemetry(snapshot, snapshot['rates']))
+			except Exception as e:
+				logging.error("Failed to send telemetry")
+				logging.error(error_message(e))
+
+		return snapshot
+
+	def __rates(self, snapshot):
+		previous = self._previous
+		if previous is None:
+			elapsed = snapshot['uptime']
+			before = {}
+		else:
+			elapsed = snapshot['time'] - previous['time']
+			before = previous['counters']
+
+		if elapsed <= 0:
+			return {}
+		return {
+			name: round((count - before.get(name, 0)) / elapsed, 2)
+			for name, count in snapshot['counters'].items()
+		}
+
+	def __write(self, snapshot):
+		tmp_path = self._path + '.tmp'
+		try:
+			with open(tmp_path, 'w') as f:
+				json.dump(snapshot, f, indent=1, sort_keys=True)
+			os.replace(tmp_path, self._path)
+		except Exception as e:
+			logging.error("Failed to write stats")
+			logging.error(error_message(e))
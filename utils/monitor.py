@@ -1,10 +1,15 @@
 import logging
-from math import sin, cos, sqrt, atan2, radians, sqrt
-from statistics import stdev
-
-import shelve
+from collections import deque
+from math import atan2, cos, degrees, sin, sqrt, radians
 
+from utils.distance import ENGINES, PLANET_RADIUS
 from utils.error_handling import error_message
+from utils.window import RollingWindow, WindowPoint, WindowSnapshot
+
+# process_batch looks BATCH_BLOCK rows ahead at first, doubling while none
+# of them emit, and widens its distance test by BATCH_SLACK metres
+BATCH_BLOCK = 64
+BATCH_SLACK = 1e-6
 
 class Sampler():
     
@@ -16,25 +21,55 @@ class Sampler():
         pause_distance=0.5,
         resume_distance=5,
         moving_average_length=20,
-        update_callback=None
+        update_callback=None,
+        snapshot_path=None,
+        snapshot_interval=60,
+        distance='haversine',
+        strategy='distance',
+        drift_tolerance=25,
+        max_interval=300,
+        velocity_fixes=5
         ):
 
+        # Distance engine from utils.distance, see there for the error bounds
+        self._distance = ENGINES[distance]()
+        self._first_leg = None
+
+        self._history = RollingWindow(moving_average_length)
+        self._recent = deque(maxlen=velocity_fixes)
         self.__reset()
-        
-        self._history = shelve.open(
-            'sampler_history'
-        )
 
         self._maximum_sampling_distance = maximum_sampling_distance
         self._minimum_sampling_distance = minimum_sampling_distance
         self._x_max = x_max
         
         self._update_callback = update_callback
+        self._emitted = None
         
         self._pause_distance = pause_distance
         self._resume_distance = resume_distance
         self._moving_average_length = moving_average_length
 
+        # 'distance' samples by the course/speed dependent distance below;
+        # 'dead_reckoning' assumes the receiver extrapolates the last sent
+        # point along its speed and course and only sends a point once the
+        # track drifts drift_tolerance metres from that, or max_interval
+        # seconds after the last one. A single fix's speed and course are
+        # too noisy to extrapolate, so a sent point carries the mean velocity
+        # of the last velocity_fixes fixes instead
+        if strategy not in ('distance', 'dead_reckoning'):
+            raise ValueError("Unknown sampling strategy %s" % strategy)
+        self._strategy = strategy
+        self._drift_tolerance = drift_tolerance
+        self._max_interval = max_interval
+
+        # The window lives in memory only; crash recovery comes from an
+        # optional snapshot written at most every snapshot_interval seconds
+        self._snapshot = None
+        if snapshot_path:
+            self._snapshot = WindowSnapshot(snapshot_path, snapshot_interval)
+            self.__restore(self._snapshot.load())
+
     def set_sampling_distance(self, distance):
         self._sampling_distance = distance
 
@@ -44,44 +79,85 @@ class Sampler():
     def set_resume_distance(self, distance):
         self._resume_distance = distance
 
+    def set_strategy(self, strategy):
+        if strategy not in ('distance', 'dead_reckoning'):
+            raise ValueError("Unknown sampling strategy %s" % strategy)
+        self._strategy = strategy
+
+    def set_drift_tolerance(self, distance):
+        self._drift_tolerance = distance
+
+    def set_max_interval(self, interval):
+        self._max_interval = interval
+
+    def set_velocity_fixes(self, count):
+        self._recent = deque(self._recent, maxlen=count)
+
     def set_moving_average_length(self, length):
         self._moving_average_length = length
+        self._history.resize(length)
 
-    def __reset(self):
-        self._planet_radius = 6373000
+    def snapshot(self):
+        # Write the current window state out now, e.g. on shutdown. __step
+        # also calls this on the event loop: the state is a few dozen points,
+        # written without fsync at most every snapshot_interval seconds, so
+        # it blocks the loop for well under a millisecond
+        if self._snapshot:
+            self._snapshot.save(self.__state())
 
-        self._prev = {
-            'latitude': 1000,
-            'longitude': 1000
+    def __state(self):
+        return {
+            'history': list(self._history),
+            'prev': self._prev,
+            'last_update': self._last_update,
+            'wait': self._wait,
+            'recent': list(self._recent)
         }
+
+    def __restore(self, state):
+        if not state:
+            return
+
+        try:
+            self._history.clear()
+            for point in state['history']:
+                self.__prepare(point)
+                self._history.append(point)
+            self._prev = self.__prepare(state['prev'])
+            self._last_update = self.__prepare(state['last_update'])
+            self._wait = state['wait']
+            # Snapshots from before velocity smoothing have no recent fixes
+            self._recent.clear()
+            for point in state.get('recent', []):
+                self._recent.append(self.__prepare(point))
+            logging.info("Sampler restored %d points from snapshot" % len(self._history))
+        except Exception as e:
+            logging.error(error_message(e))
+            self.__reset()
+
+    def __reset(self):
+        self._prev = self.__prepare(WindowPoint(None, 1000, 1000, 0, 0, 0, 0, 0))
         self._last_update = self._prev
-        self._last_n_points = [self._prev]
+        self._history.clear()
+        self._recent.clear()
 
         self._wait = False
         
-    def __distance_from_last_update(self, _point):
-        return self.__distance_between_points(_point, self._last_update)
-    
-    def __distance_from_prev(self, _point):
-        delta = self.__distance_between_points(_point, self._prev)
-        self._prev = _point
-        return delta
-        
-    def __distance_between_points(self, _next, _prev):
-        next_lat = radians(_next.get('latitude'))
-        next_lon = radians(_next.get('longitude'))
-        
-        prev_lat = radians(_prev.get('latitude'))
-        prev_lon = radians(_prev.get('longitude'))
-
-        dlon = next_lat - prev_lat
-        dlat = next_lon - prev_lon
+    def __prepare(self, _point):
+        # Per-point distance terms, worked out once as the point arrives
+        _point.terms = self._distance.terms(_point.latitude, _point.longitude)
+        return _point
 
-        a = sin(dlat / 2)**2 + cos(next_lat) * \
-            cos(prev_lat) * sin(dlon / 2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    def __distance_from_last_update(self, _point):
+        # The window's first point is measured against the last update on
+        # every fix until either of them changes
+        _leg = self._first_leg
+        if _leg is not None and _leg[0] is _point and _leg[1] is self._last_update:
+            return _leg[2]
 
-        return self._planet_radius * c
+        _distance = self._distance.distance(self._last_update.terms, _point.terms)
+        self._first_leg = (_point, self._last_update, _distance)
+        return _distance
     
     def __dynamic_sampling_function(self, x):
         minimum = self._minimum_sampling_distance
@@ -89,105 +165,92 @@ class Sampler():
         x_max = self._x_max
         return (minimum*x_max)/(x + ((x_max*minimum)/maximum))
 
-    def __calc_averages(self):
-        
-        sums = {
-            'distance_change': 0,
-            'speed': 0,
-            'cyclical_course': 0
-        }
-        
-        for key in list(self._history.keys()):
-            sums['distance_change'] += self._history.get(key).get('distance_change')
-            sums['speed'] += self._history.get(key).get('speed')
-            sums['cyclical_course'] += self._history.get(key).get('cyclical_course')
-            
-        return {key: sums.get(key)/max(len(self._history.keys()), 1) for key in sums.keys()}
-    
-    def __calc_deviations(self):
-        
-        if len(self._history.keys()) > 1:
-            sums = {
-                'distance_change': [],
-                'speed': [],
-                'cyclical_course': []
-            }
-
-            for key in list(self._history.keys()):
-                sums['distance_change'].append(self._history.get(key).get('distance_change'))
-                sums['speed'].append(self._history.get(key).get('speed'))
-                sums['cyclical_course'].append(self._history.get(key).get('cyclical_course'))
-
-            return { key: stdev(sums.get(key)) for key in sums.keys() }
-        else:
-            return {
-                'distance_change': 0,
-                'speed': 0,
-                'cyclical_course': 0
-            }
-        
-    def __history_append(self, _update):
+    def __call_callback(self, _point):
         
-        if len(self._history) < self._moving_average_length:
-            self._history[str(_update.get('timestamp'))] = _update
-        else:
-            keys = list(self._history.keys())
-            keys.sort(key=int)
-            del(self._history[keys[0]])
-            self._history[str(_update.get('timestamp'))] = _update
-            
-    def __call_callback(self, _update):
-        
-        self._last_update = _update
+        self._last_update = _point
         
-        latest_key = int(_update.get('timestamp'))
+        # Everything up to and including the reported point is now history
+        self._history.discard_until(_point.timestamp)
         
-        keys = list(self._history.keys())
-        keys.sort(key=int)
-        
-        for key in keys:
-            if int(key) <= latest_key:
-                del(self._history[str(key)])
+        if self._emitted is not None:
+            # process_batch collects indices instead of calling back
+            self._emitted.append(_point.index)
+            return
                 
         minimised = {
-            't': _update.get('timestamp'),
-            'lon': _update.get('longitude'),
-            'lat': _update.get('latitude'),
-            's': _update.get('speed'),
-            'c': _update.get('course'),
-            'a': _update.get('altitude')
+            't': _point.timestamp,
+            'lon': _point.longitude,
+            'lat': _point.latitude,
+            's': _point.speed,
+            'c': _point.course,
+            'a': _point.altitude
         }
         
         self._update_callback(minimised)
         
     def __process_history(self, _ratio):
         _sampling_distance = self.__dynamic_sampling_function(_ratio)
-                
-        keys = list(self._history.keys())
-        keys.sort(key=int)
-        
-        _historic_cum_delta = 0
         
-        prev_historic_update = {}
+        _historic_cum_delta = None
         
-        for key in keys:
-            historic_update = self._history.get(key)
+        # Copy the window as reporting a point discards the points before it
+        for historic_point in list(self._history):
             
-            if len(prev_historic_update) > 0:
+            if _historic_cum_delta is not None:
                 
-                prev_delta = self.__distance_between_points(historic_update, prev_historic_update)
-                
-                _historic_cum_delta += prev_delta
-                prev_historic_update = historic_update
+                # Window points are consecutive fixes, so the leg to the
+                # previous point is the distance_change recorded on arrival
+                _historic_cum_delta += historic_point.distance_change
 
                 if _historic_cum_delta > _sampling_distance:
                     logging.debug("Monitor - Normal")
-                    self.__call_callback(historic_update)
+                    self.__call_callback(historic_point)
                     _historic_cum_delta = 0
  
             else:
-                prev_historic_update = historic_update
-                _historic_cum_delta = self.__distance_from_last_update(historic_update)
+                _historic_cum_delta = self.__distance_from_last_update(historic_point)
+
+    def __predicted_drift(self, _point):
+        # Distance of the point from where the last update would be by now
+        # at its speed and course, on a local plane around the last update
+        _last = self._last_update
+        _travelled = (_last.speed or 0) * (_point.timestamp - _last.timestamp)
+        _course = radians(_last.course or 0)
+        _latitude = _last.latitude + _travelled*cos(_course)/PLANET_RADIUS/radians(1)
+        _longitude = _last.longitude + _travelled*sin(_course)/(PLANET_RADIUS*_last.terms[2])/radians(1)
+
+        _predicted = self._distance.terms(_latitude, _longitude)
+        return self._distance.distance(_predicted, _point.terms)
+
+    def __smoothed(self, _point):
+        # Copy of the point with the mean velocity of the recent fixes
+        _north = sum((p.speed or 0)*cos(radians(p.course or 0)) for p in self._recent)/len(self._recent)
+        _east = sum((p.speed or 0)*sin(radians(p.course or 0)) for p in self._recent)/len(self._recent)
+        return WindowPoint(
+            _point.timestamp,
+            _point.latitude,
+            _point.longitude,
+            sqrt(_north**2 + _east**2),
+            degrees(atan2(_east, _north)) % 360,
+            _point.altitude,
+            _point.cyclical_course,
+            _point.distance_change,
+            _point.index,
+            _point.terms
+        )
+
+    def __dead_reckon(self, _point):
+        self._recent.append(_point)
+
+        if self._last_update.timestamp is None:
+            logging.debug("Monitor - First point")
+            self.__call_callback(self.__smoothed(_point))
+        elif _point.timestamp - self._last_update.timestamp >= self._max_interval:
+            logging.debug("Monitor - Interval")
+            self.__call_callback(self.__smoothed(_point))
+        elif self.__predicted_drift(_point) > self._drift_tolerance:
+            logging.debug("Monitor - Drift")
+            self.__call_callback(self.__smoothed(_point))
 
     def process_update(self, _update):
         
@@ -196,25 +259,238 @@ class Sampler():
             if _update.get('status') != 'A':
                 return
             
-            _update['cyclical_course'] = (sin(radians(_update['course']))+1)/2
-            _update['distance_change'] = self.__distance_from_prev(_update)
+            _point = self.__prepare(WindowPoint.from_update(_update))
+            _point.cyclical_course = _update['cyclical_course'] = (sin(radians(_update['course']))+1)/2
+            _point.distance_change = _update['distance_change'] = self._distance.distance(self._prev.terms, _point.terms)
+
+            self.__step(_point)
+
+        except Exception as e:
+            logging.error(error_message(e))
+
+    def process_batch(self, arrays):
+        # Run a whole track through the sampler, e.g. to evaluate parameters
+        # over archived drives. arrays maps 'timestamp', 'latitude',
+        # 'longitude', 'speed', 'course' and optionally 'altitude' and
+        # 'status' to equal length sequences. Returns the indices of the
+        # points the streaming path would have emitted; the update callback
+        # is not called. The sampler state carries on from and into the
+        # streaming path.
+        import numpy as np
+
+        latitude = np.asarray(arrays['latitude'], dtype=float)
+        count = len(latitude)
+
+        valid = np.ones(count, dtype=bool)
+        if arrays.get('status') is not None:
+            valid = np.asarray(arrays['status']) == 'A'
+        index = np.flatnonzero(valid)
+
+        latitude = latitude[index]
+        longitude = np.asarray(arrays['longitude'], dtype=float)[index]
+        speed = np.asarray(arrays['speed'], dtype=float)[index]
+        course = np.asarray(arrays['course'], dtype=float)[index]
+        timestamp = np.asarray(arrays['timestamp'])[index]
+        if arrays.get('altitude') is not None:
+            altitude = np.asarray(arrays['altitude'], dtype=float)[index]
+        else:
+            altitude = np.zeros(len(index))
 
-            self.__history_append(_update)
+        # The per-point trigonometry, which dominates the streaming cost
+        prev_latitude = np.concatenate(([self._prev.latitude], latitude[:-1]))
+        prev_longitude = np.concatenate(([self._prev.longitude], longitude[:-1]))
+        distance_change = self._distance.distances(latitude, longitude, prev_latitude, prev_longitude)
+        cyclical_course = (np.sin(np.radians(course)) + 1) / 2
 
-            _averages = self.__calc_averages()
-            _deviations = self.__calc_deviations()
+        # Rows, in WindowPoint field order, are the points still in the
+        # window followed by the new ones
+        held = list(self._history)
+        columns = {'timestamp': timestamp, 'latitude': latitude, 'longitude': longitude,
+            'speed': speed, 'course': course, 'altitude': altitude,
+            'cyclical_course': cyclical_course, 'distance_change': distance_change, 'index': index}
+        if held:
+            for key, values in columns.items():
+                columns[key] = np.concatenate((np.array([getattr(p, key) for p in held]), values))
+
+        self._emitted = []
+        try:
+            if len(index) == 0:
+                pass
+            elif np.all(np.diff(columns['timestamp']) > 0):
+                self.__scan(columns, held)
+            else:
+                # A repeated or backwards timestamp replaces or keeps window
+                # points in ways the scan does not model, step every point
+                for row in list(zip(*(values.tolist() for values in columns.values())))[len(held):]:
+                    self.__step(self.__prepare(WindowPoint(*row)))
+            return np.array(self._emitted, dtype=int)
+        finally:
+            self._emitted = None
+
+    def __scan(self, columns, held):
+        # Between emissions the window only ever gains points, so its rolling
+        # statistics are worked out in NumPy for a block of rows at a time and
+        # only the rows that emit are handled one by one. They can differ from
+        # the streaming RunningStats in the last bits, which only matters for
+        # a value exactly at a threshold. The window and the recent fixes are
+        # rebuilt once at the end.
+        import numpy as np
+
+        total = len(columns['timestamp'])
+        rows = list(zip(*(values.tolist() for values in columns.values())))
+        points = held + [None]*(total - len(held))
+        recent = list(self._recent)
+        distance_change = columns['distance_change'].tolist()
+
+        def point(row):
+            if points[row] is None:
+                points[row] = self.__prepare(WindowPoint(*rows[row]))
+            return points[row]
+
+        def recent_until(row):
+            self._recent.clear()
+            self._recent.extend(recent)
+            self._recent.extend(point(r) for r in range(max(len(held), row - self._recent.maxlen), row))
+
+        # First row after the last emission and first row not yet decided
+        start = 0
+        row = len(held)
+        block = BATCH_BLOCK
+        while row < total:
+            end = min(total, row + block)
+
+            if self._strategy == 'dead_reckoning':
+                hits = np.flatnonzero(self.__drift_exceeded(columns, row, end))
+                if len(hits) == 0:
+                    row = end
+                    block *= 2
+                    continue
+                row += hits[0].item()
+                recent_until(row + 1)
+                self.__call_callback(self.__smoothed(point(row)))
+                start = row = row + 1
+                block = BATCH_BLOCK
+                continue
+
+            _average_distance, _sampling_distance, _leg, _stretch = self.__window_statistics(columns, start, row, end)
+            if self._wait:
+                emits = _average_distance > self._resume_distance
+            else:
+                # The stretch is widened against rounding, the loop below
+                # adds it up leg by leg like __process_history
+                emits = (_average_distance < self._pause_distance) | (_stretch > _sampling_distance - BATCH_SLACK)
+            hits = np.flatnonzero(emits)
+            if len(hits) == 0:
+                row = end
+                block *= 2
+                continue
 
-            if _averages.get('distance_change') < self._pause_distance and not self._wait:
+            hit = hits[0].item()
+            row += hit
+            if _average_distance[hit] < self._pause_distance and not self._wait:
+                self.__call_callback(point(row))
+                self._wait = True
+                start = row + 1
+            elif _average_distance[hit] > self._resume_distance and self._wait:
+                self.__call_callback(point(row))
+                self._wait = False
+                start = row + 1
+            elif not self._wait:
+                _historic_cum_delta = _leg[hit].item()
+                for r in range(max(start, row - self._history.capacity + 1) + 1, row + 1):
+                    _historic_cum_delta += distance_change[r]
+                    if _historic_cum_delta > _sampling_distance[hit]:
+                        self.__call_callback(point(r))
+                        _historic_cum_delta = 0
+                        start = r + 1
+            row += 1
+            block = BATCH_BLOCK
+
+        self._history.clear()
+        for r in range(max(start, total - self._history.capacity), total):
+            self._history.append(point(r))
+        if self._strategy == 'dead_reckoning':
+            recent_until(total)
+        self._prev = point(total - 1)
+
+        if self._snapshot and self._snapshot.due():
+            self.snapshot()
+
+    def __window_statistics(self, columns, start, first, end):
+        # Mean distance change, sampling distance, distance of the window's
+        # first point from the last update and the window's whole stretch
+        # from there for each row from first to end, given the window
+        # starts at row start
+        import numpy as np
+
+        length = self._history.capacity
+        window = np.arange(first, end)[:, None] + np.arange(1 - length, 1)
+        inside = window >= start
+        window = np.maximum(window, start)
+        counts = inside.sum(axis=1)
+
+        _distance_sum = np.where(inside, columns['distance_change'][window], 0).sum(axis=1)
+        _average_distance = _distance_sum / counts
+
+        cyclical_course = columns['cyclical_course'][window]
+        _course_mean = np.where(inside, cyclical_course, 0).sum(axis=1) / counts
+        _deviation = np.where(inside, cyclical_course - _course_mean[:, None], 0)
+        _stdev = np.sqrt((_deviation**2).sum(axis=1) / np.maximum(counts - 1, 1))
+        _stdev[counts < 2] = 0
+        _speed = np.where(inside, columns['speed'][window], 0).sum(axis=1) / counts
+        _sampling_distance = self.__dynamic_sampling_function(_stdev/(1 + np.sqrt(_speed)))
+
+        window_first = window[:, 0]
+        _leg = self._distance.distances(
+            columns['latitude'][window_first],
+            columns['longitude'][window_first],
+            self._last_update.latitude,
+            self._last_update.longitude
+        )
+        _stretch = _leg + _distance_sum - columns['distance_change'][window_first]
+        return _average_distance, _sampling_distance, _leg, _stretch
+
+    def __drift_exceeded(self, columns, first, end):
+        # __dead_reckon's tests for each row from first to end
+        import numpy as np
+
+        _last = self._last_update
+        if _last.timestamp is None:
+            return np.ones(end - first, dtype=bool)
+
+        _elapsed = columns['timestamp'][first:end] - _last.timestamp
+        _travelled = (_last.speed or 0) * _elapsed
+        _course = radians(_last.course or 0)
+        _latitude = _last.latitude + _travelled*cos(_course)/PLANET_RADIUS/radians(1)
+        _longitude = _last.longitude + _travelled*sin(_course)/(PLANET_RADIUS*_last.terms[2])/radians(1)
+        _drift = self._distance.distances(columns['latitude'][first:end], columns['longitude'][first:end], _latitude, _longitude)
+        return (_elapsed >= self._max_interval) | (_drift > self._drift_tolerance)
+
+    def __step(self, _point):
+        
+        try:
+            
+            self._prev = _point
+            self._history.append(_point)
+
+            _average_distance = self._history.mean('distance_change')
+
+            if self._strategy == 'dead_reckoning':
+                self.__dead_reckon(_point)
+            elif _average_distance < self._pause_distance and not self._wait:
                 logging.debug("Monitor - Pause")
-                self.__call_callback(_update)
+                self.__call_callback(_point)
                 self._wait = True
-            elif _averages.get('distance_change') > self._resume_distance and self._wait:
+            elif _average_distance > self._resume_distance and self._wait:
                 logging.debug("Monitor - Resume")
-                self.__call_callback(_update)
+                self.__call_callback(_point)
                 self._wait = False
             elif not self._wait:
-                _quotient = _deviations['cyclical_course']/(1 + sqrt(_averages['speed']))
+                _quotient = self._history.stdev('cyclical_course')/(1 + sqrt(self._history.mean('speed')))
                 self.__process_history(_quotient)
 
+            if self._snapshot and self._snapshot.due():
+                self.snapshot()
+
         except Exception as e:
             logging.error(error_message(e))
@@ -1,225 +1,139 @@
-import json
-import logging
-import copy
 import datetime
-import decimal
+from functools import lru_cache
+
+from utils.decoder import GGA, RMC, VTG, GSA, GSV
+
+# Proleptic ordinal of 1970-01-01
+EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+
+@lru_cache(maxsize=8)
+def midnight_epoch(d):
+	# Epoch time of 00:00 UTC on date d, there is one new date a day
+	return (d.toordinal() - EPOCH_ORDINAL) * 86400
 
 def get_epoch_time(t, d):
-	# get_epoch_time converts time data from SNS message into epoch time
+	# get_epoch_time converts time data from SNS message into epoch time.
+	# NMEA times are UTC, whatever the local time zone; fractions of a
+	# second are dropped.
 
-	return int(datetime.datetime.strptime(
-		str(d.day) + "-" + str(d.month) + "-" + str(d.year) + " " + str(t.hour) + ":" + str(t.minute) + ":" + str(t.second), '%d-%m-%Y %H:%M:%S').timestamp())
+	return midnight_epoch(d) + t.hour * 3600 + t.minute * 60 + t.second
 
 def convert_lat_long(value, dir):
-	# convert_lat_long takes the NMEA formatted location data and converts it into decimal latitude and longitude.
+	# convert_lat_long takes the NMEA formatted location data ([d]ddmm.mmmm) and converts it into decimal latitude and longitude,
+	# rounded to as many decimals as the minutes have.
+
+	dot = value.index('.')
+	comp = float(value[dot - 2:]) / 60 + int(value[:dot - 2])
+	if dir != 'E' and dir != 'N':
+		comp = -comp
+	return round(comp, len(value) - dot - 1)
+
+# Fields kept of each sentence type, in the order utils.decoder uses
+SATELLITE_FIELDS = GSV._fields[1:]
+FIX_FIELDS = GGA._fields[1:]
+TRACK_AND_SPEED_FIELDS = VTG._fields[1:]
+TRANSIT_DATA_FIELDS = RMC._fields[1:]
+DOP_FIELDS = GSA._fields[1:]
 
-	deg, dec = value.split('.')
-	precision = len(dec)
-	mins = deg[-2:] + '.' + dec
-	comp = float(mins) / 60 + float(deg[:-2])
-	comp = comp if (dir is 'E' or dir is 'N') else (comp / -1)
-	return round(float(str(comp)), precision)
+# GSV sequences run to at most 9 pages
+MAX_SATELLITE_PAGES = 9
+
+def sentence_fields(msg, fields):
+	# Field dict of a decoded sentence, from utils.decoder or pynmea2
+	if isinstance(msg, (GGA, RMC, VTG, GSA, GSV)):
+		return dict(msg.items())
+
+	values = {}
+	for key in fields:
+		try:
+			values[key] = getattr(msg, key)
+		except:
+			continue
+	return values
 
 class GNSS_Blob:
+	# Sentences of the current epoch. The decoded messages are immutable, so
+	# the blob keeps references to them rather than copying their fields, and
+	# reset() only drops those references. The nested dicts of `information`
+	# are built fresh from the messages when a fix is complete.
+
+	__slots__ = (
+		'satellites',
+		'fix',
+		'track_and_speed',
+		'dop',
+		'transit_data',
+		'locked'
+	)
 
 	def __init__(self):
+		self.satellites = {}
+		self.locked = False
 		self.reset()
 		
 	def reset(self):
-		self.information = {
-			'satellites': {},
-			'fix': {},
-			'track_and_speed': {},
-			'dop': {},
-			'transit_data': {}
+		self.satellites.clear()
+		self.reset_fix()
+
+	def reset_fix(self):
+		# Drop the fix sentences, keeping the satellites for the next epoch
+		self.fix = None
+		self.track_and_speed = None
+		self.dop = None
+		self.transit_data = None
+
+	@property
+	def information(self):
+		return {
+			'satellites': {
+				msg_num: sentence_fields(msg, SATELLITE_FIELDS)
+				for msg_num, msg in self.satellites.items()
+			},
+			'fix': sentence_fields(self.fix, FIX_FIELDS) if self.fix is not None else {},
+			'track_and_speed': sentence_fields(self.track_and_speed, TRACK_AND_SPEED_FIELDS) if self.track_and_speed is not None else {},
+			'dop': sentence_fields(self.dop, DOP_FIELDS) if self.dop is not None else {},
+			'transit_data': sentence_fields(self.transit_data, TRANSIT_DATA_FIELDS) if self.transit_data is not None else {}
 		}
 		
-	def add_satellite(self, msg):
-		self.locked = False
-		keys = [
-			'num_messages',
-			'msg_num',
-			'num_sv_in_view',
-			'sv_prn_num_1',
-			'elevation_deg_1',
-			'azimuth_1',
-			'snr_1'	,
-			'sv_prn_num_2',
-			'elevation_deg_2',
-			'azimuth_2',
-			'snr_2',
-			'sv_prn_num_3',
-			'elevation_deg_3',
-			'azimuth_3',
-			'snr_3',
-			'sv_prn_num_4',
-			'elevation_deg_4',
-			'azimuth_4',
-			'snr_4'
-		]
-		for key in keys:
-			try:
-				if msg.msg_num == 1:
-					self.reset()
-					
-				if msg.msg_num not in self.information['satellites']:
-					self.information['satellites'][msg.msg_num] = {}
-					
-				self.information['satellites'][msg.msg_num][key] = getattr(msg, key)
-			except Exception as e:
-				logging.error(e)
-				continue
-
-	def check_satellites(self):
+	def set_satellites(self, pages):
+		# A complete GSV sequence, e.g. from utils.satellites.LockTracker
+		self.satellites.clear()
+		for msg in pages:
+			self.satellites[msg.msg_num] = msg
 		self.locked = True
-		num_messages = -1
-		msg_num_sum = 0
-		
-		for sat_num, sat_info in self.information['satellites'].items():
-			try:
-				if int(sat_num) != int(sat_info['msg_num']):
-					self.locked = False
-				
-				if num_messages < 0:
-					num_messages = int(sat_info['num_messages'])
-				elif num_messages != int(sat_info['num_messages']):
-					self.locked = False
-					
-				msg_num_sum += int(sat_info['msg_num'])
-			except KeyError as ke:
-				print("KeyError")
-				print(ke)
-				self.locked = False
-				break
-			except Exception as e:
-				print("Error")
-				print(e)
-				self.locked = False
-				break
-			
-			
-		if msg_num_sum != sum(range(num_messages+1)) and len(self.information['satellites']) != num_messages:
-			self.locked = False
-			
-		return self.locked
-		
+
+	# Global Positioning System Fix Data
 	def add_fix_data(self, msg):
-		
-		keys = [
-			'timestamp',
-			'lat',
-			'lat_dir',
-			'lon',
-			'lon_dir',
-			'gps_qual',
-			'num_sats',
-			'horizontal_dil',
-			'altitude',
-			'altitude_units',
-			'geo_sep',
-			'geo_sep_units',
-			'age_gps_data',
-			'ref_station_id'
-		]
-		
-		for key in keys:
-			try:
-				self.information['fix'][key] = getattr(msg, key)
-			except:
-				continue
+		self.fix = msg
 				
 	# Track made good and ground speed
 	def add_track_and_ground_speed(self, msg):
-		
-		keys = [
-			'true_track',
-			'true_track_sym',
-			'mag_track',
-			'mag_track_sym',
-			'spd_over_grnd_kts',
-			'spd_over_grnd_kts_sym',
-			'spd_over_grnd_kmph',
-			'spd_over_grnd_kmph_sym',
-			'faa_mode'
-		]
-		
-		for key in keys:
-			try:
-				self.information['track_and_speed'][key] = getattr(msg, key)
-			except:
-				continue
+		self.track_and_speed = msg
 
 	# Recommended minimum specific GPS/Transit data
 	def add_minimum_transit_data(self, msg):
-		
-		keys = [
-			'timestamp',
-			'status',
-			'lat',
-			'lat_dir',
-			'lon',
-			'lon_dir',
-			'spd_over_grnd',
-			'true_course',
-			'datestamp',
-			'mag_variation',
-			'mag_var_dir'
-		]
-		
-		for key in keys:
-			try:
-				self.information['transit_data'][key] = getattr(msg, key)
-			except:
-				continue
+		self.transit_data = msg
 
 	# GPS DOP and active satellites
 	def add_DOP(self, msg):
-		keys = [
-			'mode',
-			'mode_fix_type',
-			'sv_id01',
-			'sv_id02',
-			'sv_id03',
-			'sv_id04',
-			'sv_id05',
-			'sv_id06',
-			'sv_id07',
-			'sv_id08',
-			'sv_id09',
-			'sv_id10',
-			'sv_id11',
-			'sv_id12',
-			'pdop',
-			'hdop',
-			'vdop'
-		]
-		
-		for key in keys:
-			try:
-				self.information['dop'][key] = getattr(msg, key)
-			except:
-				continue
+		self.dop = msg
 			
-	def is_complete(self):
-		if len(self.information['satellites']) > 0 and len(self.information['fix']) > 0 and len(self.information['track_and_speed']) and len(self.information['dop']) > 0 and len(self.information['transit_data']) > 0 and self.locked:
-			return True
-		else:
-			return False
-		
 	def get_base_information(self):
-		i = copy.deepcopy(self.information)
+		i = self.information
+		fix = self.fix
+		transit_data = self.transit_data
 		
 		minimal = {}
 		try:
-			minimal['timestamp'] = get_epoch_time(i["fix"]["timestamp"], i["transit_data"]["datestamp"])
-			minimal['longitude'] = convert_lat_long(i["fix"]["lat"], i["fix"]["lat_dir"])
-			minimal['latitude'] = convert_lat_long(i["fix"]["lon"], i["fix"]["lon_dir"])
-			minimal['status'] = str(i["transit_data"]["status"])
+			minimal['timestamp'] = get_epoch_time(fix.timestamp, transit_data.datestamp)
+			minimal['latitude'] = convert_lat_long(fix.lat, fix.lat_dir)
+			minimal['longitude'] = convert_lat_long(fix.lon, fix.lon_dir)
+			minimal['status'] = str(transit_data.status)
 	
 			# Change it into m/s
-			minimal['speed'] = float(i["transit_data"]["spd_over_grnd"])*0.514444
-			minimal['course'] = float(i["transit_data"]["true_course"])
-			minimal['altitude'] = float(i["fix"]["altitude"])
+			minimal['speed'] = float(transit_data.spd_over_grnd)*0.514444
+			minimal['course'] = float(transit_data.true_course)
+			minimal['altitude'] = float(fix.altitude)
 		except Exception as e:
 			print(i)
 			print(e)
@@ -227,16 +141,3 @@ class GNSS_Blob:
 		
 		self.reset()
 		return minimal, i
-				
-				
-			
-			
-		
-		
-		
-		
-		
-		
-		
-		
-		
\ No newline at end of file
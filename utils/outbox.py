@@ -0,0 +1,206 @@
+import logging
+import os
+import pickle
+import shutil
+import sqlite3
+import threading
+import time
+
+from utils.error_handling import error_message
+
+# Transactional outbox for sampled points, backed by SQLite in WAL mode.
+#
+# Points are enqueued in bulk, publishers lease the oldest N items for a
+# visibility timeout and acknowledge them by id range once delivered. Each
+# lease carries a token, so acking a range never touches items in it that
+# belong to another publisher's lease. An item whose lease expires
+# (publisher died, publish failed) becomes visible again with its attempt
+# count increased. The outbox holds at most max_items; on overflow the
+# oldest items are dropped first so the newest positions survive a long
+# coverage gap. cache_bytes caps SQLite's page cache, the memory it uses.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outbox (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	payload BLOB NOT NULL,
+	enqueued_at REAL NOT NULL,
+	leased_until REAL NOT NULL DEFAULT 0,
+	lease INTEGER NOT NULL DEFAULT 0,
+	attempts INTEGER NOT NULL DEFAULT 0
+)
+"""
+
+class Outbox:
+
+	def __init__(self, path, max_items=100000, cache_bytes=None):
+		self._max_items = max_items
+		self._lock = threading.Lock()
+		self._available = threading.Condition(self._lock)
+		self._lease = int(time.time() * 1000)
+		self.dropped = 0
+
+		directory = os.path.dirname(path)
+		if directory and not os.path.exists(directory):
+			os.makedirs(directory)
+
+		self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+		self._db.execute('PRAGMA journal_mode=WAL')
+		# WAL keeps the database consistent on power loss; NORMAL only risks
+		# the last transactions, which the publisher then never saw either
+		self._db.execute('PRAGMA synchronous=NORMAL')
+		if cache_bytes is not None:
+			# A negative cache_size is in KiB rather than pages
+			self._db.execute('PRAGMA cache_size=%d' % -max(1, cache_bytes // 1024))
+		self._db.execute(SCHEMA)
+
+		# Leases do not survive a restart
+		self._db.execute('UPDATE outbox SET leased_until = 0 WHERE leased_until > 0')
+
+	def __len__(self):
+		with self._lock:
+			return self._db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+
+	def put(self, item):
+		self.put_many([item])
+
+	def put_many(self, items):
+		now = time.time()
+		rows = [(pickle.dumps(item, pickle.HIGHEST_PROTOCOL), now) for item in items]
+
+		with self._available:
+			self._db.execute('BEGIN IMMEDIATE')
+			try:
+				self._db.executemany('INSERT INTO outbox (payload, enqueued_at) VALUES (?, ?)', rows)
+				self.__enforce_limit()
+				self._db.execute('COMMIT')
+			except Exception:
+				self._db.execute('ROLLBACK')
+				raise
+			self._available.notify_all()
+
+	def __enforce_limit(self):
+		count = self._db.execute('SELECT COUNT(*) FROM outbox').fetchone()[0]
+		excess = count - self._max_items
+		if excess > 0:
+			self._db.execute(
+				'DELETE FROM outbox WHERE id IN (SELECT id FROM outbox ORDER BY id LIMIT ?)',
+				(excess,)
+			)
+			self.dropped += excess
+			logging.warning("Outbox full, dropped %d oldest points" % excess)
+
+	def wait(self, count, max_age, timeout=None):
+		# Block until count items are visible or the oldest visible item is
+		# max_age seconds old; returns False if timeout expires first.
+		deadline = None if timeout is None else time.monotonic() + timeout
+
+		with self._available:
+			while True:
+				now = time.time()
+				visible, oldest = self._db.execute(
+					'SELECT COUNT(*), MIN(enqueued_at) FROM outbox WHERE leased_until <= ?',
+					(now,)
+				).fetchone()
+
+				if visible >= count or (visible > 0 and now - oldest >= max_age):
+					return True
+
+				wait = max_age if visible == 0 else max(0, oldest + max_age - now)
+				if deadline is not None:
+					remaining = deadline - time.monotonic()
+					if remaining <= 0:
+						return False
+					wait = min(wait, remaining)
+
+				self._available.wait(wait)
+
+	def lease(self, n, visibility_timeout=120):
+		# Lease the oldest n visible items, returns (token, [(id, item, attempts)])
+		now = time.time()
+
+		with self._lock:
+			self._lease += 1
+			token = self._lease
+
+			self._db.execute('BEGIN IMMEDIATE')
+			try:
+				rows = self._db.execute(
+					'SELECT id, payload, attempts FROM outbox WHERE leased_until <= ? ORDER BY id LIMIT ?',
+					(now, n)
+				).fetchall()
+				if rows:
+					self._db.execute(
+						'UPDATE outbox SET leased_until = ?, lease = ?, attempts = attempts + 1 WHERE id BETWEEN ? AND ? AND leased_until <= ?',
+						(now + visibility_timeout, token, rows[0][0], rows[-1][0], now)
+					)
+				self._db.execute('COMMIT')
+			except Exception:
+				self._db.execute('ROLLBACK')
+				raise
+
+		leased = []
+		for item_id, payload, attempts in rows:
+			try:
+				leased.append((item_id, pickle.loads(payload), attempts + 1))
+			except Exception as e:
+				logging.error("Dropping unreadable outbox item %d" % item_id)
+				logging.error(error_message(e))
+				self.ack(token, item_id, item_id)
+		return token, leased
+
+	def ack(self, token, first_id, last_id):
+		# Delete the delivered items first_id..last_id (inclusive) of a lease
+		with self._lock:
+			self._db.execute(
+				'DELETE FROM outbox WHERE id BETWEEN ? AND ? AND lease = ?',
+				(first_id, last_id, token)
+			)
+
+	def release(self, token, first_id, last_id):
+		# Make leased items visible again straight away for a retry
+		with self._available:
+			self._db.execute(
+				'UPDATE outbox SET leased_until = 0 WHERE id BETWEEN ? AND ? AND lease = ?',
+				(first_id, last_id, token)
+			)
+			self._available.notify_all()
+
+	def close(self):
+		with self._lock:
+			self._db.close()
+
+def migrate_persistqueue(path, outbox, batch_size=500):
+	# Move points still waiting in a persistqueue.Queue from before the
+	# outbox into it, batch_size at a time, then remove the old queue
+	if not os.path.isdir(path):
+		return 0
+
+	try:
+		from persistqueue import Queue
+		from persistqueue.exceptions import Empty
+	except ImportError:
+		logging.error("persistqueue missing, cannot migrate %s" % path)
+		return 0
+
+	old = Queue(path=path)
+	migrated = 0
+	done = False
+	while not done:
+		items = []
+		while len(items) < batch_size:
+			try:
+				items.append(old.get(block=False))
+			except Empty:
+				done = True
+				break
+
+		if items:
+			outbox.put_many(items)
+			# Only now the old queue may forget them
+			for item in items:
+				old.task_done()
+			migrated += len(items)
+
+	shutil.rmtree(path, ignore_errors=True)
+	logging.info("Migrated %d points from %s to the outbox" % (migrated, path))
+	return migrated
@@ -0,0 +1,155 @@
+import logging
+import time
+
+from utils.nmea import GNSS_Blob
+from utils import decoder
+from utils.epochs import EPOCH_DEADLINE, REQUIRED_SENTENCES, EpochAssembler
+from utils.error_handling import error_message
+from utils.metrics import metrics
+from utils.satellites import LockTracker
+
+# Sentences worth decoding while waiting for a lock and once locked
+LOCK_SENTENCES = ('GSV',)
+FIX_SENTENCES = ('GGA', 'VTG', 'RMC', 'GSA')
+
+# Seconds without a sentence before the lock counts as lost
+LOCK_TIMEOUT = 5
+
+class Pipeline:
+	# Serial line -> GNSS_Blob -> Sampler (-> raw archive) path of the client.
+	# The input source only needs a serial.Serial style readline(), so the same
+	# pipeline runs against the GNSS receiver or a replayed drive.
+
+	def __init__(
+		self,
+		sampler,
+		raw_archive=None,
+		lock_timeout=LOCK_TIMEOUT,
+		required=REQUIRED_SENTENCES,
+		epoch_deadline=EPOCH_DEADLINE,
+		started=None
+	):
+		self.sampler = sampler
+		self.raw_archive = raw_archive
+		self.blob = GNSS_Blob()
+		self.lock = LockTracker()
+		self.epochs = EpochAssembler(self.blob, required, epoch_deadline)
+		self.locked = False
+		self.lock_timeout = lock_timeout
+		self._last_message = None
+
+		# Seconds from started (process start, say) until the first fix was
+		# recorded, None until then
+		self.started = time.monotonic() if started is None else started
+		self.time_to_first_fix = None
+
+	def run(self, source, stopped=lambda: False):
+		# Read lines from source until it is exhausted or stopped() is true
+		while not stopped():
+			try:
+				# Read data line from serial
+				start = metrics.clock()
+				line = source.readline()
+				metrics.observe('serial_read', start)
+				if line is None:
+					break
+				self.process_line(line.decode('ascii', 'replace').strip())
+			except Exception as e:
+				logging.error("Exception in Main")
+				logging.error(error_message(e))
+				continue
+
+	def process_line(self, line):
+		if len(line) <= 6:
+			fix = self.timeout()
+			if fix is not None:
+				self.process_fix(*fix)
+			elif self.raw_archive is not None:
+				# Keeps the archive's flush interval while no fixes arrive
+				self.raw_archive.tick()
+			return
+
+		start = metrics.clock()
+		try:
+			# Other sentence types are dropped before any parsing
+			msg = decoder.parse(line, self.wanted())
+		except Exception as e:
+			metrics.count('decode_errors')
+			logging.error(error_message(e))
+			return
+		metrics.observe('decode', start)
+
+		if msg is None:
+			return
+
+		start = metrics.clock()
+		fix = self.assemble(msg)
+		metrics.observe('assemble', start)
+		if fix is not None:
+			self.process_fix(*fix)
+
+	def wanted(self):
+		# Sentence types the assembler needs in its current lock state; once
+		# locked the satellites in view still go into each fix's record
+		return LOCK_SENTENCES + FIX_SENTENCES if self.locked else LOCK_SENTENCES
+
+	def timeout(self):
+		# A read timeout is only the gap between bursts: it closes an epoch
+		# past its deadline, returning (minimal, full) if that makes a fix.
+		# The lock is lost once nothing has arrived for lock_timeout seconds.
+		self.epochs.boundary()
+		if not self.locked or self._last_message is None:
+			return None
+		if time.monotonic() - self._last_message > self.lock_timeout:
+			logging.info("No GNSS data for %d s, lock lost" % self.lock_timeout)
+			self.locked = False
+			self.lock.reset()
+			self.epochs.reset()
+			self.blob.reset()
+			return None
+		return self.epochs.expire()
+
+	def assemble(self, msg):
+		# Add a decoded sentence, returns (minimal, full) once an epoch's fix
+		# goes out and None otherwise
+		blob = self.blob
+		self._last_message = time.monotonic()
+
+		if msg.sentence_type == 'GSV':
+			# GPS Satellites in view, tracked per constellation
+			pages = self.lock.add(msg)
+			if pages is not None and not blob.satellites:
+				# The record keeps the first complete set of the epoch
+				blob.set_satellites(pages)
+			self.locked = self.lock.locked
+
+		elif self.locked:
+			return self.epochs.add(msg)
+
+		return None
+
+	def process_fix(self, minimal, full):
+		start = metrics.clock()
+		self.sampler.process_update(minimal)
+		metrics.observe('sampler', start)
+
+		if self.raw_archive is None:
+			self.recorded()
+			return
+
+		start = metrics.clock()
+		try:
+			self.raw_archive.append(minimal.get('timestamp'), full)
+			self.recorded()
+		except Exception as e:
+			logging.error("Failed to persit raw data")
+			logging.error(error_message(e))
+		metrics.observe('raw_persist', start)
+
+	def recorded(self):
+		# A fix has reached the raw archive (or the sampler, without one)
+		if self.time_to_first_fix is not None:
+			return
+		self.time_to_first_fix = time.monotonic() - self.started
+		metrics.record('time_to_first_fix', self.time_to_first_fix)
+		logging.info("First fix recorded %.1f s after start" % self.time_to_first_fix)
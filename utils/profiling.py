@@ -0,0 +1,223 @@
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+from utils.error_handling import error_message
+
+# Names of the profilers' own threads, left out of the CPU samples
+PROFILER_THREADS = ('profiler', 'allocations')
+
+# On-demand profiling for devices in the field, see start.py for the signals.
+#
+# SamplingProfiler samples the stacks of every thread a fixed number of
+# times per second from a background thread and writes them in collapsed
+# stack format (one "frame;frame;frame count" line per distinct stack, as
+# read by flamegraph.pl and speedscope). AllocationProfiler traces
+# allocations with tracemalloc and writes the top allocation sites.
+#
+# Both are safe to leave to run: they stop by themselves after
+# max_duration seconds. The sampler keeps at most max_stacks distinct
+# stacks (further ones are counted as "[other]"), and the allocation
+# tracer stops early once tracemalloc's own memory passes max_memory.
+# Stopping only sets an event, but starting starts a thread and, for the
+# allocation tracer, tracemalloc. Python runs signal handlers on the main
+# thread between bytecodes, so toggling from one is safe as long as the
+# interrupted code is not itself starting a thread; start.py calls the
+# toggles on the event loop while the runtime runs. The reports are written
+# from the background thread.
+
+class SamplingProfiler:
+
+	def __init__(
+		self,
+		directory,
+		interval=0.01,
+		max_duration=60,
+		max_stacks=2000,
+		max_depth=32,
+		on_report=None
+	):
+		self._directory = directory
+		self._interval = interval
+		self._max_duration = max_duration
+		self._max_stacks = max_stacks
+		self._max_depth = max_depth
+		self._on_report = on_report
+		self._stop = threading.Event()
+		self._thread = None
+
+	@property
+	def running(self):
+		return self._thread is not None and self._thread.is_alive()
+
+	def toggle(self):
+		if self.running:
+			self.stop()
+		else:
+			self.start()
+
+	def start(self):
+		if self.running:
+			return
+		self._stop.clear()
+		self._thread = threading.Thread(target=self.__run, name='profiler', daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+
+	def __run(self):
+		logging.info("Sampling profiler started")
+		stacks = Counter()
+		samples = 0
+		names = {}
+
+		started = time.monotonic()
+		deadline = started + self._max_duration
+		try:
+			while not self._stop.wait(self._interval) and time.monotonic() < deadline:
+				if len(names) != threading.active_count():
+					names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+				for thread_id, frame in sys._current_frames().items():
+					name = names.get(thread_id, str(thread_id))
+					if name in PROFILER_THREADS:
+						continue
+					stack = self.__collapse(name, frame)
+					if stack not in stacks and len(stacks) >= self._max_stacks:
+						stack = '[other]'
+					stacks[stack] += 1
+				samples += 1
+
+			path = os.path.join(self._directory, 'profile_%d.collapsed' % int(time.time()))
+			with open(path, 'w') as f:
+				for stack, count in stacks.most_common():
+					f.write('%s %d\n' % (stack, count))
+
+			summary = {
+				'type': 'cpu',
+				'seconds': round(time.monotonic() - started, 1),
+				'samples': samples,
+				'top': self.__top_functions(stacks, 10),
+				'file': path
+			}
+			logging.info("Sampling profiler wrote %d samples to %s" % (samples, path))
+			if self._on_report is not None:
+				self._on_report(summary)
+
+		except Exception as e:
+			logging.error("Sampling profiler failed")
+			logging.error(error_message(e))
+
+	def __collapse(self, thread_name, frame):
+		frames = []
+		while frame is not None and len(frames) < self._max_depth:
+			code = frame.f_code
+			frames.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+			frame = frame.f_back
+		frames.append(thread_name)
+		return ';'.join(reversed(frames))
+
+	@staticmethod
+	def __top_functions(stacks, count):
+		# Share of the samples each function was running in (the leaf frame)
+		total = sum(stacks.values()) or 1
+		leaves = Counter()
+		for stack, samples in stacks.items():
+			leaves[stack.rsplit(';', 1)[-1]] += samples
+		return [[name, round(100 * samples / total, 1)] for name, samples in leaves.most_common(count)]
+
+class AllocationProfiler:
+
+	def __init__(
+		self,
+		directory,
+		max_duration=60,
+		max_memory=4 * 1024 * 1024,
+		frames=5,
+		top=25,
+		on_report=None
+	):
+		self._directory = directory
+		self._max_duration = max_duration
+		self._max_memory = max_memory
+		self._frames = frames
+		self._top = top
+		self._on_report = on_report
+		self._stop = threading.Event()
+		self._thread = None
+
+	@property
+	def running(self):
+		return self._thread is not None and self._thread.is_alive()
+
+	def toggle(self):
+		if self.running:
+			self.stop()
+		else:
+			self.start()
+
+	def start(self):
+		if self.running or tracemalloc.is_tracing():
+			return
+		self._stop.clear()
+		tracemalloc.start(self._frames)
+		self._thread = threading.Thread(target=self.__run, name='allocations', daemon=True)
+		self._thread.start()
+
+	def stop(self):
+		self._stop.set()
+
+	def __run(self):
+		logging.info("Allocation tracing started")
+		started = time.monotonic()
+		deadline = started + self._max_duration
+		try:
+			while not self._stop.wait(1) and time.monotonic() < deadline:
+				if tracemalloc.get_tracemalloc_memory() > self._max_memory:
+					logging.warning("Allocation tracing stopped early at its memory limit")
+					break
+
+			snapshot = tracemalloc.take_snapshot()
+			current, peak = tracemalloc.get_traced_memory()
+		except Exception as e:
+			logging.error("Allocation tracing failed")
+			logging.error(error_message(e))
+			return
+		finally:
+			tracemalloc.stop()
+
+		try:
+			snapshot = snapshot.filter_traces((
+				tracemalloc.Filter(False, tracemalloc.__file__),
+				tracemalloc.Filter(False, '<frozen *>')
+			))
+			statistics = snapshot.statistics('lineno')[:self._top]
+
+			path = os.path.join(self._directory, 'allocations_%d.txt' % int(time.time()))
+			with open(path, 'w') as f:
+				f.write('traced %d KiB, peak %d KiB over %.1f s\n' % (current / 1024, peak / 1024, time.monotonic() - started))
+				for stat in statistics:
+					f.write('%s\n' % stat)
+					for line in stat.traceback.format():
+						f.write('    %s\n' % line)
+
+			summary = {
+				'type': 'memory',
+				'seconds': round(time.monotonic() - started, 1),
+				'current_kib': current // 1024,
+				'peak_kib': peak // 1024,
+				'top': [['%s:%d' % (os.path.basename(stat.traceback[0].filename), stat.traceback[0].lineno), stat.size // 1024, stat.count] for stat in statistics[:10]],
+				'file': path
+			}
+			logging.info("Allocation tracing wrote %s" % path)
+			if self._on_report is not None:
+				self._on_report(summary)
+
+		except Exception as e:
+			logging.error("Allocation tracing failed")
+			logging.error(error_message(e))
@@ -0,0 +1,117 @@
+import logging
+import time
+
+from utils.aws import MAX_PAYLOAD_BYTES
+from utils.error_handling import error_message
+from utils.metrics import metrics
+
+class BatchPublisher:
+	# Drains sampled points from the outbox and publishes them to AWS in
+	# batches rather than one message per point.
+	#
+	# A batch goes out once max_count points are waiting, or once the oldest
+	# waiting point is max_age seconds old. A lease is split so no message
+	# exceeds max_bytes (capped under the AWS IoT limit). Each message's items
+	# are acknowledged on the outbox only after its PUBACK has arrived; on a
+	# failed publish the rest of the lease is released and retried after a
+	# backoff, so points stay on the SD card until delivered.
+
+	def __init__(
+		self,
+		outbox,
+		mqtt,
+		max_count=50,
+		max_bytes=64 * 1024,
+		max_age=30,
+		lease_size=500,
+		visibility_timeout=300,
+		retry_backoff=(1, 60)
+	):
+		self._outbox = outbox
+		self._mqtt = mqtt
+		self._max_count = max_count
+		self._max_bytes = min(max_bytes, MAX_PAYLOAD_BYTES)
+		self._max_age = max_age
+		self._lease_size = max(lease_size, max_count)
+		self._visibility_timeout = visibility_timeout
+		self._retry_backoff = retry_backoff
+		self._delay = retry_backoff[0]
+		# Points of the current lease held in memory
+		self.leased = 0
+
+	def run(self, stopped=lambda: False):
+		while not stopped():
+			self.poll(timeout=1)
+
+	def poll(self, timeout=None):
+		# Wait for a batch to be due, then publish everything leased
+		if not getattr(self._mqtt, 'connected', True):
+			# Points stay in the outbox until MQTT is up
+			time.sleep(timeout or 1)
+			return
+
+		if not self._outbox.wait(self._max_count, self._max_age, timeout):
+			return
+
+		token, leased = self._outbox.lease(self._lease_size, self._visibility_timeout)
+		if not leased:
+			return
+
+		self.leased = len(leased)
+		try:
+			self.__publish_lease(token, leased)
+		finally:
+			self.leased = 0
+
+	def __publish_lease(self, token, leased):
+		batches = self.__split([(item_id, self._mqtt.encode_point(item)) for item_id, item, _ in leased])
+
+		for batch in batches:
+			if not self.__publish([encoded for _, encoded in batch]):
+				# Hand the rest back for a retry after the backoff
+				self._outbox.release(token, batch[0][0], batches[-1][-1][0])
+				time.sleep(self._delay)
+				self._delay = min(self._delay * 2, self._retry_backoff[1])
+				return
+
+			self._outbox.ack(token, batch[0][0], batch[-1][0])
+			self._delay = self._retry_backoff[0]
+			logging.info("Sent batch of %d points" % len(batch))
+
+	def __split(self, encoded):
+		# Cut the leased points into batches by count and payload size
+		batches = []
+		batch = []
+		size = 0
+
+		for item_id, point in encoded:
+			point_size = self._mqtt.point_size(point)
+			too_big = point_size + size + self._mqtt.batch_overhead(len(batch) + 1) > self._max_bytes
+			if batch and (len(batch) >= self._max_count or too_big):
+				batches.append(batch)
+				batch = []
+				size = 0
+
+			batch.append((item_id, point))
+			size += point_size
+
+		if batch:
+			batches.append(batch)
+
+		return batches
+
+	def __publish(self, encoded_points):
+		# send_batch returns on PUBACK, so this times the full round trip
+		start = metrics.clock()
+		try:
+			sent = self._mqtt.send_batch(encoded_points)
+		except Exception as e:
+			logging.error("Failed to publish batch")
+			logging.error(error_message(e))
+			sent = False
+
+		if sent:
+			metrics.observe('publish', start, len(encoded_points))
+		else:
+			metrics.count('publish_failed')
+		return sent
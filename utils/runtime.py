@@ -0,0 +1,426 @@
+import asyncio
+import logging
+import signal
+from concurrent.futures import ThreadPoolExecutor
+
+from utils import decoder
+from utils.error_handling import error_message
+from utils.memory import ITEM_BYTES
+from utils.metrics import metrics
+from utils.pipeline import FIX_SENTENCES, LOCK_SENTENCES
+
+# Asyncio runtime of the client
+#
+#   reader -> lines -> decoder -> messages -> assembler -> fixes -> sampler -> points -> outbox
+#                                                      \-> raw -> persister
+#
+# Stages are connected by bounded queues. The reader never waits on the rest
+# of the pipeline, so serial input keeps draining: when `lines` is full the
+# oldest line is dropped and counted. The raw archive and sampled point
+# queues drop their oldest entry the same way, so a slow SD card can neither
+# stall sampling nor the serial port; every other hop applies backpressure.
+# Blocking I/O (serial, raw archive, outbox and MQTT) runs in its own
+# executor thread.
+#
+# Every stage reports its latency to utils.metrics and queue depths are
+# registered there as gauges; a StatsReporter passed as `reporter` writes
+# them out every stats_interval seconds.
+#
+# With a utils.memory.MemoryBudget the queues are sized from it and their
+# usage is tracked there. With an outbox, a full points queue spills its
+# oldest half to the outbox instead of dropping points. The spill is written
+# on the outbox executor, after the batches queued there before it, and
+# while one is being written a full queue drops its oldest point as the
+# others do.
+
+ALL_SENTENCES = LOCK_SENTENCES + FIX_SENTENCES
+
+# End of stream marker passed down every queue on shutdown
+STOP = object()
+
+# Read timeout marker from the decoder to the assembler
+TIMEOUT = object()
+
+# Seconds without raw fixes before the persister lets the archive check its
+# flush interval
+TICK_INTERVAL = 1
+
+class StageQueue:
+	# Bounded asyncio queue with depth and drop accounting. spill(items),
+	# if set, hands items off and returns a future that is done once they
+	# are stored.
+
+	def __init__(self, name, maxsize, spill=None):
+		self.name = name
+		self.queue = asyncio.Queue(maxsize)
+		self.spill = spill
+		self.dropped = 0
+		self.spilled = 0
+		# Items handed to spill() and not stored yet
+		self.spilling = 0
+		self.high_water = 0
+
+	def offer(self, item):
+		# Put without waiting, making room by spilling the oldest half or
+		# dropping the oldest item
+		if self.queue.full():
+			if self.spill is not None and not self.spilling:
+				self.__spill()
+			else:
+				self.queue.get_nowait()
+				self.dropped += 1
+		self.queue.put_nowait(item)
+		self.high_water = max(self.high_water, self.queue.qsize())
+
+	async def put(self, item):
+		await self.queue.put(item)
+		self.high_water = max(self.high_water, self.queue.qsize())
+
+	async def get(self):
+		return await self.queue.get()
+
+	def get_batch(self, first, limit):
+		# first plus whatever else is already waiting, up to limit items
+		batch = [first]
+		while len(batch) < limit and not self.queue.empty():
+			batch.append(self.queue.get_nowait())
+		return batch
+
+	def __spill(self):
+		items = [self.queue.get_nowait() for i in range(max(1, self.queue.qsize() // 2))]
+		items = [item for item in items if item is not STOP]
+		self.spilling = len(items)
+		self.spill(items).add_done_callback(self.__spilled)
+
+	def __spilled(self, future):
+		count = self.spilling
+		self.spilling = 0
+		try:
+			future.result()
+			self.spilled += count
+			metrics.count('spilled.' + self.name, count)
+		except Exception as e:
+			self.dropped += count
+			logging.error("Failed to spill %d items of %s" % (count, self.name))
+			logging.error(error_message(e))
+
+	def stats(self):
+		return {
+			'depth': self.queue.qsize(),
+			'high_water': self.high_water,
+			'dropped': self.dropped,
+			'spilled': self.spilled
+		}
+
+class AsyncRuntime:
+
+	def __init__(
+		self,
+		source,
+		pipeline,
+		outbox=None,
+		publishers=(),
+		queue_sizes=None,
+		stats_interval=60,
+		reporter=None,
+		budget=None
+	):
+		self._source = source
+		self._pipeline = pipeline
+		self._outbox = outbox
+		self._publishers = publishers
+		self._stats_interval = stats_interval
+		self._reporter = reporter
+		self._budget = budget
+		self._queue_sizes = {
+			'lines': 512,
+			'messages': 256,
+			'fixes': 64,
+			'raw': 600,
+			'points': 1000
+		}
+		if budget is not None:
+			self._queue_sizes.update({name: budget.items(name) for name in self._queue_sizes})
+			if outbox is not None:
+				# Room for the half being spilled next to a full queue
+				self._queue_sizes['points'] = self._queue_sizes['points'] * 2 // 3
+		self._queue_sizes.update(queue_sizes or {})
+
+		self.decode_errors = 0
+		self._queues = None
+		self._stopping = False
+
+	def emit(self, point):
+		# Sampler update callback: hand the point to the outbox stage
+		if self._queues is not None:
+			metrics.count('points')
+			self._queues['points'].offer(point)
+
+	def stats(self):
+		stats = {name: q.stats() for name, q in (self._queues or {}).items()}
+		stats['decode_errors'] = self.decode_errors
+		return stats
+
+	def run(self, stopped=lambda: False, signal_handlers=None):
+		# Run until stopped() is true or the source is exhausted, then drain
+		# every stage and return. signal_handlers maps signal numbers to
+		# callbacks that run on the loop, between stage steps, while it runs;
+		# the handlers from before are put back afterwards.
+		loop = asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		previous = {}
+		try:
+			for signal_number, callback in (signal_handlers or {}).items():
+				previous[signal_number] = signal.getsignal(signal_number)
+				loop.add_signal_handler(signal_number, callback)
+			loop.run_until_complete(self.__main(loop, stopped))
+		finally:
+			for signal_number, handler in previous.items():
+				loop.remove_signal_handler(signal_number)
+				signal.signal(signal_number, handler)
+			loop.close()
+
+	async def __main(self, loop, stopped):
+		self._queues = {name: StageQueue(name, size) for name, size in self._queue_sizes.items()}
+
+		executors = {
+			'reader': ThreadPoolExecutor(1),
+			'persister': ThreadPoolExecutor(1),
+			'outbox': ThreadPoolExecutor(1),
+			'publisher': ThreadPoolExecutor(max(len(self._publishers), 1)),
+			'stats': ThreadPoolExecutor(1)
+		}
+
+		if self._outbox is not None:
+			self._queues['points'].spill = lambda items: loop.run_in_executor(executors['outbox'], self._outbox.put_many, items)
+
+		gauges = self.__register_gauges()
+
+		publishing = [
+			loop.run_in_executor(executors['publisher'], publisher.run, lambda: self._stopping)
+			for publisher in self._publishers
+		]
+
+		stages = [
+			asyncio.ensure_future(self.__reader(loop, executors['reader'], stopped)),
+			asyncio.ensure_future(self.__decoder()),
+			asyncio.ensure_future(self.__assembler()),
+			asyncio.ensure_future(self.__sampler()),
+			asyncio.ensure_future(self.__persister(loop, executors['persister'])),
+			asyncio.ensure_future(self.__outbox(loop, executors['outbox']))
+		]
+		reporter = asyncio.ensure_future(self.__report(loop, executors['stats']))
+
+		await asyncio.gather(*stages)
+		reporter.cancel()
+
+		self._stopping = True
+		if publishing:
+			await asyncio.gather(*publishing)
+
+		logging.info("Pipeline stats: %r" % self.stats())
+		if self._reporter is not None:
+			await loop.run_in_executor(executors['stats'], self._reporter.report)
+
+		for name in gauges:
+			metrics.remove_gauge(name)
+		if self._budget is not None:
+			for name in self._queues:
+				self._budget.untrack(name)
+
+		for executor in executors.values():
+			executor.shutdown()
+
+	def __register_gauges(self):
+		gauges = {}
+		for name, q in self._queues.items():
+			gauges['queue_depth.' + name] = q.queue.qsize
+			gauges['queue_dropped.' + name] = lambda q=q: q.dropped
+		lock = self._pipeline.lock
+		gauges['gnss_locked'] = lambda: int(lock.locked)
+		gauges['gnss_tracked'] = lambda: lock.summary('tracked')
+		gauges['gnss_strong'] = lambda: lock.summary('strong')
+		gauges['gnss_snr_mean'] = lock.snr_mean
+		gauges['time_to_first_fix'] = lambda: self._pipeline.time_to_first_fix
+		if hasattr(self._source, 'stats'):
+			# Bytes waiting in a BulkSerialSource ring
+			gauges['serial_buffered'] = lambda: self._source.stats()['buffered']
+		if self._outbox is not None:
+			gauges['outbox'] = self._outbox.__len__
+			gauges['outbox_dropped'] = lambda: self._outbox.dropped
+
+		for name, read in gauges.items():
+			metrics.gauge(name, read)
+
+		if self._budget is not None:
+			for name, q in self._queues.items():
+				self._budget.track(name, lambda q=q, size=ITEM_BYTES[name]: (q.queue.qsize() + q.spilling) * size)
+		return gauges
+
+	async def __report(self, loop, executor):
+		while True:
+			await asyncio.sleep(self._stats_interval)
+			logging.info("Pipeline stats: %r" % self.stats())
+			if self._budget is not None:
+				over = self._budget.over()
+				if over:
+					metrics.count('memory_over_budget')
+					logging.warning("Over the memory budget: %s" % ', '.join(over))
+			if self._reporter is not None:
+				try:
+					await loop.run_in_executor(executor, self._reporter.report)
+				except Exception as e:
+					logging.error(error_message(e))
+
+	async def __reader(self, loop, executor, stopped):
+		lines = self._queues['lines']
+		try:
+			while not stopped():
+				start = metrics.clock()
+				try:
+					line = await loop.run_in_executor(executor, self._source.readline)
+				except Exception as e:
+					logging.error("Exception in reader")
+					logging.error(error_message(e))
+					continue
+
+				metrics.observe('serial_read', start)
+
+				if line is None:
+					break
+				lines.offer(line)
+		finally:
+			await lines.put(STOP)
+
+	async def __decoder(self):
+		lines = self._queues['lines']
+		messages = self._queues['messages']
+
+		while True:
+			line = await lines.get()
+			if line is STOP:
+				await messages.put(STOP)
+				return
+
+			line = line.decode('ascii', 'replace').strip()
+			if len(line) <= 6:
+				await messages.put(TIMEOUT)
+				continue
+
+			# The assembler's lock state may have moved on by the time the
+			# message arrives, so decode everything it could need
+			start = metrics.clock()
+			try:
+				msg = decoder.parse(line, ALL_SENTENCES)
+			except Exception as e:
+				self.decode_errors += 1
+				metrics.count('decode_errors')
+				logging.error(error_message(e))
+				continue
+			metrics.observe('decode', start)
+
+			if msg is not None:
+				await messages.put(msg)
+
+	async def __assembler(self):
+		messages = self._queues['messages']
+		fixes = self._queues['fixes']
+		raw = self._queues['raw']
+
+		while True:
+			msg = await messages.get()
+			if msg is STOP:
+				await fixes.put(STOP)
+				await raw.put(STOP)
+				return
+
+			try:
+				if msg is TIMEOUT:
+					# May close an epoch past its deadline
+					fix = self._pipeline.timeout()
+				else:
+					start = metrics.clock()
+					fix = self._pipeline.assemble(msg)
+					metrics.observe('assemble', start)
+			except Exception as e:
+				logging.error(error_message(e))
+				continue
+
+			if fix is not None:
+				await fixes.put(fix[0])
+				raw.offer(fix)
+
+	async def __sampler(self):
+		fixes = self._queues['fixes']
+		points = self._queues['points']
+
+		while True:
+			minimal = await fixes.get()
+			if minimal is STOP:
+				await points.put(STOP)
+				return
+
+			# Emitted points arrive through emit()
+			start = metrics.clock()
+			self._pipeline.sampler.process_update(minimal)
+			metrics.observe('sampler', start)
+			if self._pipeline.raw_archive is None:
+				self._pipeline.recorded()
+
+	async def __persister(self, loop, executor):
+		raw = self._queues['raw']
+		archive = self._pipeline.raw_archive
+
+		while True:
+			try:
+				first = await asyncio.wait_for(raw.get(), TICK_INTERVAL)
+			except asyncio.TimeoutError:
+				# No fixes for a while: the archive may still hold some
+				if archive is not None:
+					try:
+						await loop.run_in_executor(executor, archive.tick)
+					except Exception as e:
+						logging.error(error_message(e))
+				continue
+
+			batch = raw.get_batch(first, 100)
+			done = STOP in batch
+			batch = [fix for fix in batch if fix is not STOP]
+
+			if batch and archive is not None:
+				start = metrics.clock()
+				try:
+					await loop.run_in_executor(executor, self.__persist, archive, batch)
+					self._pipeline.recorded()
+				except Exception as e:
+					logging.error("Failed to persit raw data")
+					logging.error(error_message(e))
+				metrics.observe('raw_persist', start, len(batch))
+
+			if done:
+				return
+
+	@staticmethod
+	def __persist(archive, batch):
+		for minimal, full in batch:
+			archive.append(minimal.get('timestamp'), full)
+
+	async def __outbox(self, loop, executor):
+		points = self._queues['points']
+
+		while True:
+			batch = points.get_batch(await points.get(), 500)
+			done = STOP in batch
+			batch = [point for point in batch if point is not STOP]
+
+			if batch and self._outbox is not None:
+				start = metrics.clock()
+				try:
+					await loop.run_in_executor(executor, self._outbox.put_many, batch)
+				except Exception as e:
+					logging.error("Failed to queue points")
+					logging.error(error_message(e))
+				metrics.observe('enqueue', start, len(batch))
+
+			if done:
+				return
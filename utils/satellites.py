@@ -0,0 +1,154 @@
+from utils.decoder import GSV
+from utils.metrics import metrics
+from utils.nmea import MAX_SATELLITE_PAGES
+
+# Incremental GNSS lock tracking from GSV sentences.
+#
+# Every constellation (talker id: GP, GL, GA, GB, ...) sends its satellites
+# in view as a numbered sequence of GSV pages. LockTracker follows one
+# sequence per talker with a bitmask of the pages received, so pages of
+# different constellations may interleave and each page costs O(1). A
+# sequence that completes replaces that constellation's satellite table;
+# one that skips or repeats a page is dropped and counted. The receiver
+# counts as locked once any constellation has sent a complete sequence.
+#
+# The tables (PRN, elevation, azimuth, SNR per satellite) and the quality
+# figures are only worked out from the pages when asked for, e.g. by the
+# stats gauges, so tracking a page is a few integer operations.
+
+# GSV fields of the four satellites a page can carry, (prn, elevation,
+# azimuth, snr) each
+SATELLITE_FIELDS = tuple(
+	name
+	for i in range(1, 5)
+	for name in ('sv_prn_num_%d' % i, 'elevation_deg_%d' % i, 'azimuth_%d' % i, 'snr_%d' % i)
+)
+SATELLITE_START = GSV._fields.index('sv_prn_num_1')
+
+# Satellites at or above this SNR (dB-Hz) count as strong
+STRONG_SNR = 30
+
+def _int(value):
+	try:
+		return int(value)
+	except (TypeError, ValueError):
+		return None
+
+class LockTracker:
+
+	def __init__(self, strong_snr=STRONG_SNR):
+		self._strong_snr = strong_snr
+		self.reset()
+
+	def reset(self):
+		# talker: [page count, received page mask, pages]
+		self._sequences = {}
+		# talker: pages of its last complete sequence
+		self._complete = {}
+		self._tables = {}
+		self._summaries = {}
+		self.locked = False
+		self.sequences = 0
+		self.broken_sequences = 0
+
+	def add(self, msg):
+		# Track one GSV page. Returns the pages of the sequence it completes,
+		# None otherwise.
+		talker = msg.talker
+		total = _int(msg.num_messages)
+		page = _int(msg.msg_num)
+		if not total or not page or page > total or total > MAX_SATELLITE_PAGES:
+			self.__broken(talker)
+			return None
+
+		sequence = self._sequences.get(talker)
+		if page == 1:
+			if sequence is not None:
+				self.__broken(talker)
+			sequence = self._sequences[talker] = [total, 0, []]
+		elif sequence is None or sequence[0] != total or sequence[1] != (1 << (page - 1)) - 1:
+			# Pages must arrive in order, starting from the first
+			self.__broken(talker)
+			return None
+
+		sequence[1] |= 1 << (page - 1)
+		sequence[2].append(msg)
+		if page < total:
+			return None
+
+		del self._sequences[talker]
+		self._complete[talker] = sequence[2]
+		self._tables.pop(talker, None)
+		self._summaries.pop(talker, None)
+		self.sequences += 1
+		self.locked = True
+		return sequence[2]
+
+	def table(self, talker):
+		# ((prn, elevation, azimuth, snr), ...) of the talker's last complete
+		# sequence, missing values as None
+		table = self._tables.get(talker)
+		if table is None:
+			satellites = []
+			for msg in self._complete.get(talker, ()):
+				if isinstance(msg, GSV):
+					values = msg[SATELLITE_START:]
+				else:
+					values = [getattr(msg, name, None) for name in SATELLITE_FIELDS]
+				for i in range(0, len(values) - 3, 4):
+					if values[i]:
+						satellites.append(tuple(_int(value) for value in values[i:i + 4]))
+			table = self._tables[talker] = tuple(satellites)
+		return table
+
+	@property
+	def tables(self):
+		return {talker: self.table(talker) for talker in self._complete}
+
+	def __broken(self, talker):
+		if self._sequences.pop(talker, None) is not None:
+			self.broken_sequences += 1
+			metrics.count('gsv_broken_sequences')
+
+	def __summary(self, talker):
+		summary = self._summaries.get(talker)
+		if summary is not None:
+			return summary
+
+		satellites = self.table(talker)
+		snrs = [satellite[3] for satellite in satellites if satellite[3] is not None]
+		summary = self._summaries[talker] = {
+			'in_view': len(satellites),
+			'tracked': len(snrs),
+			'strong': sum(1 for snr in snrs if snr >= self._strong_snr),
+			'snr_mean': round(sum(snrs) / len(snrs), 1) if snrs else None,
+			'snr_max': max(snrs) if snrs else None
+		}
+		return summary
+
+	def summaries(self):
+		return {talker: self.__summary(talker) for talker in self._complete}
+
+	def summary(self, key):
+		# key ('in_view', 'tracked' or 'strong') summed over constellations
+		return sum(summary[key] for summary in self.summaries().values())
+
+	def snr_mean(self):
+		summaries = [summary for summary in self.summaries().values() if summary['tracked']]
+		tracked = sum(summary['tracked'] for summary in summaries)
+		if not tracked:
+			return None
+		return round(sum(summary['snr_mean'] * summary['tracked'] for summary in summaries) / tracked, 1)
+
+	def quality(self):
+		# Lock and signal quality, overall and per constellation
+		return {
+			'locked': self.locked,
+			'in_view': self.summary('in_view'),
+			'tracked': self.summary('tracked'),
+			'strong': self.summary('strong'),
+			'snr_mean': self.snr_mean(),
+			'sequences': self.sequences,
+			'broken_sequences': self.broken_sequences,
+			'constellations': self.summaries()
+		}
@@ -0,0 +1,206 @@
+import logging
+import threading
+import time
+
+from utils.error_handling import error_message
+from utils.metrics import metrics
+
+# Bulk serial input for the GNSS receiver.
+#
+# A dedicated thread drains whatever the UART has waiting in one read and
+# copies it into a preallocated ring buffer, so input keeps draining however
+# long the rest of the pipeline takes over a line. Consumers take complete
+# lines out of the ring with readline(); the newline search runs over the
+# ring in place and the only allocation is the returned line.
+#
+# When the ring is full the bytes that do not fit are dropped and counted
+# as an overrun; the line they belonged to is discarded rather than handed
+# on half. Lines that do not look like NMEA (no leading '$' or '!', or
+# longer than max_line) are dropped as framing errors.
+
+class LineRing:
+
+	def __init__(self, capacity=64 * 1024, max_line=256):
+		self._buffer = bytearray(capacity)
+		self._capacity = capacity
+		self._max_line = max_line
+
+		# Absolute stream offsets, the ring index is offset % capacity
+		self._head = 0
+		self._tail = 0
+		self._scanned = 0
+
+		# Offsets where bytes were lost, lines spanning them are dropped
+		self._gaps = []
+		# Skip everything up to the next newline
+		self._resync = False
+
+		self.overruns = 0
+		self.overrun_bytes = 0
+		self.framing_errors = 0
+
+	def __len__(self):
+		return self._tail - self._head
+
+	def write(self, data):
+		# Copy data in, dropping what does not fit. Returns the bytes kept.
+		size = len(data)
+		free = self._capacity - (self._tail - self._head)
+		if size > free:
+			self.overruns += 1
+			self.overrun_bytes += size - free
+			metrics.count('serial_overruns')
+			size = free
+			self._gaps.append(self._tail + size)
+		if size == 0:
+			return 0
+
+		view = memoryview(data)
+		start = self._tail % self._capacity
+		first = min(size, self._capacity - start)
+		self._buffer[start:start + first] = view[:first]
+		if first < size:
+			self._buffer[:size - first] = view[first:size]
+		self._tail += size
+		return size
+
+	def readline(self):
+		# Next complete line including its newline, None if there is none yet
+		while True:
+			end = self.__find_newline()
+			if end < 0:
+				if self._tail - self._head > self._max_line:
+					# No line end in sight, drop what is there and wait for one
+					self.__framing_error()
+					self._head = self._scanned = self._tail
+					self._gaps = [gap for gap in self._gaps if gap > self._tail]
+					self._resync = True
+				return None
+
+			start = self._head
+			self._head = self._scanned = end + 1
+
+			if self._gaps and self._gaps[0] <= end:
+				self._gaps = [gap for gap in self._gaps if gap > end]
+				self._resync = False
+				continue
+
+			if self._resync:
+				self._resync = False
+				continue
+
+			line = self.__copy(start, end + 1)
+			if line[:1] not in (b'$', b'!') or len(line) > self._max_line:
+				self.__framing_error()
+				continue
+			return line
+
+	def __framing_error(self):
+		self.framing_errors += 1
+		metrics.count('serial_framing_errors')
+
+	def __find_newline(self):
+		# Absolute offset of the next newline after the head, or -1
+		position = self._scanned
+		tail = self._tail
+		while position < tail:
+			start = position % self._capacity
+			stop = min(self._capacity, start + (tail - position))
+			found = self._buffer.find(b'\n', start, stop)
+			if found >= 0:
+				return position + (found - start)
+			position += stop - start
+		self._scanned = tail
+		return -1
+
+	def __copy(self, start, end):
+		first = start % self._capacity
+		last = first + (end - start)
+		if last <= self._capacity:
+			return bytes(self._buffer[first:last])
+		return bytes(self._buffer[first:]) + bytes(self._buffer[:last - self._capacity])
+
+class BulkSerialSource:
+	# serial.Serial style source (see utils.sources) reading the receiver
+	# through a LineRing. readline() returns the next line, b'' when none
+	# arrives within timeout and None once closed.
+
+	def __init__(self, port='/dev/ttyUSB1', timeout=0.1, capacity=64 * 1024, max_line=256, tty=None):
+		if tty is None:
+			import serial
+			tty = serial.Serial(port, timeout=timeout)
+		self._tty = tty
+		self._timeout = timeout
+		self._ring = LineRing(capacity, max_line)
+		self._available = threading.Condition()
+		self._closed = False
+
+		self._thread = threading.Thread(target=self.__drain, name='serial', daemon=True)
+		self._thread.start()
+
+	@property
+	def overruns(self):
+		return self._ring.overruns
+
+	@property
+	def framing_errors(self):
+		return self._ring.framing_errors
+
+	def stats(self):
+		ring = self._ring
+		return {
+			'buffered': len(ring),
+			'overruns': ring.overruns,
+			'overrun_bytes': ring.overrun_bytes,
+			'framing_errors': ring.framing_errors
+		}
+
+	def __drain(self):
+		tty = self._tty
+		while not self._closed:
+			try:
+				# Block for the first byte (up to the port timeout), then take
+				# everything else already waiting in one go
+				data = tty.read(max(1, tty.in_waiting))
+			except Exception as e:
+				if self._closed:
+					break
+				logging.error("Serial read failed")
+				logging.error(error_message(e))
+				time.sleep(1)
+				continue
+
+			if data:
+				with self._available:
+					self._ring.write(data)
+					self._available.notify()
+
+	def readline(self):
+		deadline = None
+		with self._available:
+			while True:
+				line = self._ring.readline()
+				if line is not None:
+					return line
+				if self._closed:
+					return None
+
+				now = time.monotonic()
+				if deadline is None:
+					deadline = now + self._timeout
+				elif now >= deadline:
+					return b''
+				self._available.wait(deadline - now)
+
+	def close(self):
+		self._closed = True
+		with self._available:
+			self._available.notify_all()
+		self._thread.join(max(1, 2 * self._timeout))
+		self._tty.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
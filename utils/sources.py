@@ -0,0 +1,272 @@
+import json
+import logging
+import time
+from collections import namedtuple
+
+from utils import decoder
+from utils.archive import RawArchiveReader
+from utils.columnar import COLUMNAR_SUFFIX, ColumnarArchive
+from utils.nmea import convert_lat_long, get_epoch_time
+
+# Recorded input sources for utils.pipeline.Pipeline; the receiver itself is
+# read through utils.serial_reader.BulkSerialSource. Each exposes the small
+# part of the serial.Serial interface the pipeline uses: readline() returning
+# bytes, b'' on a read timeout and None once the source is exhausted.
+
+KNOTS = 0.514444
+
+# One position sample of a recorded drive; speed is m/s, course in degrees
+Fix = namedtuple('Fix', ['t', 'latitude', 'longitude', 'speed', 'course', 'altitude'])
+
+class ReplaySource:
+	# Replays a recorded drive as NMEA lines.
+	#
+	# `warp` scales the recording's time: 1 is real time, 10 is ten times
+	# faster and None replays as fast as the CPU allows. Each epoch is preceded
+	# by b'', the read timeout the receiver's idle gap produces on the serial
+	# port.
+
+	def __init__(self, epochs, warp=None):
+		self._epochs = iter(epochs)
+		self._warp = warp
+		self._pending = []
+		self._start = None
+
+	@classmethod
+	def from_file(cls, path, rate=None, warp=None):
+		# NMEA logs are replayed line by line unless an internal rate is given;
+		# raw archives and JSON dumps are always rendered from interpolated fixes
+		if path.endswith('.json'):
+			fixes = fixes_from_json(path)
+		elif path.endswith('.seg') or not path.endswith(('.nmea', '.log', '.txt')):
+			fixes = fixes_from_archive(path)
+		elif rate:
+			fixes = fixes_from_nmea(path)
+		else:
+			return cls(epochs_from_nmea(path), warp)
+
+		return cls(render_epochs(interpolate(fixes, rate or 1)), warp)
+
+	def readline(self):
+		if not self._pending:
+			try:
+				t, lines = next(self._epochs)
+			except StopIteration:
+				return None
+
+			self.__wait_for(t)
+			self._pending = [b''] + lines
+			self._pending.reverse()
+
+		return self._pending.pop()
+
+	def __wait_for(self, t):
+		if not self._warp:
+			return
+
+		now = time.monotonic()
+		if self._start is None:
+			self._start = (now, t)
+
+		delay = self._start[0] + (t - self._start[1]) / self._warp - now
+		if delay > 0:
+			time.sleep(delay)
+
+	def close(self):
+		pass
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
+
+def _line_time(msg):
+	ts = msg.timestamp
+	return ts.hour * 3600 + ts.minute * 60 + ts.second + ts.microsecond / 1e6
+
+def _burst_key(line):
+	# Sentence id, plus the message number for multi-part GSV sentences
+	if line[3:6] == b'GSV':
+		return line.split(b',', 3)[:3]
+	return line[:6]
+
+def epochs_from_nmea(path):
+	# (time of day, [lines]) per burst of a recorded NMEA log. The receiver
+	# sends the same sentences in the same order every epoch, so a burst
+	# starts each time the sentence that opened the first burst comes round.
+	opener = None
+	t = None
+	burst_t = None
+	lines = []
+
+	with open(path, 'rb') as f:
+		for raw in f:
+			line = raw.strip()
+			if len(line) <= 6:
+				continue
+
+			key = _burst_key(line)
+			if opener is None:
+				opener = key
+			elif key == opener and lines:
+				yield burst_t if burst_t is not None else (t or 0), lines
+				lines = []
+				burst_t = None
+
+			if line[3:6] in (b'GGA', b'RMC') and burst_t is None:
+				try:
+					t = burst_t = _line_time(decoder.decode(line.decode('ascii')))
+				except Exception:
+					pass
+
+			lines.append(line + b'\r\n')
+
+	if lines:
+		yield burst_t if burst_t is not None else (t or 0), lines
+
+def fixes_from_nmea(path):
+	fixes = []
+	altitude = 0.0
+
+	with open(path, 'rb') as f:
+		for raw in f:
+			try:
+				msg = decoder.decode(raw.strip().decode('ascii'), ('GGA', 'RMC'))
+			except Exception:
+				continue
+
+			if msg is None:
+				continue
+
+			if msg.sentence_type == 'GGA':
+				altitude = msg.altitude or altitude
+			elif msg.status == 'A':
+				fixes.append(Fix(
+					get_epoch_time(msg.timestamp, msg.datestamp),
+					convert_lat_long(msg.lat, msg.lat_dir),
+					convert_lat_long(msg.lon, msg.lon_dir),
+					(msg.spd_over_grnd or 0) * KNOTS,
+					msg.true_course or 0,
+					altitude
+				))
+
+	return fixes
+
+def fixes_from_archive(prefix):
+	# Fixes from a raw archive written by utils.archive.RawArchiveWriter or
+	# compacted into a utils.columnar archive
+	if prefix.endswith(COLUMNAR_SUFFIX):
+		with ColumnarArchive(prefix) as archive:
+			records = list(archive)
+	else:
+		if prefix.endswith('.seg'):
+			prefix = prefix.rsplit('_', 1)[0]
+		records = RawArchiveReader(prefix)
+
+	fixes = []
+	for _, full in records:
+		try:
+			fix, transit = full['fix'], full['transit_data']
+			fixes.append(Fix(
+				get_epoch_time(fix['timestamp'], transit['datestamp']),
+				convert_lat_long(fix['lat'], fix['lat_dir']),
+				convert_lat_long(fix['lon'], fix['lon_dir']),
+				float(transit['spd_over_grnd']) * KNOTS,
+				float(transit['true_course']),
+				float(fix['altitude'])
+			))
+		except Exception as e:
+			logging.debug(e)
+			continue
+
+	return fixes
+
+def fixes_from_json(path):
+	# Fixes from a {timestamp: update} dump as used by test.py
+	with open(path) as f:
+		items = json.load(f)
+
+	fixes = []
+	for key in sorted(items.keys(), key=int):
+		update = items[key]
+		fixes.append(Fix(
+			int(key),
+			update.get('latitude'),
+			update.get('longitude'),
+			update.get('speed', 0),
+			update.get('course', 0),
+			update.get('altitude', 0)
+		))
+
+	return fixes
+
+def interpolate(fixes, rate):
+	# Resample fixes at `rate` Hz, linearly between recorded fixes and along
+	# the shortest turn for the course
+	fixes = sorted(fixes, key=lambda fix: fix.t)
+	if len(fixes) < 2:
+		for fix in fixes:
+			yield fix
+		return
+
+	step = 1.0 / rate
+	start = fixes[0].t
+	i = 0
+	t = start
+	for a, b in zip(fixes, fixes[1:]):
+		span = b.t - a.t
+		if span <= 0:
+			continue
+
+		while t < b.t:
+			f = (t - a.t) / span
+			turn = (b.course - a.course + 180) % 360 - 180
+			yield Fix(
+				t,
+				a.latitude + (b.latitude - a.latitude) * f,
+				a.longitude + (b.longitude - a.longitude) * f,
+				a.speed + (b.speed - a.speed) * f,
+				(a.course + turn * f) % 360,
+				a.altitude + (b.altitude - a.altitude) * f
+			)
+			# Step from the start rather than accumulating rounding errors
+			i += 1
+			t = round(start + i * step, 3)
+
+	yield fixes[-1]
+
+def nmea_sentence(body):
+	# '$<body>*<checksum>' line as the receiver sends it
+	checksum = 0
+	for c in body.encode('ascii'):
+		checksum ^= c
+	return ('$%s*%02X\r\n' % (body, checksum)).encode('ascii')
+
+def nmea_coordinate(value, width):
+	# Decimal degrees as NMEA (d)ddmm.mmmmm
+	degrees = int(abs(value))
+	minutes = (abs(value) - degrees) * 60
+	return '%0*d%08.5f' % (width, degrees, minutes)
+
+def render_epochs(fixes):
+	# (epoch time, [GSV, GGA, GSA, RMC, VTG lines]) for each fix, in the order
+	# the receiver sends them
+	for fix in fixes:
+		stamp = time.gmtime(fix.t)
+		hhmmss = '%02d%02d%06.3f' % (stamp.tm_hour, stamp.tm_min, stamp.tm_sec + fix.t % 1)
+		ddmmyy = '%02d%02d%02d' % (stamp.tm_mday, stamp.tm_mon, stamp.tm_year % 100)
+
+		lat = nmea_coordinate(fix.latitude, 2)
+		lat_dir = 'N' if fix.latitude >= 0 else 'S'
+		lon = nmea_coordinate(fix.longitude, 3)
+		lon_dir = 'E' if fix.longitude >= 0 else 'W'
+		knots = fix.speed / KNOTS
+
+		yield fix.t, [
+			nmea_sentence('GPGSV,1,1,04,01,45,090,40,02,30,180,38,03,60,270,42,04,15,000,35'),
+			nmea_sentence('GPGGA,%s,%s,%s,%s,%s,1,08,0.9,%.1f,M,0.0,M,,' % (hhmmss, lat, lat_dir, lon, lon_dir, fix.altitude)),
+			nmea_sentence('GPGSA,A,3,01,02,03,04,,,,,,,,,1.5,0.9,1.2'),
+			nmea_sentence('GPRMC,%s,A,%s,%s,%s,%s,%.2f,%.2f,%s,,,A' % (hhmmss, lat, lat_dir, lon, lon_dir, knots, fix.course, ddmmyy)),
+			nmea_sentence('GPVTG,%.2f,T,,M,%.2f,N,%.2f,K,A' % (fix.course, knots, knots * 1.852))
+		]
@@ -0,0 +1,241 @@
+import itertools
+import logging
+import random
+
+from utils.monitor import Sampler
+from utils.sources import fixes_from_archive, fixes_from_json, fixes_from_nmea
+from utils.wire import ENCODERS
+
+# Sampler parameter sweep over recorded tracks, see sweep.py for the command
+# line.
+#
+# Every combination of parameters runs each track through
+# Sampler.process_batch and is scored on
+#
+#   points  sampled points emitted
+#   bytes   MQTT payload plus an estimated per-message overhead, with the
+#           points batched as BatchPublisher would (max_count points or
+#           max_age seconds per message)
+#   error   cross-track distance in metres of every recorded fix from the
+#           polyline through the sampled points, as max and mean
+#
+# pareto() keeps the combinations no other combination beats on both bytes
+# and error.
+
+# name: (default, low, high, integer) as searched by random_search
+PARAMETERS = {
+	'minimum_sampling_distance': (50, 10, 200, False),
+	'maximum_sampling_distance': (30000, 1000, 50000, False),
+	'x_max': (0.15, 0.02, 0.5, False),
+	'pause_distance': (0.5, 0.1, 2, False),
+	'resume_distance': (5, 1, 15, False),
+	'moving_average_length': (20, 5, 60, True),
+	'drift_tolerance': (25, 5, 100, False),
+	'max_interval': (300, 30, 900, True),
+	'velocity_fixes': (5, 1, 20, True)
+}
+
+# Grid searched per Sampler strategy when none is given, around the
+# defaults
+DEFAULT_GRIDS = {
+	'distance': {
+		'minimum_sampling_distance': [25, 50, 100, 200],
+		'x_max': [0.05, 0.15, 0.3],
+		'moving_average_length': [10, 20, 40]
+	},
+	'dead_reckoning': {
+		'drift_tolerance': [5, 10, 25, 50, 100],
+		'max_interval': [60, 300, 900],
+		'velocity_fixes': [1, 5, 10]
+	}
+}
+
+# Fixed header, topic length, packet id and PUBACK of a QoS 1 PUBLISH,
+# with TLS record framing, for a topic of around 40 bytes
+MESSAGE_OVERHEAD = 80
+
+TRACK_FIELDS = ('timestamp', 'latitude', 'longitude', 'speed', 'course', 'altitude')
+
+def load_track(path):
+	# Columns of a recorded drive (as accepted by replay.py) for process_batch
+	if path.endswith('.json'):
+		fixes = fixes_from_json(path)
+	elif path.endswith(('.nmea', '.log', '.txt')):
+		fixes = fixes_from_nmea(path)
+	else:
+		fixes = fixes_from_archive(path)
+
+	fixes = sorted(fixes, key=lambda fix: fix.t)
+	return {key: [fix[i] for fix in fixes] for i, key in enumerate(TRACK_FIELDS)}
+
+def parameter_value(name, value):
+	# A parameter value from text, as the type PARAMETERS declares for it
+	return int(value) if PARAMETERS[name][3] else float(value)
+
+def grid_search(grid):
+	# Every combination of the listed values; other parameters keep their
+	# defaults
+	names = sorted(grid)
+	for values in itertools.product(*[grid[name] for name in names]):
+		yield dict(zip(names, values))
+
+def random_search(count, seed=None, ranges=None):
+	# count combinations drawn uniformly from ranges (default PARAMETERS)
+	rng = random.Random(seed)
+	ranges = ranges or {name: (low, high) for name, (_, low, high, _) in PARAMETERS.items()}
+	for _ in range(count):
+		parameters = {}
+		for name, (low, high) in sorted(ranges.items()):
+			if PARAMETERS[name][3]:
+				parameters[name] = rng.randint(int(low), int(high))
+			else:
+				parameters[name] = round(rng.uniform(low, high), 3)
+		yield parameters
+
+def valid(parameters):
+	settings = settings_of(parameters)
+	return (
+		settings['minimum_sampling_distance'] < settings['maximum_sampling_distance']
+		and settings['pause_distance'] < settings['resume_distance']
+	)
+
+def settings_of(parameters):
+	settings = {name: default for name, (default, _, _, _) in PARAMETERS.items()}
+	settings['strategy'] = 'distance'
+	settings.update(parameters)
+	return settings
+
+def cross_track_errors(track, emitted):
+	# Distance in metres of every fix from the polyline through the emitted
+	# fixes, measured against the leg between the emitted fixes either side
+	# of it on a local plane. The polyline runs from the first to the last
+	# fix of the track, which the device would send sooner or later.
+	import numpy as np
+
+	latitude = np.asarray(track['latitude'], dtype=float)
+	longitude = np.asarray(track['longitude'], dtype=float)
+	count = len(latitude)
+	if count == 0:
+		return np.zeros(0)
+
+	emitted = np.union1d(np.asarray(emitted, dtype=int), [0, count - 1])
+	leg = np.clip(np.searchsorted(emitted, np.arange(count), side='right') - 1, 0, len(emitted) - 1)
+	start = emitted[leg]
+	end = emitted[np.minimum(leg + 1, len(emitted) - 1)]
+
+	metres = np.radians(1) * 6373000
+	scale = np.cos(np.radians(latitude))
+
+	def projected(index):
+		return (
+			(longitude[index] - longitude) * scale * metres,
+			(latitude[index] - latitude) * metres
+		)
+
+	ax, ay = projected(start)
+	bx, by = projected(end)
+	dx, dy = bx - ax, by - ay
+	length = dx * dx + dy * dy
+	with np.errstate(invalid='ignore', divide='ignore'):
+		along = np.where(length > 0, -(ax * dx + ay * dy) / length, 0)
+	along = np.clip(along, 0, 1)
+	return np.hypot(ax + along * dx, ay + along * dy)
+
+def message_bytes(track, emitted, encoder, max_count=50, max_age=30, overhead=MESSAGE_OVERHEAD):
+	# Bytes the emitted points cost on the wire, batched as BatchPublisher
+	# would batch them; returns (bytes, messages)
+	total = 0
+	messages = 0
+	batch = []
+	first = None
+	for index in emitted:
+		point = {
+			't': track['timestamp'][index],
+			'lon': track['longitude'][index],
+			'lat': track['latitude'][index],
+			's': track['speed'][index],
+			'c': track['course'][index],
+			'a': track['altitude'][index]
+		}
+		if batch and (len(batch) >= max_count or point['t'] - first >= max_age):
+			total += len(encoder.encode_batch(batch)) + overhead
+			messages += 1
+			batch = []
+		if not batch:
+			first = point['t']
+		batch.append(encoder.encode_point(point))
+
+	if batch:
+		total += len(encoder.encode_batch(batch)) + overhead
+		messages += 1
+	return total, messages
+
+# Tracks of a worker process, loaded once by init_worker
+_tracks = None
+_encoding = None
+
+def init_worker(tracks, encoding):
+	global _tracks, _encoding
+	_tracks = tracks
+	_encoding = encoding
+
+def evaluate(parameters, tracks=None, encoding=None):
+	# Score one combination over every track
+	import numpy as np
+
+	tracks = tracks if tracks is not None else _tracks
+	encoder = ENCODERS[encoding or _encoding or 'json']()
+
+	points = 0
+	total_bytes = 0
+	messages = 0
+	fixes = 0
+	error_sum = 0.0
+	error_max = 0.0
+	for track in tracks:
+		sampler = Sampler(**parameters)
+		emitted = sampler.process_batch(track)
+		errors = cross_track_errors(track, emitted)
+
+		points += len(emitted)
+		track_bytes, track_messages = message_bytes(track, emitted, encoder)
+		total_bytes += track_bytes
+		messages += track_messages
+		fixes += len(errors)
+		error_sum += float(np.sum(errors))
+		if len(errors):
+			error_max = max(error_max, float(np.max(errors)))
+
+	return {
+		'parameters': parameters,
+		'points': points,
+		'bytes': total_bytes,
+		'messages': messages,
+		'fixes': fixes,
+		'max_error': round(error_max, 2),
+		'mean_error': round(error_sum / fixes, 3) if fixes else 0.0
+	}
+
+def sweep(tracks, combinations, workers=None, encoding='json'):
+	# evaluate() every valid combination across a pool of worker processes
+	import multiprocessing
+
+	combinations = [parameters for parameters in combinations if valid(parameters)]
+	logging.info("Sweeping %d combinations over %d tracks" % (len(combinations), len(tracks)))
+
+	pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(tracks, encoding))
+	try:
+		return pool.map(evaluate, combinations, chunksize=max(1, len(combinations) // (4 * (workers or multiprocessing.cpu_count()))))
+	finally:
+		pool.close()
+		pool.join()
+
+def pareto(results, error='max_error'):
+	# Results not dominated on (bytes, error), by ascending bytes
+	front = []
+	best = None
+	for result in sorted(results, key=lambda result: (result['bytes'], result[error])):
+		if best is None or result[error] < best:
+			front.append(result)
+			best = result[error]
+	return front
@@ -0,0 +1,209 @@
+import logging
+import os
+import pickle
+import time
+from collections import deque
+from math import sqrt
+
+from utils.error_handling import error_message
+
+# Fields of a WindowPoint that carry running statistics
+STAT_FIELDS = ('distance_change', 'speed', 'cyclical_course')
+
+class WindowPoint:
+	# Compact record of one accepted fix held in the Sampler's moving average window
+
+	__slots__ = (
+		'timestamp',
+		'latitude',
+		'longitude',
+		'speed',
+		'course',
+		'altitude',
+		'cyclical_course',
+		'distance_change',
+		'index',
+		'terms'
+	)
+
+	def __init__(self, timestamp, latitude, longitude, speed, course, altitude, cyclical_course, distance_change, index=None, terms=None):
+		self.timestamp = timestamp
+		self.latitude = latitude
+		self.longitude = longitude
+		self.speed = speed
+		self.course = course
+		self.altitude = altitude
+		self.cyclical_course = cyclical_course
+		self.distance_change = distance_change
+		self.index = index
+		# Distance engine terms, set by the Sampler when the point arrives
+		self.terms = terms
+
+	@classmethod
+	def from_update(cls, update):
+		return cls(
+			update.get('timestamp'),
+			update.get('latitude'),
+			update.get('longitude'),
+			update.get('speed'),
+			update.get('course'),
+			update.get('altitude'),
+			update.get('cyclical_course'),
+			update.get('distance_change')
+		)
+
+	def get(self, key, default=None):
+		# Dict-style access so a WindowPoint can stand in for an update dict
+		return getattr(self, key, default)
+
+	def __getstate__(self):
+		return tuple(getattr(self, key) for key in self.__slots__)
+
+	def __setstate__(self, state):
+		self.index = None
+		self.terms = None
+		for key, value in zip(self.__slots__, state):
+			setattr(self, key, value)
+
+class RunningStat:
+	# Running mean and sample variance (Welford) that supports removing values again
+
+	__slots__ = ('n', 'mean', 'm2')
+
+	def __init__(self):
+		self.clear()
+
+	def clear(self):
+		self.n = 0
+		self.mean = 0.0
+		self.m2 = 0.0
+
+	def add(self, x):
+		self.n += 1
+		delta = x - self.mean
+		self.mean += delta / self.n
+		self.m2 += delta * (x - self.mean)
+
+	def remove(self, x):
+		if self.n <= 1:
+			self.clear()
+			return
+
+		old_mean = self.mean
+		self.n -= 1
+		self.mean = (old_mean * (self.n + 1) - x) / self.n
+		self.m2 -= (x - old_mean) * (x - self.mean)
+
+		# Guard against rounding drift pushing the variance negative
+		if self.m2 < 0:
+			self.m2 = 0.0
+
+	def stdev(self):
+		if self.n < 2:
+			return 0
+		return sqrt(self.m2 / (self.n - 1))
+
+class RollingWindow:
+	# Fixed-capacity ring of WindowPoints with running statistics over STAT_FIELDS.
+	# Appending, evicting and reading the averages/deviations are all O(1).
+
+	def __init__(self, capacity):
+		self._points = deque(maxlen=capacity)
+		self._stats = {key: RunningStat() for key in STAT_FIELDS}
+
+	def __len__(self):
+		return len(self._points)
+
+	def __iter__(self):
+		return iter(self._points)
+
+	@property
+	def capacity(self):
+		return self._points.maxlen
+
+	def resize(self, capacity):
+		# Keep the newest points that still fit into the new capacity
+		points = list(self._points)[-capacity:]
+		self._points = deque(maxlen=capacity)
+		for stat in self._stats.values():
+			stat.clear()
+		for point in points:
+			self.append(point)
+
+	def clear(self):
+		self._points.clear()
+		for stat in self._stats.values():
+			stat.clear()
+
+	def append(self, point):
+		if len(self._points) > 0 and self._points[-1].timestamp == point.timestamp:
+			# Same epoch seen twice, the newer fix replaces the older one
+			self.__forget(self._points.pop())
+		elif len(self._points) == self._points.maxlen:
+			self.__forget(self._points.popleft())
+
+		self._points.append(point)
+		for key, stat in self._stats.items():
+			stat.add(getattr(point, key))
+
+	def discard_until(self, timestamp):
+		# Drop every point at or before timestamp
+		while len(self._points) > 0 and self._points[0].timestamp <= timestamp:
+			self.__forget(self._points.popleft())
+
+	def mean(self, key):
+		return self._stats[key].mean
+
+	def stdev(self, key):
+		return self._stats[key].stdev()
+
+	def averages(self):
+		return {key: stat.mean for key, stat in self._stats.items()}
+
+	def deviations(self):
+		return {key: stat.stdev() for key, stat in self._stats.items()}
+
+	def __forget(self, point):
+		for key, stat in self._stats.items():
+			stat.remove(getattr(point, key))
+
+class WindowSnapshot:
+	# Optional periodic snapshot of the Sampler state, used for crash recovery.
+	# The snapshot is written atomically (temp file + rename) at most every
+	# `interval` seconds, so a crash loses at most that much window history.
+
+	def __init__(self, path, interval=60):
+		self._path = path
+		self._interval = interval
+		self._last_write = time.monotonic()
+
+	def due(self):
+		return time.monotonic() - self._last_write >= self._interval
+
+	def save(self, state):
+		self._last_write = time.monotonic()
+		tmp_path = self._path + '.tmp'
+		try:
+			with open(tmp_path, 'wb') as f:
+				pickle.dump(state, f, pickle.HIGHEST_PROTOCOL)
+			os.replace(tmp_path, self._path)
+		except Exception as e:
+			logging.error("Failed to write sampler snapshot")
+			logging.error(error_message(e))
+
+	def load(self):
+		if not os.path.exists(self._path):
+			return None
+		try:
+			with open(self._path, 'rb') as f:
+				return pickle.load(f)
+		except Exception as e:
+			logging.error("Failed to read sampler snapshot")
+			logging.error(error_message(e))
+			return None
+
+	def remove(self):
+		try:
+			os.remove(self._path)
+		except FileNotFoundError:
+			pass
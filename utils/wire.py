@@ -0,0 +1,156 @@
+import json
+
+# Compact binary wire encoding for batches of sampled points
+#
+# A batch is
+#
+#   version (1 byte) | count (varint) | point * count
+#
+# and every point is
+#
+#   field mask (1 byte) | zigzag varint delta per present field
+#
+# Fields are stored as fixed-point integers (see FIELDS) and each present
+# field is delta-encoded against the same field of the last point that had
+# it, starting from zero. Bit i of the mask is set when FIELDS[i] is present,
+# so missing (None) values cost nothing.
+#
+# decode_batch() is the reference decoder for the backend; it only needs the
+# standard library.
+
+VERSION = 1
+
+# (key, scale): the wire value is round(value * scale)
+FIELDS = (
+	('t', 1),           # epoch seconds
+	('lat', 1000000),   # 1e-6 degrees, ~0.1 m
+	('lon', 1000000),
+	('s', 100),         # cm/s
+	('c', 10),          # 0.1 degrees
+	('a', 10)           # 0.1 m
+)
+
+def zigzag(n):
+	return -2 * n - 1 if n < 0 else 2 * n
+
+def unzigzag(n):
+	return (n >> 1) ^ -(n & 1)
+
+def write_varint(out, n):
+	while n > 0x7f:
+		out.append((n & 0x7f) | 0x80)
+		n >>= 7
+	out.append(n)
+
+def read_varint(data, offset):
+	shift = 0
+	n = 0
+	while True:
+		b = data[offset]
+		offset += 1
+		n |= (b & 0x7f) << shift
+		if b < 0x80:
+			return n, offset
+		shift += 7
+
+def varint_size(n):
+	size = 1
+	while n > 0x7f:
+		n >>= 7
+		size += 1
+	return size
+
+def quantize(point):
+	# Fixed-point tuple of a point, None for missing fields
+	values = []
+	for key, scale in FIELDS:
+		value = point.get(key)
+		values.append(None if value is None else int(round(float(value) * scale)))
+	return tuple(values)
+
+def encode_batch(quantized_points):
+	out = bytearray([VERSION])
+	write_varint(out, len(quantized_points))
+
+	prev = [0] * len(FIELDS)
+	for values in quantized_points:
+		mask = 0
+		for i, value in enumerate(values):
+			if value is not None:
+				mask |= 1 << i
+		out.append(mask)
+
+		for i, value in enumerate(values):
+			if value is not None:
+				write_varint(out, zigzag(value - prev[i]))
+				prev[i] = value
+
+	return bytes(out)
+
+def decode_batch(payload):
+	# Reference decoder: bytes -> list of point dicts as sent in JSON
+	if payload[0] != VERSION:
+		raise ValueError("Unsupported wire version %d" % payload[0])
+
+	count, offset = read_varint(payload, 1)
+	prev = [0] * len(FIELDS)
+	points = []
+
+	for _ in range(count):
+		mask = payload[offset]
+		offset += 1
+
+		point = {}
+		for i, (key, scale) in enumerate(FIELDS):
+			if mask & (1 << i):
+				delta, offset = read_varint(payload, offset)
+				prev[i] += unzigzag(delta)
+				point[key] = prev[i] if scale == 1 else prev[i] / scale
+			else:
+				point[key] = None
+		points.append(point)
+
+	return points
+
+class JSONEncoder:
+	# The original encoding: a JSON array of point objects
+
+	topic_suffix = "/transit/batch"
+
+	def __init__(self, default=None):
+		self._default = default
+
+	def encode_point(self, point):
+		return json.dumps(point, default=self._default, separators=(',', ':')).encode('utf-8')
+
+	def point_size(self, encoded):
+		return len(encoded)
+
+	def batch_overhead(self, count):
+		return 2 + max(count - 1, 0)
+
+	def encode_batch(self, encoded_points):
+		return b'[' + b','.join(encoded_points) + b']'
+
+class CompactEncoder:
+	# Versioned fixed-point, delta and varint packed batches, see above
+
+	topic_suffix = "/transit/batch/compact"
+
+	def encode_point(self, point):
+		return quantize(point)
+
+	def point_size(self, encoded):
+		# Upper bound: a delta needs at most one byte more than the value
+		return 1 + sum(varint_size(zigzag(value)) + 1 for value in encoded if value is not None)
+
+	def batch_overhead(self, count):
+		return 1 + varint_size(count)
+
+	def encode_batch(self, encoded_points):
+		return encode_batch(encoded_points)
+
+ENCODERS = {
+	'json': JSONEncoder,
+	'compact': CompactEncoder
+}